@@ -2,25 +2,9 @@ import streamlit as st
 import pandas as pd
 import calendar
 import json
-import re
 import datetime
-import io  # Excel書き出し用のバイナリストリームモジュール
-# OR-Tools の最適化モジュールをインポート
-from ortools.sat.python import cp_model
-# holidaysライブラリを安全にインポート（環境未導入時でもクラッシュしない設計）
-try:
-    import holidays
-except ImportError:
-    holidays = None
-
-# --- 超過時間を HH:MM 形式に変換するヘルパー関数 ---
-def format_minutes_to_hhmm(minutes):
-    is_negative = minutes < 0
-    abs_minutes = abs(minutes)
-    hh = abs_minutes // 60
-    mm = abs_minutes % 60
-    sign = "-" if is_negative else ""
-    return f"{sign}{hh:02d}:{mm:02d}"
+# 勤務作成エンジン（モデル構築・求解・結果抽出）
+import roster_engine as eng
 
 # --- 1. グローバル設定：デザインとレイアウト ---
 st.set_page_config(page_title="AI勤務作成：V80 Ultra Optimizer", page_icon="🛡️", layout="wide")
@@ -29,10 +13,6 @@ st.set_page_config(page_title="AI勤務作成：V80 Ultra Optimizer", page_icon=
 if 'config' not in st.session_state:
     st.session_state.config = {}
 
-# 履歴（世代管理）用セッション状態の初期化
-if "roster_history" not in st.session_state:
-    st.session_state["roster_history"] = []
-
 # 現在の翌月（年・月）を動的に算出するロジック
 now = datetime.datetime.now()
 if now.month == 12:
@@ -70,23 +50,22 @@ st.info("💡 **操作負荷低減アップデート**: 各タブでの入力時
 # --- 2. データのバックアップ・復元管理（サイドバー） ---
 with st.sidebar:
     st.header("📂 設定データの完全同期")
-    up_file = st.file_uploader("設定ファイルを読み込む", type="json")
+    up_file = st.file_uploader("設定ファイルを読み込む", type=["json", "v80z"])
     if up_file:
         file_id = f"{up_file.name}_{up_file.size}"
         if "last_loaded_file" not in st.session_state or st.session_state.last_loaded_file != file_id:
             try:
-                st.session_state.config.update(json.load(up_file))
-                if "last_state_key" in st.session_state:
-                    del st.session_state.last_state_key
+                st.session_state.config.update(eng.load_config_bytes(up_file.getvalue()))
+                if "table_state_keys" in st.session_state:
+                    del st.session_state["table_state_keys"]
                 
                 keys_to_delete = [k for k in st.session_state.keys() if "_ed_" in k or "names_ed" in k]
                 for k in keys_to_delete:
                     del st.session_state[k]
 
-                # 計算済みのシフト結果、および履歴キャッシュもクリア
+                # 計算済みのシフト結果をクリア（履歴は読み込んだユニット×年月のものへ自動で切り替わる）
                 if "raw_schedule" in st.session_state:
                     del st.session_state["raw_schedule"]
-                st.session_state["roster_history"] = []
 
                 st.session_state.last_loaded_file = file_id
                 st.success("全ての変数の整合性を確認し復元しました。")
@@ -107,19 +86,26 @@ with st.sidebar:
     month = int(st.number_input("月", 1, 12, st.session_state.config["month"]))
 
     st.divider()
+    # 書き出しはボタンが押されたときだけ実行する（再実行のたびに全設定を直列化しない）
+    config_snapshot = st.session_state.config
     st.download_button(
         "📥 現在の全設定を保存する", 
-        json.dumps(st.session_state.config, ensure_ascii=False), 
-        f"v80_backup_{year}_{month}.json"
+        lambda: eng.config_to_json(config_snapshot),
+        f"v80_backup_{year}_{month}.json",
+        mime="application/json",
+        on_click="ignore",
+    )
+    st.download_button(
+        "🗜️ コンパクト形式で保存する（大規模ユニット向け）",
+        lambda: eng.pack_config(config_snapshot),
+        f"v80_backup_{year}_{month}.v80z",
+        mime="application/octet-stream",
+        help="表を列ごとの整数コードに圧縮した版数付きバイナリ形式です。上の「設定ファイルを読み込む」からそのまま復元できます。",
+        on_click="ignore",
     )
 
 # --- 日本の祝日判定用データの取得 ---
-jp_holidays = {}
-if holidays is not None:
-    try:
-        jp_holidays = holidays.Japan(years=[year])
-    except Exception:
-        pass
+jp_holidays = eng.get_jp_holidays(year)
 
 # 現在の有効な設定パラメータを読み込み
 n_mgr = st.session_state.config["num_mgr"]
@@ -138,34 +124,7 @@ late_gr = [x for x in s_list if x in st.session_state.config["late_shifts"]]
 
 # --- 【位置ベース】曜日ズレ・非カレンダーテーブル共通高精度復元関数 ---
 def get_persisted_df(key, d_df, categories=None):
-    tables = st.session_state.config.get("saved_tables", {})
-    if key in tables:
-        raw_data = tables.get(key)
-        df = pd.DataFrame(raw_data)
-        
-        result_df = d_df.copy()
-        
-        max_rows = min(len(d_df.index), len(df.index))
-        max_cols = min(len(d_df.columns), len(df.columns))
-        
-        for i in range(max_rows):
-            for j in range(max_cols):
-                try:
-                    val = df.iloc[i, j]
-                    if hasattr(val, "values"):
-                        val = val.values[0] if len(val.values) > 0 else None
-                    if pd.notna(val) and val != "":
-                        result_df.iloc[i, j] = val
-                except Exception:
-                    pass
-        df = result_df
-    else:
-        df = d_df
-    
-    if categories:
-        for c in df.columns: 
-            df[c] = pd.Categorical(df[c], categories=categories)
-    return df
+    return eng.restore_table(st.session_state.config.get("saved_tables", {}), key, d_df, categories)
 
 # 超過時間設定用のF対応リスト
 overtime_s_list = list(s_list)
@@ -174,38 +133,60 @@ if "C" in s_list and "D" in s_list:
 
 # カレンダーの準備
 _, n_days = calendar.monthrange(year, month)
-days_cols = [f"{d+1}({['月','火','水','木','金','土','日'][calendar.weekday(year,month,d+1)]})" for d in range(n_days)]
+days_cols = eng.make_days_cols(year, month)
 options = ["", "休", "日"] + s_list
-p_days = ["前月4日前","前月3日前","前月2日前","前月末日"]
+p_days = list(eng.P_DAYS)
+
+# --- 勤務表の世代履歴（基準勤務表からのセル差分で保持し、ユニット×年月ごとにディスクへ永続化） ---
+history_file = eng.history_path(eng.history_unit_key(staff_list, s_list), year, month)
+if st.session_state.get("roster_history") is None or st.session_state["roster_history"].path != history_file:
+    st.session_state["roster_history"] = eng.RosterHistory.load(history_file)
+roster_history = st.session_state["roster_history"]
+
+
+def add_history(df, label):
+    # 最新世代と同じ内容なら登録しない
+    if not roster_history.push(df, label):
+        return False
+    roster_history.save()
+    return True
+
 
 # --- 【重要】ステート同期・DataFrame完全永続化システム ---
-current_state_key = (
-    tuple(staff_list),
-    tuple(days_cols),
-    tuple(s_list),
-    tuple(overtime_s_list),
-    year,
-    month
-)
-
-required_keys = ["skill", "hols", "trainee", "prev", "request", "exclude", "overtime", "designated", "names"]
-all_keys_exist = all(k in st.session_state for k in required_keys)
-
-if "last_state_key" not in st.session_state or st.session_state.last_state_key != current_state_key or not all_keys_exist:
-    form_names = list(staff_list)
-    st.session_state["skill"] = get_persisted_df("skill", pd.DataFrame("○", index=staff_list, columns=s_list), ["○", "△", "×"])
-    st.session_state["hols"] = get_persisted_df("hols", pd.DataFrame({"休の総数": [9] * len(staff_list), "公休分": [8] * len(staff_list)}, index=staff_list))
-    st.session_state["trainee"] = get_persisted_df("trainee", pd.DataFrame(0, index=staff_list, columns=[f"{s}_見習い回数" for s in s_list]))
-    st.session_state["prev"] = get_persisted_df("prev", pd.DataFrame("休", index=staff_list, columns=p_days), ["日", "休", "早", "遅"])
-    st.session_state["request"] = get_persisted_df("request", pd.DataFrame("", index=staff_list, columns=days_cols), options)
-    st.session_state["exclude"] = get_persisted_df("exclude", pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=s_list))
-    st.session_state["overtime"] = get_persisted_df("overtime", pd.DataFrame({"平日超過分(分)": [0 if s in ["A","B"] else 30 for s in overtime_s_list], "土曜超過分(分)": [0 if s in ["A","B"] else 30 for s in overtime_s_list]}, index=overtime_s_list))
-    st.session_state["designated"] = get_persisted_df("designated", pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=["指定日"]))
-    st.session_state["names"] = get_persisted_df("names", pd.DataFrame({"スタッフ名": form_names}))
-    
-    st.session_state.last_state_key = current_state_key
+# テーブルごとに実際に依存する構成だけをキーにし、変わったテーブルだけを保存データから作り直す
+# （例: スタッフを1名追加しても不要担務・超過時間・指定日は作り直さない）
+table_state_keys = {
+    "skill": (tuple(staff_list), tuple(s_list)),
+    "hols": (tuple(staff_list),),
+    "trainee": (tuple(staff_list), tuple(s_list)),
+    "prev": (tuple(staff_list),),
+    "request": (tuple(staff_list), tuple(days_cols), tuple(s_list), year, month),
+    "exclude": (tuple(days_cols), tuple(s_list), year, month),
+    "overtime": (tuple(overtime_s_list),),
+    "designated": (tuple(days_cols), year, month),
+    "names": (tuple(staff_list),),
+}
+table_defaults = {
+    "skill": lambda: get_persisted_df("skill", pd.DataFrame("○", index=staff_list, columns=s_list), ["○", "△", "×"]),
+    "hols": lambda: get_persisted_df("hols", pd.DataFrame({"休の総数": [9] * len(staff_list), "公休分": [8] * len(staff_list)}, index=staff_list)),
+    "trainee": lambda: get_persisted_df("trainee", pd.DataFrame(0, index=staff_list, columns=[f"{s}_見習い回数" for s in s_list])),
+    "prev": lambda: get_persisted_df("prev", pd.DataFrame("休", index=staff_list, columns=p_days), ["日", "休", "早", "遅"]),
+    "request": lambda: get_persisted_df("request", pd.DataFrame("", index=staff_list, columns=days_cols), options),
+    "exclude": lambda: get_persisted_df("exclude", pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=s_list)),
+    "overtime": lambda: get_persisted_df("overtime", pd.DataFrame({"平日超過分(分)": [0 if s in ["A","B"] else 30 for s in overtime_s_list], "土曜超過分(分)": [0 if s in ["A","B"] else 30 for s in overtime_s_list]}, index=overtime_s_list)),
+    "designated": lambda: get_persisted_df("designated", pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=["指定日"])),
+    "names": lambda: get_persisted_df("names", pd.DataFrame({"スタッフ名": list(staff_list)})),
+}
+
+built_state_keys = st.session_state.setdefault("table_state_keys", {})
+for key in eng.TABLE_KEYS:
+    if key not in st.session_state or built_state_keys.get(key) != table_state_keys[key]:
+        st.session_state[key] = table_defaults[key]()
+        built_state_keys[key] = table_state_keys[key]
 
 # --- 3. UIの統合タブ構成 ---
+# 各タブのフォームはフラグメントとして描画する（保存ボタンはまずそのタブだけを再実行し、
+# 入力表が変わったときに限りアプリ全体を再実行して派生データを更新する）
 tab_st, tab_ot, tab_skl, tab_hol, tab_prev, tab_req, tab_ex_des, tab_solve = st.tabs([
     "🏗️ 1. 基本構成", 
     "⏱️ 2. 超過時間設定",
@@ -219,161 +200,182 @@ tab_st, tab_ot, tab_skl, tab_hol, tab_prev, tab_req, tab_ex_des, tab_solve = st.
 
 # --- タブ1. 基本構成 ---
 with tab_st:
-    with st.form("st_form"):
-        c1, c2 = st.columns(2)
-        with c1:
-            st.subheader("👥 人員配置")
-            form_n_mgr = st.number_input("管理者数", 0, 5, n_mgr)
-            form_n_reg = st.number_input("一般職数", 1, 20, n_reg)
-            form_total = int(form_n_mgr + form_n_reg)
-            ed_names = st.data_editor(st.session_state["names"], use_container_width=True, key=f"names_ed_{len(staff_list)}")
-        with c2:
-            st.subheader("📋 シフト構成")
-            form_raw_s = st.text_input("勤務略称 (,) 区切り", raw_s)
-            form_s_list = [s.strip() for s in form_raw_s.split(",") if s.strip()]
-            form_early_gr = st.multiselect("早番グループ", form_s_list, default=[x for x in form_s_list if x in early_gr])
-            form_late_gr = st.multiselect("遅番グループ", form_s_list, default=[x for x in form_s_list if x in late_gr])
+    @st.fragment
+    def basic_settings_form():
+        with st.form("st_form"):
+            c1, c2 = st.columns(2)
+            with c1:
+                st.subheader("👥 人員配置")
+                form_n_mgr = st.number_input("管理者数", 0, 5, n_mgr)
+                form_n_reg = st.number_input("一般職数", 1, 20, n_reg)
+                form_total = int(form_n_mgr + form_n_reg)
+                ed_names = st.data_editor(st.session_state["names"], use_container_width=True, key=f"names_ed_{len(staff_list)}")
+            with c2:
+                st.subheader("📋 シフト構成")
+                form_raw_s = st.text_input("勤務略称 (,) 区切り", raw_s)
+                form_s_list = [s.strip() for s in form_raw_s.split(",") if s.strip()]
+                form_early_gr = st.multiselect("早番グループ", form_s_list, default=[x for x in form_s_list if x in early_gr])
+                form_late_gr = st.multiselect("遅番グループ", form_s_list, default=[x for x in form_s_list if x in late_gr])
             
-        submit_st = st.form_submit_button("🏗️ 基本構成を保存する")
-        if submit_st:
-            new_staff_list = ed_names["スタッフ名"].tolist()
-            st.session_state["names"] = ed_names
-            st.session_state.config["saved_tables"]["names"] = ed_names.to_dict()
-            st.session_state.config.update({
-                "num_mgr": form_n_mgr,
-                "num_regular": form_n_reg,
-                "staff_names": new_staff_list,
-                "user_shifts": form_raw_s,
-                "early_shifts": form_early_gr,
-                "late_shifts": form_late_gr
-            })
-            st.success("基本構成を保存しました。")
-            st.rerun()
+            submit_st = st.form_submit_button("🏗️ 基本構成を保存する")
+            if submit_st:
+                new_staff_list = ed_names["スタッフ名"].tolist()
+                st.session_state["names"] = ed_names
+                st.session_state.config["saved_tables"]["names"] = ed_names.to_dict()
+                st.session_state.config.update({
+                    "num_mgr": form_n_mgr,
+                    "num_regular": form_n_reg,
+                    "staff_names": new_staff_list,
+                    "user_shifts": form_raw_s,
+                    "early_shifts": form_early_gr,
+                    "late_shifts": form_late_gr
+                })
+                st.success("基本構成を保存しました。")
+                st.rerun()
+    basic_settings_form()
 
 # --- タブ2. 担務の超過時間設定 ---
 with tab_ot:
-    with st.form("ot_form"):
-        st.subheader("⏱️ 各担務の超過時間設定")
-        st.write("※日勤、日曜日のすべての担務、土曜日のA・B勤務は、自動的に一律「0分」として処理されます。")
-        ed_overtime = st.data_editor(st.session_state["overtime"], use_container_width=True, key=f"overtime_ed_{len(overtime_s_list)}")
-        submit_ot = st.form_submit_button("⏱️ 超過時間設定を保存する")
-        if submit_ot:
-            st.session_state["overtime"] = ed_overtime
-            st.session_state.config["saved_tables"]["overtime"] = ed_overtime.to_dict()
-            st.success("超過時間設定を保存しました。")
-            st.rerun()
+    @st.fragment
+    def overtime_form():
+        with st.form("ot_form"):
+            st.subheader("⏱️ 各担務の超過時間設定")
+            st.write("※日勤、日曜日のすべての担務、土曜日のA・B勤務は、自動的に一律「0分」として処理されます。")
+            ed_overtime = st.data_editor(st.session_state["overtime"], use_container_width=True, key=f"overtime_ed_{len(overtime_s_list)}")
+            submit_ot = st.form_submit_button("⏱️ 超過時間設定を保存する")
+            if submit_ot:
+                st.session_state["overtime"] = ed_overtime
+                st.session_state.config["saved_tables"]["overtime"] = ed_overtime.to_dict()
+                st.success("超過時間設定を保存しました。")
+                st.rerun()
+    overtime_form()
 
 # --- タブ3. 専門スキル ＆ 教育同行設定 ---
 with tab_skl:
-    with st.form("skl_form"):
-        st.subheader("🎓 専門スキル（○:可能, △:見習い, ×:不可）")
-        column_config_skill = {
-            col: st.column_config.SelectboxColumn(
-                col,
-                options=["○", "△", "×"],
-                required=True
+    @st.fragment
+    def skill_form():
+        with st.form("skl_form"):
+            st.subheader("🎓 専門スキル（○:可能, △:見習い, ×:不可）")
+            column_config_skill = {
+                col: st.column_config.SelectboxColumn(
+                    col,
+                    options=["○", "△", "×"],
+                    required=True
+                )
+                for col in s_list
+            }
+            ed_skill = st.data_editor(
+                st.session_state["skill"], 
+                column_config=column_config_skill,
+                use_container_width=True, 
+                key=f"skill_ed_{len(staff_list)}_{len(s_list)}"
             )
-            for col in s_list
-        }
-        ed_skill = st.data_editor(
-            st.session_state["skill"], 
-            column_config=column_config_skill,
-            use_container_width=True, 
-            key=f"skill_ed_{len(staff_list)}_{len(s_list)}"
-        )
         
-        st.subheader("🏫 教育ノルマ（見習い担当回数の上限）")
-        ed_trainee = st.data_editor(st.session_state["trainee"], use_container_width=True, key=f"trainee_ed_{len(staff_list)}")
-        submit_skl = st.form_submit_button("🎓 スキル・教育同行設定を保存する")
-        if submit_skl:
-            st.session_state["skill"] = ed_skill
-            st.session_state["trainee"] = ed_trainee
-            st.session_state.config["saved_tables"]["skill"] = ed_skill.to_dict()
-            st.session_state.config["saved_tables"]["trainee"] = ed_trainee.to_dict()
-            st.success("スキル・教育同行設定を保存しました。")
-            st.rerun()
+            st.subheader("🏫 教育ノルマ（見習い担当回数の上限）")
+            ed_trainee = st.data_editor(st.session_state["trainee"], use_container_width=True, key=f"trainee_ed_{len(staff_list)}")
+            submit_skl = st.form_submit_button("🎓 スキル・教育同行設定を保存する")
+            if submit_skl:
+                st.session_state["skill"] = ed_skill
+                st.session_state["trainee"] = ed_trainee
+                st.session_state.config["saved_tables"]["skill"] = ed_skill.to_dict()
+                st.session_state.config["saved_tables"]["trainee"] = ed_trainee.to_dict()
+                st.success("スキル・教育同行設定を保存しました。")
+                st.rerun()
+    skill_form()
 
 # --- タブ4. 月間休日数設定 ---
 with tab_hol:
-    with st.form("hol_form"):
-        st.subheader("📅 月間休日数設定")
-        ed_hols = st.data_editor(st.session_state["hols"], use_container_width=True, key=f"hols_ed_{len(staff_list)}")
-        submit_hol = st.form_submit_button("📅 休日数設定を保存する")
-        if submit_hol:
-            st.session_state["hols"] = ed_hols
-            st.session_state.config["saved_tables"]["hols"] = ed_hols.to_dict()
-            st.success("休日数設定を保存・同期しました。")
-            st.rerun()
+    @st.fragment
+    def holidays_form():
+        with st.form("hol_form"):
+            st.subheader("📅 月間休日数設定")
+            ed_hols = st.data_editor(st.session_state["hols"], use_container_width=True, key=f"hols_ed_{len(staff_list)}")
+            submit_hol = st.form_submit_button("📅 休日数設定を保存する")
+            if submit_hol:
+                st.session_state["hols"] = ed_hols
+                st.session_state.config["saved_tables"]["hols"] = ed_hols.to_dict()
+                st.success("休日数設定を保存・同期しました。")
+                st.rerun()
+    holidays_form()
 
 # --- タブ5. 前月末引継ぎ ---
 with tab_prev:
-    with st.form("prev_form"):
-        st.subheader("🗓️ 前月末引継ぎ")
-        column_config_prev = {
-            col: st.column_config.SelectboxColumn(
-                col,
-                options=["日", "休", "早", "遅"],
-                required=True,
-                width=75
+    @st.fragment
+    def prev_form():
+        with st.form("prev_form"):
+            st.subheader("🗓️ 前月末引継ぎ")
+            column_config_prev = {
+                col: st.column_config.SelectboxColumn(
+                    col,
+                    options=["日", "休", "早", "遅"],
+                    required=True,
+                    width=75
+                )
+                for col in p_days
+            }
+            ed_prev = st.data_editor(
+                st.session_state["prev"], 
+                column_config=column_config_prev,
+                use_container_width=True, 
+                key=f"prev_ed_{len(staff_list)}"
             )
-            for col in p_days
-        }
-        ed_prev = st.data_editor(
-            st.session_state["prev"], 
-            column_config=column_config_prev,
-            use_container_width=True, 
-            key=f"prev_ed_{len(staff_list)}"
-        )
-        submit_prev = st.form_submit_button("🗓️ 前月末引継ぎを保存する")
-        if submit_prev:
-            st.session_state["prev"] = ed_prev
-            st.session_state.config["saved_tables"]["prev"] = ed_prev.to_dict()
-            st.success("前月末引継ぎを保存しました。")
-            st.rerun()
+            submit_prev = st.form_submit_button("🗓️ 前月末引継ぎを保存する")
+            if submit_prev:
+                st.session_state["prev"] = ed_prev
+                st.session_state.config["saved_tables"]["prev"] = ed_prev.to_dict()
+                st.success("前月末引継ぎを保存しました。")
+                st.rerun()
+    prev_form()
 
 # --- タブ6. 今月の申し込み ---
 with tab_req:
-    with st.form("request_form"):
-        st.subheader("📝 今月の申し込み (※「休」は年次休暇として集計します)")
-        column_config_request = {
-            col: st.column_config.SelectboxColumn(
-                col,
-                options=options,
-                required=False,
-                width=45
+    @st.fragment
+    def request_form():
+        with st.form("request_form"):
+            st.subheader("📝 今月の申し込み (※「休」は年次休暇として集計します)")
+            column_config_request = {
+                col: st.column_config.SelectboxColumn(
+                    col,
+                    options=options,
+                    required=False,
+                    width=45
+                )
+                for col in days_cols
+            }
+            ed_req = st.data_editor(
+                st.session_state["request"], 
+                column_config=column_config_request,
+                use_container_width=True, 
+                key=f"request_ed_{len(staff_list)}_{year}_{month}"
             )
-            for col in days_cols
-        }
-        ed_req = st.data_editor(
-            st.session_state["request"], 
-            column_config=column_config_request,
-            use_container_width=True, 
-            key=f"request_ed_{len(staff_list)}_{year}_{month}"
-        )
-        submit_req = st.form_submit_button("📝 今月の申し込みを保存する")
-        if submit_req:
-            st.session_state["request"] = ed_req
-            st.session_state.config["saved_tables"]["request"] = ed_req.to_dict()
-            st.success("今月の申し込みを保存しました。")
-            st.rerun()
+            submit_req = st.form_submit_button("📝 今月の申し込みを保存する")
+            if submit_req:
+                st.session_state["request"] = ed_req
+                st.session_state.config["saved_tables"]["request"] = ed_req.to_dict()
+                st.success("今月の申し込みを保存しました。")
+                st.rerun()
+    request_form()
 
 # --- タブ7. 不要担務・指定日設定 ---
 with tab_ex_des:
-    with st.form("ex_des_form"):
-        st.subheader("🚫 不要担務 (祝日Cなど)")
-        ed_ex = st.data_editor(st.session_state["exclude"], use_container_width=True, key=f"exclude_ed_{year}_{month}")
+    @st.fragment
+    def exclude_designated_form():
+        with st.form("ex_des_form"):
+            st.subheader("🚫 不要担務 (祝日Cなど)")
+            ed_ex = st.data_editor(st.session_state["exclude"], use_container_width=True, key=f"exclude_ed_{year}_{month}")
         
-        st.subheader("📌 指定日設定")
-        st.write("※ここでチェックを入れた日は「指定日」となり、A・B勤務の超過分が自動的に「0分」になります。")
-        ed_des = st.data_editor(st.session_state["designated"], use_container_width=True, key=f"designated_ed_{year}_{month}")
-        submit_ex_des = st.form_submit_button("🚫 不要担務・指定日設定を保存する")
-        if submit_ex_des:
-            st.session_state["exclude"] = ed_ex
-            st.session_state["designated"] = ed_des
-            st.session_state.config["saved_tables"]["exclude"] = ed_ex.to_dict()
-            st.session_state.config["saved_tables"]["designated"] = ed_des.to_dict()
-            st.success("不要担務・指定日設定を保存しました。")
-            st.rerun()
+            st.subheader("📌 指定日設定")
+            st.write("※ここでチェックを入れた日は「指定日」となり、A・B勤務の超過分が自動的に「0分」になります。")
+            ed_des = st.data_editor(st.session_state["designated"], use_container_width=True, key=f"designated_ed_{year}_{month}")
+            submit_ex_des = st.form_submit_button("🚫 不要担務・指定日設定を保存する")
+            if submit_ex_des:
+                st.session_state["exclude"] = ed_ex
+                st.session_state["designated"] = ed_des
+                st.session_state.config["saved_tables"]["exclude"] = ed_ex.to_dict()
+                st.session_state.config["saved_tables"]["designated"] = ed_des.to_dict()
+                st.success("不要担務・指定日設定を保存しました。")
+                st.rerun()
+    exclude_designated_form()
 
 # --- 最適化インプットデータの最新同期取得 ---
 opt_skill = st.session_state["skill"]
@@ -384,44 +386,91 @@ opt_ex = st.session_state["exclude"]
 opt_overtime = st.session_state["overtime"]
 opt_des = st.session_state["designated"]
 
+# エンジンへ渡す問題定義（テーブルは参照渡しのため構築コストはほぼゼロ）
+problem = {
+    "year": year, "month": month, "n_days": n_days,
+    "n_mgr": n_mgr, "total": total,
+    "staff_list": staff_list, "s_list": s_list,
+    "early_gr": early_gr, "late_gr": late_gr,
+    "days_cols": days_cols, "jp_holidays": jp_holidays,
+    "tables": {
+        "skill": opt_skill, "hols": opt_hols, "prev": opt_prev, "request": opt_req,
+        "exclude": opt_ex, "overtime": opt_overtime, "designated": opt_des,
+    },
+}
+weights = {"w_h_rule": w_h_rule, "w_mixing": w_mixing, "w_fair": w_fair, "w_holiday": w_holiday}
+
+
+# --- 派生データ（エンジン入力配列）のキャッシュ ---
+# 入力表の DataFrame はタブで保存されたときだけ差し替わるため、同じオブジェクトの間は前回の配列を再利用する
+def cached_inputs(problem):
+    key = (problem["year"], problem["month"], problem["n_mgr"], tuple(problem["staff_list"]), tuple(problem["s_list"]),
+           tuple(problem["early_gr"]), tuple(problem["late_gr"]))
+    tables = problem["tables"]
+    hit = st.session_state.get("inputs_cache")
+    if hit is not None and hit[0] == key and all(hit[1].get(k) is tables[k] for k in tables):
+        return hit[2]
+    inputs = eng.compile_inputs(problem)
+    st.session_state["inputs_cache"] = (key, dict(tables), inputs)
+    return inputs
+
+
+problem_inputs = cached_inputs(problem)
+
+# --- 求解前の矛盾検出（各タブの保存 → 全体再実行のたびに数ミリ秒で再判定） ---
+precheck = eng.precheck_inputs(problem, problem_inputs)
+precheck_ms = precheck["elapsed"] * 1000
+if precheck["errors"]:
+    st.sidebar.error(f"🧯 入力に矛盾が {precheck['errors']} 件あります（このままでは解が見つかりません）。「AI勤務表作成」タブで確認してください。")
+elif precheck["warnings"]:
+    st.sidebar.warning(f"🧯 欠員・休日調整などの注意点が {precheck['warnings']} 件あります。「AI勤務表作成」タブで確認してください。")
+
 # --- タブ8. AI勤務表作成の実行 ---
 with tab_solve:
     st.write("🔍 **AIが今回読み込んだ各スタッフの公休と年次休暇の最終データ（自動同期検証用）**")
-    debug_rows = []
-    for s_idx, s_name in enumerate(staff_list):
-        req_off_count = sum(1 for di in range(n_days) if opt_req.iloc[s_idx, di] == "休")
-        total_h = int(opt_hols.iloc[s_idx, 0])
-        kokyu_h = int(opt_hols.iloc[s_idx, 1])
-        
-        # 調整休枠の上限
-        max_cho_capacity = total_h - kokyu_h
-        expected_cho = max(0, max_cho_capacity)
-        expected_nen = max(0, req_off_count - expected_cho)
-        expected_total = kokyu_h + expected_cho + expected_nen
-        
-        debug_rows.append({
-            "スタッフ名": s_name,
-            "公休(休)目標": kokyu_h,
-            "調整休(調)目標": expected_cho,
-            "追加年休(年)目標": expected_nen,
-            "希望休(申し込み)数": req_off_count,
-            "最終休み目標(総数)": expected_total
-        })
-    st.dataframe(pd.DataFrame(debug_rows), use_container_width=True)
+    req_off_counts = (problem_inputs["request"] == problem_inputs["S_OFF"]).sum(axis=1)
+    st.dataframe(pd.DataFrame({
+        "スタッフ名": staff_list,
+        "公休(休)目標": problem_inputs["kokyu"],
+        "調整休(調)目標": problem_inputs["expected_cho"],
+        "追加年休(年)目標": problem_inputs["expected_nen"],
+        "希望休(申し込み)数": req_off_counts,
+        "最終休み目標(総数)": problem_inputs["kokyu"] + problem_inputs["expected_cho"] + problem_inputs["expected_nen"],
+    }), use_container_width=True)
+
+    # --- 求解前チェックの結果（スタッフ×日ごとの矛盾箇所） ---
+    if precheck["issues"]:
+        precheck_df = pd.DataFrame([
+            {"重大度": "🚨 矛盾" if x["level"] == "error" else "⚠️ 注意", "日": x["day"] or "-", "スタッフ名": x["staff"] or "-", "内容": x["message"]}
+            for x in precheck["issues"]
+        ])
+        if precheck["errors"]:
+            st.error(f"🧯 **求解前チェック**: 申し込み・スキル・前月末引継ぎの間に **{precheck['errors']} 件の矛盾** があり、このまま実行しても解が見つかりません。該当箇所を修正してください。")
+        else:
+            st.warning(f"🧯 **求解前チェック**: 作成はできますが、欠員・休日数の調整・連勤などの緩和が **{precheck['warnings']} 件** 避けられません。")
+        with st.expander(f"求解前チェックの詳細（{len(precheck['issues'])} 件・判定 {precheck_ms:.1f} ミリ秒）", expanded=bool(precheck["errors"])):
+            st.dataframe(precheck_df, use_container_width=True, hide_index=True)
+    else:
+        st.caption(f"🧯 求解前チェック: 入力の矛盾は見つかりませんでした（判定 {precheck_ms:.1f} ミリ秒）。")
 
     # --- 履歴管理（世代トラベル）操作パネル ---
-    if st.session_state["roster_history"]:
+    # 世代の選択はこのパネルだけを再実行し、復元したときだけアプリ全体を再計算する
+    @st.fragment
+    def history_panel():
+        if not len(roster_history):
+            return
         st.divider()
         st.subheader("⏳ 勤務表のバージョン管理履歴（ロールバック）")
         st.info("💡 過去に自動作成、または手動調整したセーブポイントへいつでも戻ることができます。")
-        hist_options = [f"世代 {i+1}: [{h['timestamp']}] {h['label']}" for i, h in enumerate(st.session_state["roster_history"])]
+        hist_options = [f"世代 {i+1}: [{h['timestamp']}] {h['label']}（基準から {h['changed']} セル変更）" for i, h in enumerate(roster_history.entries())]
         selected_hist_str = st.selectbox("ロールバックする勤務表のバージョンを選択してください:", hist_options, index=len(hist_options)-1)
         selected_idx = hist_options.index(selected_hist_str)
         
         if st.button("🔄 選択したバージョンに復元する"):
-            st.session_state["raw_schedule"] = st.session_state["roster_history"][selected_idx]["df"].copy()
+            st.session_state["raw_schedule"] = roster_history.get(selected_idx)
             st.success("選択された履歴バージョンから勤務スケジュールを正常に復元しました。")
             st.rerun()
+    history_panel()
 
     # --- 数理最適化開始 ---
     st.divider()
@@ -429,340 +478,219 @@ with tab_solve:
     
     strategy_mode = st.radio(
         "🎯 **AIの勤務作成戦略（モード）を選択してください**",
-        ["⚖️ バランス調整モード（標準）", "🤝 フェアネス（担当回数公平）最優先モード", "🧘 健康・リズム（連勤・シフト負荷低減）最優先モード"],
+        eng.STRATEGY_MODES,
         horizontal=True,
         help="戦略に応じて、AIの思考ウェイトが自動調整されます。"
     )
 
-    if st.button("🚀 AIによる勤務作成 (最高解モード)"):
-        progress_bar = st.progress(10, text="エンジンの初期化中...")
-        
-        model = cp_model.CpModel()
-        
-        s_list_extended = list(s_list)
-        has_C_and_D = "C" in s_list and "D" in s_list
-        c_idx, d_idx, f_idx = -1, -1, -1
-        if has_C_and_D:
-            s_list_extended.append("F")
-            c_idx = s_list.index("C")
-            d_idx = s_list.index("D")
-            f_idx = s_list_extended.index("F")
-
-        num_types_extended = len(s_list_extended)
-        
-        S_OFF, S_NIK = 0, num_types_extended + 1
-        S_CHO = num_types_extended + 2
-        S_NEN = num_types_extended + 3
-        
-        E_IDS = [s_list_extended.index(x) + 1 for x in early_gr if x in s_list_extended]
-        L_IDS = [s_list_extended.index(x) + 1 for x in late_gr if x in s_list_extended]
-        
-        if "⚖️" in strategy_mode:
-            current_w_h_rule = w_h_rule
-            current_w_rhythm = w_mixing
-            current_w_fair = w_fair
-        elif "🤝" in strategy_mode:
-            current_w_h_rule = w_h_rule
-            current_w_rhythm = int(w_mixing * 0.5)
-            current_w_fair = int(w_fair * 4.0)
-        else:  # 🧘 健康・リズム最優先
-            current_w_h_rule = int(w_h_rule * 2.0)
-            current_w_rhythm = int(w_mixing * 4.0)
-            current_w_fair = int(w_fair * 0.3)
-
-        def get_skill_for_F(s_idx):
-            skill_c = opt_skill.iloc[s_idx, c_idx]
-            skill_d = opt_skill.iloc[s_idx, d_idx]
-            if skill_c == "×" or skill_d == "×":
-                return "×"
-            elif skill_c == "○" and skill_d == "○":
-                return "○"
-            return "△"
-
-        progress_bar.progress(30, text="制約条件のマッピング中...")
-        x = {(s, d, i): model.NewBoolVar(f'x_{s}_{d}_{i}') for s in range(total) for d in range(n_days) for i in range(num_types_extended + 4)}
-        score_objs = []
+    with st.expander("⚙️ ソルバー詳細設定"):
+        use_shared_mentor = st.checkbox(
+            "🧑‍🏫 教育同行判定を日ごとの共有変数で構築する（見習いが多い月向け）",
+            value=eng.DEFAULT_MODEL_OPTIONS["mentor_coverage"] == "shared",
+            help="見習い1人ごとに熟練者の和を展開せず、日×担務スキルごとに1つの判定変数を共有してモデルを小さくします。"
+        )
+        use_lexicographic = st.checkbox(
+            "🪜 段階的（辞書式）最適化で求解する",
+            value=eng.DEFAULT_MODEL_OPTIONS["objective"] == "lexicographic",
+            help="担務充足 → 勤務ルール → 休日数 → リズム・公平性の順に1段ずつ最適化し、前段の最適値を固定して次段へ進みます。"
+                 "桁違いの重みを1つの目的関数に混ぜないため、各段の最適性を証明しやすくなります。"
+        )
+        symmetric_staff = sum(len(c) for c in eng.interchangeable_staff(problem_inputs))
+        use_symmetry = st.checkbox(
+            f"🪞 入れ替え可能なスタッフの対称性を除去する（該当 {symmetric_staff} 名）",
+            value=eng.DEFAULT_MODEL_OPTIONS["symmetry"] == "lex",
+            disabled=symmetric_staff == 0,
+            help="スキル・申し込み・前月末引継ぎ・休日目標・職位がすべて同じスタッフは勤務を入れ替えても評価が変わらないため、"
+                 "勤務列に辞書式の順序を付けて同じ勤務表の並べ替えを探索から除きます。一般職の条件がそろっている月ほど最適性の証明が速くなります。"
+                 "（近傍修復では使用しません）"
+        )
+        # ウォームスタート（初期解ヒント）の選択肢: 現在の勤務表 + 履歴の各世代
+        # 世代の勤務表は選択されたものだけを差分から復元する
+        hint_sources = {"使用しない（ゼロから探索）": None}
+        if "raw_schedule" in st.session_state:
+            hint_sources["現在の勤務表（手動調整を含む）"] = "current"
+        for i, h in enumerate(roster_history.entries()):
+            hint_sources[f"世代 {i+1}: [{h['timestamp']}] {h['label']}"] = i
+        hint_choice = st.selectbox(
+            "🧭 ウォームスタート（既存の勤務表を初期解ヒントとして与える）",
+            list(hint_sources.keys()),
+            help="希望休を1件追加した程度の小さな設定変更なら、前回の勤務表から探索を始めることで数秒で収束します。"
+        )
+        hint_time_limit = st.number_input(
+            "ウォームスタート時の制限時間（秒）", 1, int(eng.DEFAULT_TIME_LIMIT), min(15, int(eng.DEFAULT_TIME_LIMIT)),
+            disabled=hint_sources[hint_choice] is None
+        )
+        use_solve_cache = st.checkbox(
+            "♻️ 同一条件の求解結果をキャッシュから再利用する",
+            value=True,
+            help="設定・年月・祝日・戦略・ウェイト・ソルバー設定がすべて同じ場合、CP-SAT を再実行せず前回の勤務表を即座に返します（ウォームスタート時は対象外）。"
+        )
+        # 常駐の求解サービスが起動していれば、求解はサービス側のプロセスプールで順番に実行する
+        service_info = eng.service_health()
+        use_service = st.checkbox(
+            "🖥️ ローカル求解サービスへ投入する（同時実行数を CPU コア数に制限して順番待ち）",
+            value=service_info is not None,
+            disabled=service_info is None,
+            help="複数の画面から同時に求解しても CPU を奪い合わないよう、solve_service.py のプロセスプールで実行します。"
+        )
+        if service_info is not None:
+            st.caption(f"求解サービス: {eng.SERVICE_URL} / 同時実行 {service_info['slots']} 件（各 {service_info['num_workers']} スレッド）/ "
+                       f"実行中 {service_info['running']} 件・待機中 {service_info['queued']} 件")
+        else:
+            st.caption("求解サービスは起動していません（`python solve_service.py` で起動できます）。この画面のサーバー内で直接求解します。")
+        cache_info = eng.cache_stats()
+        cc1, cc2 = st.columns([3, 1])
+        cc1.caption(f"キャッシュ: {cache_info['entries']} 件 / {cache_info['bytes'] / 1024:.0f} KB（上限 {eng.CACHE_MAX_ENTRIES} 件・{eng.CACHE_MAX_BYTES // (1024 * 1024)} MB、古いものから自動削除）")
+        if cc2.button("🗑️ キャッシュを消去", disabled=cache_info["entries"] == 0):
+            eng.cache_clear()
+            st.rerun()
+    model_options = {
+        "mentor_coverage": "shared" if use_shared_mentor else "inline",
+        "objective": "lexicographic" if use_lexicographic else "weighted",
+        "symmetry": "lex" if use_symmetry else "none",
+    }
+    hint_source = hint_sources[hint_choice]
+    if hint_source is None:
+        hint_df = None
+    elif hint_source == "current":
+        hint_df = st.session_state["raw_schedule"]
+    else:
+        hint_df = roster_history.get(hint_source)
+
+    solve_job = st.session_state.get("solve_job")
+    job_running = solve_job is not None and not solve_job["done"].is_set()
+
+    if st.button("🚀 AIによる勤務作成 (最高解モード)", disabled=job_running):
+        cache_key = None
+        if use_solve_cache and hint_df is None:
+            cache_key = eng.solve_cache_key(problem, strategy_mode, weights, eng.DEFAULT_TIME_LIMIT, eng.DEFAULT_NUM_WORKERS, model_options, inputs=problem_inputs)
+            cached = eng.cache_get(cache_key)
+            if cached is not None:
+                st.session_state["solve_cached_result"] = cached
+                st.session_state["solve_job_strategy"] = strategy_mode
+                st.rerun()
 
-        for s in range(total):
-            for di in range(4):
-                val = opt_prev.iloc[s, di]
-                if di == 3 and val == "遅":
-                    for ei in E_IDS: model.Add(x[s, 0, ei] == 0)
+        time_limit = float(hint_time_limit) if hint_df is not None else eng.DEFAULT_TIME_LIMIT
+        if use_service:
+            # 構築・ヒント補完・求解・キャッシュ保存はすべてサービス側で行う
+            try:
+                st.session_state["solve_job"] = eng.start_service_job(
+                    st.session_state.config, year, month, strategy_mode, weights, time_limit,
+                    model_options=model_options, hint_schedule=hint_df,
+                )
+            except (OSError, RuntimeError) as e:
+                st.error(f"求解サービスへの投入に失敗しました: {e}")
+                st.stop()
+            st.session_state["solve_job_strategy"] = strategy_mode
+            st.session_state["solve_job_cache_key"] = None
+            st.rerun()
 
-        for d in range(n_days):
-            wd = calendar.weekday(year, month, d+1)
-            
-            use_F_var = None
-            if wd == 5 and has_C_and_D:
-                use_F_var = model.NewBoolVar(f'use_F_{d}')
-                score_objs.append(use_F_var * -1000)
-
-            for i, s_name in enumerate(s_list_extended):
-                sid = i + 1
-                is_requested_by_someone = any(opt_req.iloc[s, d] == s_name for s in range(total))
-                
-                if s_name == "F":
-                    is_excl = not (wd == 5 and has_C_and_D)
-                else:
-                    is_excl = (opt_ex.iloc[d, i] and not is_requested_by_someone) or (wd == 6 and s_name == "C" and not is_requested_by_someone)
-                
-                if s_name == "F":
-                    skilled = [s for s in range(total) if get_skill_for_F(s) == "○"]
-                    trainee = [s for s in range(total) if get_skill_for_F(s) == "△"]
-                else:
-                    skilled = [s for s in range(total) if opt_skill.iloc[s, i] == "○"]
-                    trainee = [s for s in range(total) if opt_skill.iloc[s, i] == "△"]
-                
-                s_sum = sum(x[s, d, sid] for s in skilled)
-                t_sum = sum(x[s, d, sid] for s in trainee)
-                
-                if s_name in ["C", "D", "F"] and wd == 5 and has_C_and_D:
-                    under_sat_var = model.NewIntVar(0, 1, f'under_sat_{d}_{sid}')
-                    if s_name == "F":
-                        model.Add(s_sum + t_sum + under_sat_var == 1).OnlyEnforceIf(use_F_var)
-                        model.Add(s_sum + t_sum == 0).OnlyEnforceIf(use_F_var.Not())
-                    else:
-                        model.Add(s_sum + t_sum == 0).OnlyEnforceIf(use_F_var)
-                        if is_excl:
-                            model.Add(s_sum + t_sum == 0).OnlyEnforceIf(use_F_var.Not())
-                        else:
-                            model.Add(s_sum + t_sum + under_sat_var == 1).OnlyEnforceIf(use_F_var.Not())
-                    score_objs.append(under_sat_var * -100000000)
-                else:
-                    if is_excl:
-                        model.Add(s_sum + t_sum == 0)
-                    else:
-                        under_std_var = model.NewIntVar(0, 1, f'under_std_{d}_{sid}')
-                        model.Add(s_sum + t_sum + under_std_var == 1)
-                        score_objs.append(under_std_var * -100000000)
-                    
-                    for s_t in trainee:
-                        all_skilled_staff = [s for s in range(total) if opt_skill.iloc[s, i] == "○"]
-                        eligible_mentors_on_duty = sum(x[s, d, other_sid] for s in all_skilled_staff for other_sid in range(1, num_types_extended+1))
-                        no_vet_var = model.NewBoolVar(f'no_vet_{s_t}_{d}_{sid}')
-                        model.Add(eligible_mentors_on_duty + no_vet_var >= 1).OnlyEnforceIf(x[s_t, d, sid])
-                        score_objs.append(no_vet_var * -50000000)
-
-            if wd == 5 and has_C_and_D:
-                for s_name in ["C", "D", "F"]:
-                    sid = s_list_extended.index(s_name) + 1
-                    if s_name == "F":
-                        trainee = [s for s in range(total) if get_skill_for_F(s) == "△"]
-                    else:
-                        trainee = [s for s in range(total) if opt_skill.iloc[s, s_list_extended.index(s_name)] == "△"]
-                    
-                    for s_t in trainee:
-                        all_skilled_staff = []
-                        for s in range(total):
-                            if s_name == "F":
-                                is_ok = (get_skill_for_F(s) == "○")
-                            else:
-                                is_ok = (opt_skill.iloc[s, s_list_extended.index(s_name)] == "○")
-                            if is_ok:
-                                all_skilled_staff.append(s)
-                                
-                        eligible_mentors_on_duty = sum(x[s, d, other_sid] for s in all_skilled_staff for other_sid in range(1, num_types_extended+1))
-                        no_vet_var = model.NewBoolVar(f'no_vet_sat_{s_t}_{d}_{sid}')
-                        model.Add(eligible_mentors_on_duty + no_vet_var >= 1).OnlyEnforceIf(x[s_t, d, sid])
-                        score_objs.append(no_vet_var * -50000000)
-
-            for s in range(total): model.Add(sum(x[s, d, i] for i in range(num_types_extended+4)) == 1)
-
-        progress_bar.progress(60, text="個人別制約および働き溜めモデルを計算中...")
-        overtime_shortages = []
-        off_discrepancies = []
-
-        for s in range(total):
-            is_early = [model.NewBoolVar(f'ie_{s}_{d}') for d in range(n_days)]
-            is_late = [model.NewBoolVar(f'il_{s}_{d}') for d in range(n_days)]
-            is_off = [model.NewBoolVar(f'io_{s}_{d}') for d in range(n_days)]
-            daily_overtime_exprs = []
-            
-            # --- 【新規追加】Fシフト前後の遷移に関するハード制約定義 ---
-            if "F" in s_list_extended:
-                f_sid = s_list_extended.index("F") + 1
-                
-                # 1. 前月最終日（前月末日）が「遅」の場合、当月1日目の F を完全排除（禁止）
-                last_prev_val = opt_prev.iloc[s, 3] # 前月末日
-                if last_prev_val == "遅":
-                    model.Add(x[s, 0, f_sid] == 0)
-                
-                # 2. 月内の F の前後遷移制限（ハード制約）
-                for d in range(n_days):
-                    # F の翌日(d+1) に 早番グループ を完全禁止
-                    if d < n_days - 1:
-                        model.Add(x[s, d, f_sid] + sum(x[s, d+1, ei] for ei in E_IDS) <= 1)
-                    # F の前日(d-1) に 遅番グループ を完全禁止
-                    if d > 0:
-                        model.Add(sum(x[s, d-1, li] for li in L_IDS) + x[s, d, f_sid] <= 1)
-
-            for d in range(n_days):
-                model.Add(is_off[d] == x[s, d, S_OFF] + x[s, d, S_CHO] + x[s, d, S_NEN])
-                model.Add(sum(x[s, d, i] for i in E_IDS) == 1).OnlyEnforceIf(is_early[d])
-                model.Add(sum(x[s, d, i] for i in E_IDS) == 0).OnlyEnforceIf(is_early[d].Not())
-                model.Add(sum(x[s, d, i] for i in L_IDS) == 1).OnlyEnforceIf(is_late[d])
-                model.Add(sum(x[s, d, i] for i in L_IDS) == 0).OnlyEnforceIf(is_late[d].Not())
-
-                for i, s_name in enumerate(s_list_extended):
-                    if s_name == "F":
-                        skill_val = get_skill_for_F(s)
-                    else:
-                        skill_val = opt_skill.iloc[s, i]
-                    if skill_val == "×": model.Add(x[s, d, i+1] == 0)
+        progress_bar = st.progress(10, text="エンジンの初期化中...")
 
-                # 申し込み（希望）の反映モデル
-                req = opt_req.iloc[s, d]
-                c_map = {"日": S_NIK, "": -1}
-                for i, n in enumerate(s_list_extended): c_map[n] = i+1
-                
-                if req == "休":
-                    model.Add(x[s, d, S_OFF] + x[s, d, S_CHO] + x[s, d, S_NEN] == 1)
-                elif req in c_map and req != "": 
-                    model.Add(x[s, d, c_map[req]] == 1)
-                
-                if req != "休":
-                    model.Add(x[s, d, S_NEN] == 0)
-
-                if d < n_days - 1:
-                    not_le = model.NewBoolVar(f'nle_{s}_{d}')
-                    model.Add(is_late[d] + is_early[d+1] <= 1).OnlyEnforceIf(not_le)
-                    score_objs.append(not_le * 2000000 * current_w_h_rule)
-
-                wd_v = calendar.weekday(year, month, d+1)
-                d_date = datetime.date(year, month, d+1)
-                is_holiday = d_date in jp_holidays
-                is_designated = bool(opt_des.at[d+1, "指定日"]) if d+1 in opt_des.index else False
-                
-                terms = []
-                if wd_v == 6:
-                    pass
-                elif wd_v == 5:
-                    for i, s_name in enumerate(s_list_extended):
-                        sid = i + 1
-                        if s_name in ["A", "B"]:
-                            continue
-                        over_val = 0
-                        if s_name in opt_overtime.index:
-                            over_val = int(opt_overtime.loc[s_name, "土曜超過分(分)"])
-                        if over_val > 0:
-                            terms.append(x[s, d, sid] * over_val)
-                else:
-                    for i, s_name in enumerate(s_list_extended):
-                        sid = i + 1
-                        if (is_holiday or is_designated) and s_name in ["A", "B"]:
-                            continue
-                        over_val = 0
-                        if s_name in opt_overtime.index:
-                            over_val = int(opt_overtime.loc[s_name, "平日超過分(分)"])
-                        if over_val > 0:
-                            terms.append(x[s, d, sid] * over_val)
-                
-                daily_overtime_exprs.append(sum(terms))
+        progress_bar.progress(30, text="制約条件のマッピング中...")
+        built = eng.build_model(problem, strategy_mode, weights, inputs=problem_inputs, model_options=model_options)
 
-            for d in range(n_days):
-                cum_overtime = sum(daily_overtime_exprs[k] for k in range(d + 1))
-                cum_cho_count = sum(x[s, k, S_CHO] for k in range(d + 1))
-                
-                shortage = model.NewIntVar(0, 10000, f'shortage_{s}_{d}')
-                model.Add(cum_overtime + shortage >= cum_cho_count * 445)
-                score_objs.append(shortage * -1000)
-                overtime_shortages.append(shortage)
-
-            for d in range(n_days):
-                wd_v = calendar.weekday(year, month, d+1)
-                if wd_v >= 5:
-                    model.Add(x[s, d, S_CHO] == 0)
-
-            hist_w = [1 if opt_prev.iloc[s, k] != "休" else 0 for k in range(4)] + [(1 - is_off[di]) for di in range(n_days)]
-            for st_i in range(len(hist_w) - 4):
-                nc = model.NewBoolVar(f'nc_{s}_{st_i}')
-                model.Add(sum(hist_w[st_i:st_i+5]) <= 4).OnlyEnforceIf(nc)
-                score_objs.append(nc * 1000000 * current_w_h_rule)
-
-            for di in range(n_days - 1):
-                mix = model.NewBoolVar(f'mix_{s}_{di}')
-                model.AddBoolAnd([is_early[di], is_late[di+1]]).OnlyEnforceIf(mix)
-                score_objs.append(mix * 500 * current_w_rhythm)
-                if di < n_days - 2:
-                    e_block = model.NewBoolVar(f'eb_{s}_{di}')
-                    model.Add(is_early[di] + is_early[di+1] + is_early[di+2] - 2 <= e_block)
-                    score_objs.append(e_block * -1000 * current_w_rhythm)
-
-            if s < n_mgr:
-                for di in range(n_days):
-                    wd_v = calendar.weekday(year, month, di+1)
-                    if wd_v >= 5: 
-                        m_o = model.NewBoolVar(f'mo_{s}_{di}')
-                        model.Add(is_off[di] == 1).OnlyEnforceIf(m_o)
-                        score_objs.append(m_o * 10000)
-                    else: 
-                        m_w = model.NewBoolVar(f'mw_{s}_{di}')
-                        model.Add(is_off[di] == 0).OnlyEnforceIf(m_w)
-                        score_objs.append(m_w * 500000)
-            else:
-                for di in range(n_days):
-                    if opt_req.iloc[s, di] != "日": 
-                        nik_var = x[s, di, S_NIK]
-                        score_objs.append(nik_var * -10000000)
-
-            # 新休日割当ルール
-            req_off_count = sum(1 for di in range(n_days) if opt_req.iloc[s, di] == "休")
-            total_off_limit = int(opt_hols.iloc[s, 0])
-            kokyu_val = int(opt_hols.iloc[s, 1])
-            
-            max_cho_capacity = total_off_limit - kokyu_val
-            expected_cho = max(0, max_cho_capacity)
-            expected_nen = max(0, req_off_count - expected_cho)
-
-            model.Add(sum(x[s, d, S_NEN] for d in range(n_days)) == expected_nen)
-
-            off_slack_plus = model.NewIntVar(0, n_days, f'off_sp_{s}')
-            off_slack_minus = model.NewIntVar(0, n_days, f'off_sm_{s}')
-            model.Add(sum(x[s, d, S_OFF] for d in range(n_days)) + off_slack_plus - off_slack_minus == kokyu_val)
-            score_objs.append(off_slack_plus * -10000000)
-            score_objs.append(off_slack_minus * -10000000)
-            off_discrepancies.append((s, "公休数", off_slack_plus, off_slack_minus))
-
-            cho_slack_plus = model.NewIntVar(0, n_days, f'cho_sp_{s}')
-            cho_slack_minus = model.NewIntVar(0, n_days, f'cho_sm_{s}')
-            model.Add(sum(x[s, d, S_CHO] for d in range(n_days)) + cho_slack_plus - cho_slack_minus == expected_cho)
-            score_objs.append(cho_slack_plus * -10000000)
-            score_objs.append(cho_slack_minus * -10000000)
-            off_discrepancies.append((s, "調整休数", cho_slack_plus, cho_slack_minus))
-
-        for i_sh in range(1, num_types_extended + 1):
-            counts = [model.NewIntVar(0, n_days, f'sh_c{si}_{i_sh}') for si in range(total)]
-            for si in range(total): model.Add(counts[si] == sum(x[si, d, i_sh] for d in range(n_days)))
-            mx, mn = model.NewIntVar(0, n_days, f'mx_{i_sh}'), model.NewIntVar(0, n_days, f'mn_{i_sh}')
-            model.AddMaxEquality(mx, counts); model.AddMinEquality(mn, counts)
-            score_objs.append((mx - mn) * -100 * current_w_fair)
-
-        model.Maximize(sum(score_objs))
-        
-        progress_bar.progress(80, text="AI並列最適化ソルバー実行中（マルチスレッド処理）...")
-        slv = cp_model.CpSolver()
-        slv.parameters.max_time_in_seconds = 45.0
-        slv.parameters.num_search_workers = 4
-        
-        status = slv.Solve(model)
-        progress_bar.progress(100, text="最適化完了！結果の同期処理中...")
+        if hint_df is not None:
+            progress_bar.progress(35, text="前回の勤務表から初期解ヒントを補完中...")
+            eng.add_schedule_hint(built, hint_df)
 
-        if status in [cp_model.OPTIMAL, cp_model.FEASIBLE]:
-            st.success(f"✨ AI勤務作成が正常に完了しました。（適用戦略: {strategy_mode}）")
-            
-            relaxation_messages = []
-            for s_idx, off_type, sp, sm in off_discrepancies:
-                val_p = slv.Value(sp)
-                val_m = slv.Value(sm)
-                if val_p > 0:
-                    relaxation_messages.append(f"⚠️ {staff_list[s_idx]}の{off_type}が、制約矛盾解消のため目標より **{val_p}日減少** して調整されました。")
-                if val_m > 0:
-                    relaxation_messages.append(f"⚠️ {staff_list[s_idx]}の{off_type}が、制約矛盾解消のため目標より **{val_m}日増加** して調整されました。")
-            
-            overtime_shortage_sum = sum(slv.Value(sh) for sh in overtime_shortages)
-            if overtime_shortage_sum > 0:
-                relaxation_messages.append(f"⚠️ 働き溜め（超過勤務の累積時間）が不足しているスタッフの調整休（調）付与タイミングにおいて、計 **{overtime_shortage_sum}分相当のルール緩和** を実施しました。")
+        progress_bar.progress(40, text="AI並列最適化ソルバーをバックグラウンドで起動中...")
+        if use_lexicographic:
+            st.session_state["solve_job"] = eng.start_lexicographic_job(built, time_limit, eng.DEFAULT_NUM_WORKERS)
+        else:
+            st.session_state["solve_job"] = eng.start_solve_job(built, time_limit, eng.DEFAULT_NUM_WORKERS)
+        st.session_state["solve_job_strategy"] = strategy_mode
+        st.session_state["solve_job_cache_key"] = cache_key
+        st.rerun()
+
+    # --- バックグラウンド求解の進捗（1秒ごとにこの部分だけ再描画） ---
+    @st.fragment(run_every=1.0)
+    def render_solve_progress():
+        job = st.session_state.get("solve_job")
+        if job is None:
+            return
+        snap = eng.solve_job_snapshot(job)
+        if not snap["running"]:
+            # 求解終了 → アプリ全体を再実行して結果を確定させる
+            st.rerun()
 
+        if snap["queue_position"] is not None:
+            st.info(f"🖥️ 求解サービスの順番待ちです（{snap['queue_position']} 番目）。前のジョブが終わりしだい開始します。")
+            if st.button("⏹️ 投入を取り消す", disabled=snap["cancelled"]):
+                eng.cancel_solve_job(job)
+            return
+
+        ratio = min(1.0, snap["elapsed"] / snap["time_limit"]) if snap["time_limit"] > 0 else 1.0
+        st.progress(ratio, text=f"AI並列最適化ソルバー実行中（{snap['elapsed']:.0f} / {snap['time_limit']:.0f} 秒）...")
+        incumbents = snap["incumbents"]
+        if snap["tier"]:
+            st.caption(f"🪜 段階的最適化: 「{snap['tier']}」の段を求解中（スコア・上界・更新回数はこの段の評価項のみ）")
+            # 段ごとに目的が異なるため、前の段の解はスコアの比較対象にしない
+            incumbents = [x for x in incumbents if x.get("tier") == snap["tier"]]
+
+        m1, m2, m3, m4 = st.columns(4)
+        if incumbents:
+            best = incumbents[-1]
+            gap = abs(best["bound"] - best["objective"]) / max(1.0, abs(best["bound"]))
+            m1.metric("現在の最良スコア", f"{best['objective']:,.0f}")
+            m2.metric("理論上界", f"{best['bound']:,.0f}")
+            m3.metric("ギャップ", f"{gap:.2%}")
+            m4.metric("解の更新回数", f"{len(incumbents)} 回", delta=f"{best['wall_time']:.1f} 秒時点", delta_color="off")
+        else:
+            m1.metric("現在の最良スコア", "探索中...")
+            m4.metric("解の更新回数", "0 回")
+
+        if st.button("⏹️ 探索を中断して現時点の最良解を採用する", disabled=snap["cancelled"]):
+            eng.cancel_solve_job(job)
+
+        if snap["best_rows"] is not None:
+            st.caption("🔎 現時点の最良勤務表（プレビュー）")
+            st.dataframe(pd.DataFrame(snap["best_rows"], index=staff_list, columns=days_cols), use_container_width=True)
+
+    if job_running:
+        render_solve_progress()
+    elif solve_job is not None or "solve_cached_result" in st.session_state:
+        # 終了したジョブ（またはキャッシュから復元した結果）を確定（1回限り）
+        strategy_used = st.session_state.pop("solve_job_strategy", strategy_mode)
+        if solve_job is None:
+            result = st.session_state.pop("solve_cached_result")
+            job_cancelled, repair_info = False, None
+            st.info(f"♻️ 同一条件の求解結果をキャッシュから復元しました（CP-SAT は再実行していません。元の求解時間: {result['wall_time']:.1f} 秒）。")
+        else:
+            del st.session_state["solve_job"]
+            cache_key = st.session_state.pop("solve_job_cache_key", None)
+            job_cancelled = solve_job["cancelled"]
+            repair_info = solve_job["built"].get("repair") if "built" in solve_job else None
+            try:
+                result = eng.finish_solve_job(solve_job)
+            except RuntimeError as e:
+                result = {"ok": False, "status": "ERROR"}
+                st.error(f"ソルバー実行中にエラーが発生しました: {e}")
+            # 中断された解は制限時間いっぱい探索した結果ではないため保存しない
+            if cache_key is not None and not job_cancelled:
+                eng.cache_put(cache_key, result)
+            if result.get("instrumentation"):
+                st.session_state["last_instrumentation"] = dict(result["instrumentation"], label=strategy_used)
+
+        if result["ok"]:
+            if job_cancelled:
+                st.info(f"⏹️ 探索を中断しました。中断時点（{result['wall_time']:.1f} 秒）までの最良解を採用します。")
+            st.success(f"✨ AI勤務作成が正常に完了しました。（適用戦略: {strategy_used}）")
+
+            if repair_info:
+                n_moved = int((result["schedule"].to_numpy() != st.session_state["raw_schedule"].to_numpy()).sum()) if "raw_schedule" in st.session_state else 0
+                st.info(f"🩹 **近傍修復**: {repair_info['free_cells']} セルのみを再最適化し、{repair_info['fixed_cells']} セルは現在の勤務のまま固定しました（変更 {n_moved} セル）。")
+
+            hint_rep = result.get("hint_report")
+            if hint_rep:
+                st.info(f"🧭 **ウォームスタート追従率**: ヒントを与えた {hint_rep['hinted_cells']} セル中 **{hint_rep['kept_cells']} セル（{hint_rep['kept_ratio']:.1%}）** が前回と同じ勤務のまま維持されました。")
+                if hint_rep["released_staff"]:
+                    st.write(f"設定変更によりヒントが成立しなかったため再配置したスタッフ: {', '.join(hint_rep['released_staff'])}")
+                if hint_rep["changed"]:
+                    with st.expander(f"変更されたセル一覧（{len(hint_rep['changed'])}件）"):
+                        st.dataframe(pd.DataFrame(hint_rep["changed"]).rename(columns={"staff": "スタッフ名", "day": "日", "before": "ヒント", "after": "結果"}), use_container_width=True)
+
+            relaxation_messages = result["relaxation_messages"]
             if relaxation_messages:
                 st.warning("⚠️ **AIシステム調整報告（制約緩和レポート）**\n入力された希望休や公休目標に一部競合があったため、AIがルールを極小幅で緩和して作成を成立させました。以下をご確認ください。")
                 for msg in relaxation_messages:
@@ -771,27 +699,360 @@ with tab_solve:
                 st.balloons()
                 st.success("✅ **すべての制約条件が100%厳格に守られました。**")
 
-            res_rows = []
-            id_char = {S_OFF: "休", S_NIK: "日", S_CHO: "調", S_NEN: "年"}
-            for i, n in enumerate(s_list_extended): id_char[i+1] = n
-            for si in range(total):
-                res_rows.append([id_char[next(j for j in range(num_types_extended+4) if slv.Value(x[si, di, j])==1)] for di in range(n_days)])
-
-            res_df = pd.DataFrame(res_rows, index=staff_list, columns=days_cols)
+            res_df = result["schedule"]
             st.session_state["raw_schedule"] = res_df
 
             # 【自動作成結果を履歴管理へ保存】
-            new_hist_entry = {
-                "timestamp": datetime.datetime.now().strftime("%H:%M:%S"),
-                "label": f"AI自動作成 ({strategy_mode})",
-                "df": res_df.copy()
+            add_history(res_df, f"AI自動作成 ({strategy_used})")
+        elif result["status"] != "ERROR":
+            if job_cancelled:
+                st.error("解が見つかる前に探索が中断されました。もう一度実行してください。")
+            elif repair_info:
+                st.error("修復範囲内では制約を満たす勤務表が見つかりませんでした。前後の日数や対象スタッフ範囲を広げて再実行してください。")
+            elif precheck["errors"]:
+                st.error("解が見つかりませんでした。上の「求解前チェック」に表示されている矛盾箇所を修正してから再実行してください。")
+            else:
+                st.error("解が見つかりませんでした。下の「🔍 矛盾の原因を特定する」で、同時に満たせない制約の組を確認してください。")
+
+    # --- 実行不能の説明モード（同時に満たせないハード制約の最小の組を表示） ---
+    # 求解前チェックでは見つからない複数制約の絡んだ矛盾を、仮定リテラル付きの求解で特定する
+    @st.fragment
+    def explain_panel():
+        with st.expander("🔍 矛盾の原因を特定する（説明モード）", expanded="explain_result" in st.session_state):
+            st.caption("申し込み・スキル・前月末引継ぎ・担務の休止日などのハード制約から、同時には満たせない最小の組を探します。")
+            explain_key = eng.solve_cache_key(problem, model_options=model_options, inputs=problem_inputs)
+            if st.button("🔍 矛盾の原因を特定する"):
+                with st.spinner("矛盾する制約の組を絞り込んでいます..."):
+                    st.session_state["explain_result"] = (explain_key, eng.explain_infeasibility(problem, problem_inputs, model_options=model_options))
+            stored = st.session_state.get("explain_result")
+            if stored is None:
+                return
+            if stored[0] != explain_key:
+                st.info("前回の判定以降に入力が変更されています。もう一度実行してください。")
+                return
+            res = stored[1]
+            if res["status"] in ("OPTIMAL", "FEASIBLE"):
+                st.success(f"✅ ハード制約はすべて同時に満たせます（判定 {res['wall_time']:.1f} 秒）。欠員・休日数などは緩和で調整されます。")
+            elif not res["conflicts"]:
+                st.warning(f"制限時間内に判定できませんでした（{res['status']}・{res['wall_time']:.1f} 秒）。")
+            else:
+                scope = "最小の組（どれか1つを外せば解けます）" if res["minimal"] else "矛盾する組（時間内に最小化しきれていません）"
+                st.error(f"🚨 次の {len(res['conflicts'])} 件の制約は同時に満たせません — {scope}")
+                st.dataframe(pd.DataFrame([
+                    {"日": x["day"] or "-", "スタッフ名": x["staff"] or "-", "内容": x["message"]} for x in res["conflicts"]
+                ]), use_container_width=True, hide_index=True)
+                st.caption(f"判定 {res['checks']} 回・{res['wall_time']:.1f} 秒")
+
+    explain_panel()
+
+    # --- 計測パネル（直近の求解のモデル構築・求解の内訳） ---
+    if st.session_state.get("last_instrumentation"):
+        inst = st.session_state["last_instrumentation"]
+        with st.expander("📊 計測パネル（直近の求解のモデル構築・求解の内訳）"):
+            phase_labels = {
+                "input_sync": "入力同期", "variables": "変数生成", "coverage": "担務充足制約", "per_staff": "スタッフ別制約",
+                "symmetry": "対称性除去", "fairness": "公平性", "objective": "目的関数", "solve": "求解", "extraction": "結果抽出",
             }
-            if not st.session_state["roster_history"] or not st.session_state["roster_history"][-1]["df"].equals(res_df):
-                st.session_state["roster_history"].append(new_hist_entry)
-                if len(st.session_state["roster_history"]) > 5:
-                    st.session_state["roster_history"].pop(0)
-        else: 
-            st.error("解が見つかりませんでした。入力制約が競合していないか確認してください。")
+            family_labels = {
+                "assignment": "割当（1日1勤務）", "coverage": "担務充足", "mentor": "教育同行", "transitions": "勤務遷移",
+                "channeling": "早・遅・休判定", "requests": "申し込み・スキル", "consecutive": "連勤", "overtime_banking": "働き溜め",
+                "staff_rules": "管理職・日勤", "holidays": "休日数", "symmetry": "対称性除去", "fairness": "公平性", "other": "その他（ヒント・修復）",
+            }
+            solver = inst["solver"]
+            i1, i2, i3, i4, i5 = st.columns(5)
+            i1.metric("求解時間", f"{solver['wall_time']:.2f} 秒")
+            i2.metric("競合数", f"{solver['conflicts']:,}")
+            i3.metric("分岐数", f"{solver['branches']:,}")
+            i4.metric("理論上界", "-" if solver["best_bound"] is None else f"{solver['best_bound']:,.0f}")
+            i5.metric("ギャップ", "-" if solver["gap"] is None else f"{solver['gap']:.2%}")
+            st.caption(f"{inst['label']} / 状態: {solver['status']} / スタッフ {inst['staff']} 名 × {inst['days']} 日 / "
+                       f"変数 {inst['model_size']['variables']:,}・制約 {inst['model_size']['constraints']:,}・線形項 {inst['model_size']['linear_terms']:,} / "
+                       f"スレッド {solver['num_workers']}・最終解の発見元: {solver['solution_info'] or '-'}")
+            pc, fc = st.columns(2)
+            pc.write("**工程別の所要時間**")
+            pc.dataframe(pd.DataFrame(
+                [{"工程": phase_labels.get(k, k), "時間(ミリ秒)": round(v * 1000, 1)} for k, v in inst["phases"].items()]
+            ), use_container_width=True, hide_index=True)
+            fc.write("**制約ファミリー別のモデル規模**")
+            fc.dataframe(pd.DataFrame(
+                [{"ファミリー": family_labels.get(k, k), "制約数": v["constraints"], "変数数": v["variables"]} for k, v in inst["families"].items()]
+            ), use_container_width=True, hide_index=True)
+            if inst.get("tiers"):
+                st.write("**段階的最適化の各段**")
+                st.dataframe(pd.DataFrame([
+                    {"段": t["label"], "状態": t["status"], "評価値": t["value"], "上界": t["bound"],
+                     "求解時間(秒)": round(t["wall_time"], 2), "配分(秒)": round(t["time_limit"], 2)}
+                    for t in inst["tiers"]
+                ]), use_container_width=True, hide_index=True)
+            st.download_button(
+                "📥 計測結果を JSON で保存",
+                json.dumps(inst, ensure_ascii=False, indent=2),
+                file_name=f"solve_metrics_{year}_{month}.json",
+                on_click="ignore",
+            )
+
+    # --- 戦略ポートフォリオ：複数の戦略・ウェイトを別プロセスで同時に求解して比較 ---
+    # 候補の編集・結果の切替はこのパネルだけを再実行する（以下の複数月・複数ユニットも同様）
+    @st.fragment
+    def portfolio_panel():
+        with st.expander("🧪 全戦略を並列実行して比較する（戦略ポートフォリオ）"):
+            st.caption("各戦略を同じ制限時間で求解し（CPU コア数に収まる数ずつ同時に実行）、違反件数・公平性・超過勤務を横並びで比較してから採用する勤務表を選べます。")
+            pf_presets = st.multiselect("比較するプリセット戦略", eng.STRATEGY_MODES, default=eng.STRATEGY_MODES)
+            st.write("独自ウェイトの候補（⚖️ バランス調整モードとしてそのまま適用）")
+            pf_custom_df = st.data_editor(
+                pd.DataFrame({
+                    "名称": pd.Series(dtype=str),
+                    "ルール厳守": pd.Series(dtype="Int64"),
+                    "混成回避": pd.Series(dtype="Int64"),
+                    "公平性": pd.Series(dtype="Int64"),
+                }),
+                num_rows="dynamic", use_container_width=True, key="portfolio_custom_weights"
+            )
+            pf_time_limit = st.number_input("1候補あたりの制限時間（秒）", 5, 300, int(eng.DEFAULT_TIME_LIMIT))
+
+            pf_candidates = eng.preset_candidates(weights)
+            pf_candidates = [c for c in pf_candidates if c["strategy_mode"] in pf_presets]
+            for i, row in pf_custom_df.iterrows():
+                if pd.isna(row["ルール厳守"]) or pd.isna(row["混成回避"]) or pd.isna(row["公平性"]):
+                    continue
+                name = row["名称"] if isinstance(row["名称"], str) and row["名称"].strip() else f"カスタム{i+1}"
+                pf_candidates.append({
+                    "label": f"🛠️ {name}",
+                    "strategy_mode": eng.STRATEGY_MODES[0],
+                    "weights": {**weights, "w_h_rule": int(row["ルール厳守"]), "w_mixing": int(row["混成回避"]), "w_fair": int(row["公平性"])},
+                })
+
+            portfolio_job = st.session_state.get("portfolio_job")
+            if st.button(f"🧪 {len(pf_candidates)} 候補を並列実行", disabled=job_running or portfolio_job is not None or not pf_candidates):
+                st.session_state["portfolio_job"] = eng.start_portfolio_job(problem, pf_candidates, float(pf_time_limit), model_options=model_options)
+                st.session_state.pop("portfolio_results", None)
+                st.rerun()
+
+            @st.fragment(run_every=1.0)
+            def render_portfolio_progress():
+                job = st.session_state.get("portfolio_job")
+                if job is None:
+                    return
+                if eng.portfolio_done(job):
+                    st.rerun()
+                snap = eng.portfolio_snapshot(job)
+                st.progress(min(1.0, snap["elapsed"] / snap["expected_time"]), text=f"{snap['total']} 候補を求解中（完了 {snap['done']} 件 / {snap['elapsed']:.0f} 秒・見込み {snap['expected_time']:.0f} 秒）...")
+
+            if portfolio_job is not None:
+                if eng.portfolio_done(portfolio_job):
+                    st.session_state["portfolio_results"] = eng.portfolio_results(portfolio_job)
+                    del st.session_state["portfolio_job"]
+                else:
+                    render_portfolio_progress()
+
+            pf_results = st.session_state.get("portfolio_results")
+            if pf_results:
+                compare_rows = []
+                for r in pf_results:
+                    m = r.get("metrics") or {}
+                    compare_rows.append({
+                        "候補": r["label"],
+                        "状態": r["status"],
+                        "スコア": r.get("objective"),
+                        "未充足担務": m.get("uncovered_shifts"),
+                        "見習い単独": m.get("no_mentor"),
+                        "遅→早": m.get("late_to_early"),
+                        "5連勤": m.get("consecutive_windows"),
+                        "休日数不一致": m.get("holiday_mismatch_staff"),
+                        "回数差(最大)": m.get("fairness_spread_max"),
+                        "回数差(合計)": m.get("fairness_spread_sum"),
+                        "超勤(最大/分)": m.get("overtime_max_min"),
+                        "45h超": m.get("over_45h_staff"),
+                    })
+                st.dataframe(pd.DataFrame(compare_rows), use_container_width=True, hide_index=True)
+
+                ok_results = [r for r in pf_results if r["ok"]]
+                if ok_results:
+                    pf_pick = st.selectbox("採用する候補", [r["label"] for r in ok_results])
+                    picked = next(r for r in ok_results if r["label"] == pf_pick)
+                    st.dataframe(picked["schedule"], use_container_width=True)
+                    if st.button("✅ この候補を勤務表として採用する"):
+                        st.session_state["raw_schedule"] = picked["schedule"].copy()
+                        add_history(picked["schedule"], f"ポートフォリオ採用 ({picked['label']})")
+                        st.rerun()
+                else:
+                    st.error("どの候補でも制限時間内に解が見つかりませんでした。制限時間を延ばすか候補数を減らしてください。")
+    portfolio_panel()
+
+    # --- 複数月の連続作成（四半期計画など） ---
+    @st.fragment
+    def horizon_panel():
+        with st.expander("📆 複数月を連続で作成する（前月末引継ぎ・累積公平性・働き溜め残高を自動繰越）"):
+            st.caption("当月から順に各月を求解し、各月の末尾4日を翌月の「前月末引継ぎ」へ、担当回数と働き溜め残高を翌月の公平性・調整休判定へ自動で引き継ぎます。")
+            hz_months = st.number_input("作成する月数", 2, 12, 3)
+            hz_files = st.file_uploader(
+                "翌月以降の設定ファイル（任意・複数可）", type=["json", "v80z"], accept_multiple_files=True,
+                help="各ファイル内の年・月で対応付けます。ファイルの無い月は現在のスタッフ・スキル・休日数設定で、申し込み・不要担務・指定日を空にして作成します。"
+            )
+            hz_lookahead = st.checkbox("翌月冒頭4日の申し込みを先読みして、月末をまたぐ連勤・遅→早を避ける", value=True)
+            hz_time_limit = st.number_input("1か月あたりの制限時間（秒）", 5, 300, int(eng.DEFAULT_TIME_LIMIT))
+
+            hz_month_configs = {}
+            for f in hz_files or []:
+                try:
+                    cfg = eng.load_config_bytes(f.getvalue())
+                    hz_month_configs[(int(cfg["year"]), int(cfg["month"]))] = cfg
+                except Exception:
+                    st.error(f"エラー：{f.name} の構造が不正です。")
+            hz_plan = eng.month_sequence(year, month, int(hz_months))
+            st.write("作成対象: " + " → ".join(f"{y}年{m}月" + ("📄" if (y, m) in hz_month_configs else "") for y, m in hz_plan))
+
+            horizon_job = st.session_state.get("horizon_job")
+            if st.button(f"📆 {int(hz_months)} か月分を連続作成", disabled=job_running or horizon_job is not None):
+                st.session_state["horizon_job"] = eng.start_horizon_job(
+                    st.session_state.config, int(hz_months), year=year, month=month, month_configs=hz_month_configs,
+                    strategy_mode=strategy_mode, weights=weights, time_limit=float(hz_time_limit),
+                    model_options=model_options, lookahead=hz_lookahead, first_problem=problem,
+                    cache_dir=eng.CACHE_DIR if use_solve_cache else None,
+                )
+                st.session_state.pop("horizon_results", None)
+                st.rerun()
+
+            @st.fragment(run_every=1.0)
+            def render_horizon_progress():
+                job = st.session_state.get("horizon_job")
+                if job is None:
+                    return
+                if job["done"].is_set():
+                    st.rerun()
+                n_done = len(job["months"])
+                st.progress(n_done / job["n_months"], text=f"{n_done + 1} / {job['n_months']} か月目を求解中...")
+                for entry in job["months"]:
+                    st.write(f"✅ {entry['year']}年{entry['month']}月: {entry['result']['status']}（{entry['result']['wall_time']:.1f} 秒）")
+                if st.button("⏹️ 現在の月で打ち切る", disabled=job["stop"].is_set()):
+                    job["stop"].set()
+
+            if horizon_job is not None:
+                if horizon_job["done"].is_set():
+                    if horizon_job["error"]:
+                        st.error(f"連続作成中にエラーが発生しました: {horizon_job['error']}")
+                    st.session_state["horizon_results"] = horizon_job["months"]
+                    del st.session_state["horizon_job"]
+                else:
+                    render_horizon_progress()
+
+            hz_results = st.session_state.get("horizon_results")
+            if hz_results:
+                summary_rows = []
+                for entry in hz_results:
+                    res = entry["result"]
+                    summary_rows.append({
+                        "年月": f"{entry['year']}年{entry['month']}月",
+                        "状態": res["status"],
+                        "求解時間(秒)": round(res["wall_time"], 1),
+                        "緩和件数": len(res["relaxation_messages"]),
+                        "繰越残高合計(分)": sum(entry["carry"]["overtime_bank"].values()) if "carry" in entry else None,
+                    })
+                st.dataframe(pd.DataFrame(summary_rows), use_container_width=True, hide_index=True)
+                if not hz_results[-1]["result"]["ok"]:
+                    st.error(f"{hz_results[-1]['year']}年{hz_results[-1]['month']}月で解が見つからなかったため、以降の月は作成していません。")
+
+                ok_entries = [e for e in hz_results if e["result"]["ok"]]
+                if ok_entries:
+                    hz_pick = st.selectbox("表示する月", [f"{e['year']}年{e['month']}月" for e in ok_entries])
+                    picked = ok_entries[[f"{e['year']}年{e['month']}月" for e in ok_entries].index(hz_pick)]
+                    for msg in picked["result"]["relaxation_messages"]:
+                        st.write(msg)
+                    st.dataframe(picked["result"]["schedule"], use_container_width=True)
+
+                    st.download_button(
+                        "📥 全月分の勤務表を Excel で保存",
+                        lambda: eng.roster_workbook([(f"{e['year']}_{e['month']:02d}", e["result"]["schedule"]) for e in ok_entries], early_gr),
+                        file_name=f"roster_{ok_entries[0]['year']}_{ok_entries[0]['month']}_{len(ok_entries)}months.xlsx",
+                        on_click="ignore",
+                    )
+                    first = ok_entries[0]
+                    if (first["year"], first["month"]) == (year, month) and st.button(f"✅ {year}年{month}月分を勤務表として採用する"):
+                        st.session_state["raw_schedule"] = first["result"]["schedule"].copy()
+                        add_history(first["result"]["schedule"], f"複数月連続作成 ({strategy_mode})")
+                        st.rerun()
+    horizon_panel()
+
+    # --- 大規模向け：複数ユニットの分割作成 ---
+    @st.fragment
+    def units_panel():
+        with st.expander("🏢 複数ユニットを分割して一括作成する（大規模・兼務スタッフの応援調整）"):
+            st.caption("ユニットごとの設定ファイルを並列に求解します。同じ氏名で複数ユニットに登録されたスタッフは兼務者として、スキルの手薄なユニットを所属とし、所属先で「日」となった日（「日」の申し込み日を除く）に他ユニットの未充足担務へ応援として割り当てます。1つの設定のスタッフをチームへ自動分割する機能ではないため、ユニットごとに設定ファイルを用意してください。")
+            unit_files = st.file_uploader("ユニットごとの設定ファイル（複数選択）", type=["json", "v80z"], accept_multiple_files=True, key="unit_files")
+            unit_time_limit = st.number_input("1ユニットあたりの制限時間（秒）", 5, 300, int(eng.DEFAULT_TIME_LIMIT))
+
+            unit_labels, unit_problems = [], []
+            for f in unit_files or []:
+                try:
+                    cfg = eng.load_config_bytes(f.getvalue())
+                    unit_problems.append(eng.load_problem(cfg, year, month))
+                    unit_labels.append(f.name.rsplit(".", 1)[0])
+                except Exception:
+                    st.error(f"エラー：{f.name} の構造が不正です。")
+            if unit_problems:
+                shared = eng.shared_staff(unit_problems)
+                st.write(f"{len(unit_problems)} ユニット / 延べ {sum(p['total'] for p in unit_problems)} 名（兼務者 {len(shared)} 名）・{year}年{month}月")
+
+            units_job = st.session_state.get("units_job")
+            if st.button("🏢 分割作成を実行", disabled=job_running or units_job is not None or len(unit_problems) < 2):
+                st.session_state["units_job"] = eng.start_decomposition_job(
+                    unit_problems, strategy_mode=strategy_mode, weights=weights, time_limit=float(unit_time_limit),
+                    model_options=model_options, cache_dir=eng.CACHE_DIR if use_solve_cache else None,
+                )
+                st.session_state["units_job_labels"] = unit_labels
+                st.session_state.pop("units_result", None)
+                st.rerun()
+
+            @st.fragment(run_every=1.0)
+            def render_units_progress():
+                job = st.session_state.get("units_job")
+                if job is None:
+                    return
+                snap = eng.decomposition_snapshot(job)
+                if snap["done"] == snap["total"]:
+                    st.rerun()
+                st.progress(min(1.0, snap["elapsed"] / snap["expected_time"]), text=f"{snap['total']} ユニットを並列求解中（完了 {snap['done']} 件 / {snap['elapsed']:.0f} 秒）...")
+
+            if units_job is not None:
+                if all(f.done() for f in units_job["futures"]):
+                    st.session_state["units_result"] = (st.session_state.pop("units_job_labels"), eng.finish_decomposition_job(units_job))
+                    del st.session_state["units_job"]
+                else:
+                    render_units_progress()
+
+            if st.session_state.get("units_result"):
+                labels, out = st.session_state["units_result"]
+                summary_rows = []
+                for u, label in enumerate(labels):
+                    res = out["results"][u]
+                    summary_rows.append({
+                        "ユニット": label,
+                        "所属人数": out["subs"][u]["total"],
+                        "所属兼務者": ", ".join(n for n, h in out["home"].items() if h == u),
+                        "状態": res["status"],
+                        "未充足(調整前)": out["uncovered_before"][u],
+                        "未充足(応援後)": out["uncovered_after"][u],
+                        "応援受入": sum(1 for h in out["helpers"] if h["unit"] == u),
+                    })
+                st.dataframe(pd.DataFrame(summary_rows), use_container_width=True, hide_index=True)
+                if out["helpers"]:
+                    st.write("🤝 **応援割当**（所属先で「日」の日に他ユニットの担務を担当）")
+                    st.dataframe(pd.DataFrame([
+                        {"スタッフ名": h["staff"], "所属": labels[h["home"]], "応援先": labels[h["unit"]], "日": h["day"], "担務": h["shift"]}
+                        for h in out["helpers"]
+                    ]), use_container_width=True, hide_index=True)
+
+                ok_units = [u for u in range(len(labels)) if out["results"][u]["ok"]]
+                if ok_units:
+                    unit_pick = st.selectbox("表示するユニット", [labels[u] for u in ok_units])
+                    st.dataframe(eng.unit_schedule_with_helpers(out, labels.index(unit_pick)), use_container_width=True)
+                    st.download_button(
+                        "📥 全ユニットの勤務表を Excel で保存",
+                        lambda: eng.roster_workbook([(labels[u], eng.unit_schedule_with_helpers(out, u)) for u in ok_units], early_gr),
+                        file_name=f"roster_{year}_{month}_{len(ok_units)}units.xlsx",
+                        on_click="ignore",
+                    )
+    units_panel()
 
     # --- 4. 手動微調整 ＆ リアルタイム整合性検証システム ---
     if "raw_schedule" in st.session_state:
@@ -826,165 +1087,20 @@ with tab_solve:
 
         # 【個別セーブポイント保存ボタン】
         if st.button("💾 現在の調整版をセーブポイント（履歴）として保存"):
-            new_hist_entry = {
-                "timestamp": datetime.datetime.now().strftime("%H:%M:%S"),
-                "label": "ユーザー手動調整版",
-                "df": st.session_state["raw_schedule"].copy()
-            }
-            if not st.session_state["roster_history"] or not st.session_state["roster_history"][-1]["df"].equals(st.session_state["raw_schedule"]):
-                st.session_state["roster_history"].append(new_hist_entry)
-                if len(st.session_state["roster_history"]) > 5:
-                    st.session_state["roster_history"].pop(0)
+            if add_history(st.session_state["raw_schedule"], "ユーザー手動調整版"):
                 st.success("現在の調整内容を履歴（セーブポイント）に登録しました。いつでもこの状態に戻れます。")
             else:
                 st.info("現在の勤務表はすでに最新の履歴と同じ内容です。")
 
         # --- 5. リアルタイム・バリデーション & 統計再計算ロジック ---
-        validation_alerts = []
-        rec_rows = []
-        
-        consecutive_rules_broken = 0
-        pattern_rules_broken = 0
-        hols_mismatch_count = 0
-        overtime_limits_exceeded = 0
-
-        # 最新の確定（保存）済みスケジュールをベースに評価
+        # 最新の確定（保存）済みスケジュールをベースに、スタッフ×日のコード行列で一括評価
         saved_schedule = st.session_state["raw_schedule"]
-
-        for si, s_name in enumerate(staff_list):
-            row_shifts = saved_schedule.iloc[si].tolist()
-            
-            # (a) 休日数の整合性検証
-            n_off = row_shifts.count("休")
-            n_cho = row_shifts.count("調")
-            n_nen = row_shifts.count("年")
-            total_off_actual = n_off + n_cho + n_nen
-            
-            total_h_target = int(opt_hols.iloc[si, 0])
-            kokyu_target = int(opt_hols.iloc[si, 1])
-            req_off_count = sum(1 for di in range(n_days) if opt_req.iloc[si, di] == "休")
-            
-            max_cho_capacity = total_h_target - kokyu_target
-            expected_cho = max(0, max_cho_capacity)
-            expected_nen = max(0, req_off_count - expected_cho)
-            expected_off = kokyu_target
-            expected_total_off = expected_off + expected_cho + expected_nen
-            
-            if total_off_actual != expected_total_off:
-                validation_alerts.append(f"⚠️ **{s_name}**: 休日合計が一致しません（目標: {expected_total_off}日、手動修正後: {total_off_actual}日）")
-                hols_mismatch_count += 1
-            if n_off != expected_off:
-                validation_alerts.append(f"⚠️ **{s_name}**: 公休「休」の数が設定と異なります（目標公休: {expected_off}日、手動修正後: {n_off}日）")
-                hols_mismatch_count += 1
-            if n_cho != expected_cho:
-                validation_alerts.append(f"⚠️ **{s_name}**: 調整休「調」の数が設定と異なります（目標調整休: {expected_cho}日、手動修正後: {n_cho}日）")
-                hols_mismatch_count += 1
-            if n_nen != expected_nen:
-                validation_alerts.append(f"⚠️ **{s_name}**: 年休「年」の数が期待値と異なります（目標年休: {expected_nen}日、手動修正後: {n_nen}日）")
-                hols_mismatch_count += 1
-                
-            # (b) 5連勤以上の検出
-            prev_status = [opt_prev.iloc[si, k] for k in range(4)]
-            prev_working = [0 if v == "休" else 1 for v in prev_status]
-            current_working = [0 if v in ["休", "調", "年"] else 1 for v in row_shifts]
-            combined_working = prev_working + current_working
-            
-            max_consecutive = 0
-            curr_consecutive = 0
-            for w in combined_working:
-                if w == 1:
-                    curr_consecutive += 1
-                    if curr_consecutive > max_consecutive:
-                        max_consecutive = curr_consecutive
-                else:
-                    curr_consecutive = 0
-            
-            if max_consecutive >= 5:
-                validation_alerts.append(f"🚨 **{s_name}**: **{max_consecutive}連勤**が発生しています（上限4連勤のルール違反）")
-                consecutive_rules_broken += 1
-                
-            # (c) 遅早シフトパターン検証 ＆ 【新規】Fシフト前後の遷移パターンチェック
-            last_prev_shift = opt_prev.iloc[si, 3]
-            for di in range(n_days):
-                today_shift = row_shifts[di]
-                
-                # 通常の遅早チェック
-                if di == 0:
-                    prev_is_late = (last_prev_shift == "遅")
-                else:
-                    prev_shift = row_shifts[di-1]
-                    prev_is_late = (prev_shift in late_gr)
-                
-                today_is_early = (today_shift in early_gr)
-                
-                if prev_is_late and today_is_early:
-                    day_str = f"前月末日〜1日" if di == 0 else f"{di}日〜{di+1}日"
-                    validation_alerts.append(f"🚨 **{s_name}**: 遅番の翌日に早番が割り当てられています（{day_str}）")
-                    pattern_rules_broken += 1
-
-                # 【新規】Fシフト前後のルール検証（手動バリデーション）
-                if today_shift == "F":
-                    # Fの前日に「遅番」が入っている場合の検出
-                    if prev_is_late:
-                        day_str = "前月末日〜1日" if di == 0 else f"{di}日〜{di+1}日"
-                        validation_alerts.append(f"🚨 **{s_name}**: 遅番の翌日にF勤務が割り当てられています（{day_str}）")
-                        pattern_rules_broken += 1
-                    
-                    # Fの翌日に「早番」が入っている場合の検出
-                    if di < n_days - 1:
-                        next_shift = row_shifts[di+1]
-                        next_is_early = (next_shift in early_gr)
-                        if next_is_early:
-                            validation_alerts.append(f"🚨 **{s_name}**: F勤務の翌日に早番が割り当てられています（{di+1}日〜{di+2}日）")
-                            pattern_rules_broken += 1
-
-            # (d) 超過勤務時間の再集計
-            staff_overtime_sum = 0
-            for di in range(n_days):
-                wd_v = calendar.weekday(year, month, di+1)
-                assigned_char = row_shifts[di]
-                
-                d_date = datetime.date(year, month, di+1)
-                is_holiday = d_date in jp_holidays
-                is_designated = bool(opt_des.at[di+1, "指定日"]) if di+1 in opt_des.index else False
-                
-                if wd_v == 6:
-                    overtime_val = 0
-                elif wd_v == 5:
-                    if assigned_char in ["A", "B", "日", "休", "調", "年"]:
-                        overtime_val = 0
-                    elif assigned_char in opt_overtime.index:
-                        overtime_val = int(opt_overtime.loc[assigned_char, "土曜超過分(分)"])
-                    else:
-                        overtime_val = 0
-                else:
-                    if assigned_char in ["日", "休", "調", "年"]:
-                        overtime_val = 0
-                    elif (is_holiday or is_designated) and assigned_char in ["A", "B"]:
-                        overtime_val = 0
-                    elif assigned_char in opt_overtime.index:
-                        overtime_val = int(opt_overtime.loc[assigned_char, "平日超過分(分)"])
-                    else:
-                        overtime_val = 0
-                
-                staff_overtime_sum += overtime_val
-            
-            minus_val = n_cho * 445
-            final_overtime = staff_overtime_sum - minus_val
-            
-            # 36協定チェック
-            if final_overtime > 2700:
-                validation_alerts.append(f"⚠️ **36協定アラート**: **{s_name}**の精算後超過勤務が45時間を超過しています（{format_minutes_to_hhmm(final_overtime)}）")
-                overtime_limits_exceeded += 1
-
-            rec_rows.append({
-                "休の総数": total_off_actual,
-                "年休数(希望)": n_nen,
-                "設定公休": n_off,
-                "調整休日(調)数": n_cho,
-                "総超過(前)": format_minutes_to_hhmm(staff_overtime_sum),
-                "精算後超過": format_minutes_to_hhmm(final_overtime)
-            })
+        validation = eng.validate_roster(problem_inputs, eng.schedule_codes(problem_inputs, saved_schedule), staff_list)
+        validation_alerts = validation["alerts"]
+        consecutive_rules_broken = validation["consecutive_rules_broken"]
+        pattern_rules_broken = validation["pattern_rules_broken"]
+        hols_mismatch_count = validation["hols_mismatch_count"]
+        overtime_limits_exceeded = validation["overtime_limits_exceeded"]
 
         # 労務健全度スコアの総合算出
         deduction = (
@@ -995,7 +1111,7 @@ with tab_solve:
         )
         compliance_score = max(0, 100 - deduction)
 
-        stats_df = pd.DataFrame(rec_rows, index=staff_list)
+        stats_df = validation["stats"]
         final_display_df = pd.concat([saved_schedule, stats_df], axis=1)
 
         # 労務健全度スコアリングカードのダッシュボード表示
@@ -1015,6 +1131,36 @@ with tab_solve:
         else:
             st.success("✅ 完璧な整合性が保たれています。すべての基準ルールおよび労務協定の基準をクリアしています。")
 
+        # --- 近傍修復モード（変更・違反セルの周辺だけを再最適化） ---
+        @st.fragment
+        def repair_panel():
+            with st.expander("🩹 近傍修復モード（手動調整・違反箇所の周辺だけを再最適化）"):
+                st.write("手動で変更したセルと、新たに発生したルール違反セルの周辺だけを AI が組み直します。範囲外の勤務はそのまま固定されるため、すでに勤務を把握しているスタッフの予定は変わりません。")
+                rc1, rc2, rc3 = st.columns(3)
+                repair_day_radius = rc1.slider("前後の日数", 0, 7, 2)
+                repair_staff_opts = ["全スタッフ"] + [f"上下 {k} 人" for k in range(0, 6)]
+                repair_staff_choice = rc2.selectbox("対象スタッフ範囲（表の行）", repair_staff_opts, index=4)
+                repair_time_limit = rc3.number_input("制限時間（秒）", 1, int(eng.DEFAULT_TIME_LIMIT), min(10, int(eng.DEFAULT_TIME_LIMIT)))
+                repair_staff_radius = None if repair_staff_choice == "全スタッフ" else repair_staff_opts.index(repair_staff_choice) - 1
+
+                # 比較の基準は最新の履歴（AI 作成結果またはセーブポイント）
+                repair_base = roster_history.latest()
+                repair_inputs = problem_inputs
+                repair_free = eng.repair_window(repair_inputs, repair_base, saved_schedule, repair_day_radius, repair_staff_radius)
+                st.caption(f"再最適化の対象: {int(repair_free.sum())} / {repair_free.size} セル")
+
+                if st.button("🩹 周辺だけを再最適化する", disabled=job_running or not repair_free.any()):
+                    built = eng.build_model(problem, strategy_mode, weights, inputs=repair_inputs, model_options=dict(model_options, symmetry="none"))
+                    try:
+                        eng.fix_outside_window(built, saved_schedule, repair_free)
+                    except ValueError as e:
+                        st.error(f"近傍修復を開始できません: {e}")
+                    else:
+                        st.session_state["solve_job"] = eng.start_solve_job(built, float(repair_time_limit), eng.DEFAULT_NUM_WORKERS)
+                        st.session_state["solve_job_strategy"] = f"{strategy_mode} / 🩹 近傍修復"
+                        st.rerun()
+        repair_panel()
+
         # カラーマッピング描画
         def cl(v):
             if v == "休": return 'background-color: #ffcccc'
@@ -1028,15 +1174,11 @@ with tab_solve:
         st.subheader("📊 統計・最終集計確認（プレビュー）")
         st.dataframe(final_display_df.style.map(cl), use_container_width=True)
 
-        # Excel書き出し
-        towrite = io.BytesIO()
-        with pd.ExcelWriter(towrite, engine='openpyxl') as writer:
-            final_display_df.style.map(cl).to_excel(writer, index=True, sheet_name="Roster")
-        excel_data = towrite.getvalue()
-
+        # Excel書き出し（ダウンロードが押されたときだけ生成し、押してもアプリは再実行しない）
         st.download_button(
             label="📥 編集後の最終勤務表をExcelでダウンロード",
-            data=excel_data,
+            data=lambda: eng.roster_workbook([("Roster", final_display_df)], early_gr),
             file_name=f"roster_{year}_{month}_edited.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
         )
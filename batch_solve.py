@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import roster_engine as eng
+
+# =====================================================================
+#  一括勤務作成 CLI
+#  「📥 現在の全設定を保存する」で書き出した JSON をディレクトリ単位でまとめて求解する。
+#  例: python batch_solve.py backups/ -o results/ --jobs 4
+# =====================================================================
+
+
+# --- 1ファイル分の求解（プロセスプール内で実行） ---
+def solve_file(path, out_dir, options):
+    started = time.time()
+    name = os.path.splitext(os.path.basename(path))[0]
+    summary = {"file": path, "name": name}
+    try:
+        config = eng.load_config_file(path)
+        if options.get("months", 1) > 1:
+            return solve_file_horizon(config, path, name, out_dir, options, summary, started)
+        problem = eng.load_problem(config, options.get("year"), options.get("month"))
+        result = eng.solve_problem(
+            problem,
+            strategy_mode=options["strategy_mode"],
+            weights=options["weights"],
+            time_limit=options["time_limit"],
+            num_workers=options["num_workers"],
+            model_options=options["model_options"],
+            cache_dir=options["cache_dir"],
+        )
+        summary.update({
+            "year": problem["year"],
+            "month": problem["month"],
+            "status": result["status"],
+            "objective": result["objective"],
+            "solver_wall_time": result["wall_time"],
+            "relaxation_messages": result["relaxation_messages"],
+            "cached": result.get("cached", False),
+        })
+        if result["ok"]:
+            out_path = os.path.join(out_dir, f"{name}_roster_{problem['year']}_{problem['month']}.csv")
+            # Excel でそのまま開けるよう BOM 付き UTF-8 で出力
+            result["schedule"].to_csv(out_path, encoding="utf-8-sig")
+            summary["output"] = out_path
+    except Exception as e:
+        summary.update({"status": "ERROR", "error": f"{type(e).__name__}: {e}"})
+    summary["elapsed"] = round(time.time() - started, 3)
+    return summary
+
+
+# --- 複数月の連続作成（各月の CSV を出力し、サマリーは月ごとの配列にする） ---
+def solve_file_horizon(config, path, name, out_dir, options, summary, started):
+    results = eng.solve_horizon(
+        config,
+        options["months"],
+        year=options.get("year"),
+        month=options.get("month"),
+        strategy_mode=options["strategy_mode"],
+        weights=options["weights"],
+        time_limit=options["time_limit"],
+        num_workers=options["num_workers"],
+        model_options=options["model_options"],
+        cache_dir=options["cache_dir"],
+    )
+    months = []
+    for entry in results:
+        result = entry["result"]
+        month_summary = {
+            "year": entry["year"],
+            "month": entry["month"],
+            "status": result["status"],
+            "objective": result["objective"],
+            "solver_wall_time": result["wall_time"],
+            "relaxation_messages": result["relaxation_messages"],
+        }
+        if result["ok"]:
+            out_path = os.path.join(out_dir, f"{name}_roster_{entry['year']}_{entry['month']}.csv")
+            result["schedule"].to_csv(out_path, encoding="utf-8-sig")
+            month_summary["output"] = out_path
+        months.append(month_summary)
+    complete = len(months) == options["months"] and all(m["status"] in ("OPTIMAL", "FEASIBLE") for m in months)
+    summary.update({"status": "FEASIBLE" if complete else "INCOMPLETE", "months": months})
+    summary["elapsed"] = round(time.time() - started, 3)
+    return summary
+
+
+# --- 複数ユニットの分割作成（ディレクトリ内の全ファイルを1つの大規模勤務表として扱う） ---
+def solve_units_dir(files, out_dir, options, max_processes):
+    started = time.time()
+    names = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    problems = [eng.load_problem(eng.load_config_file(path), options.get("year"), options.get("month")) for path in files]
+    out = eng.solve_units(
+        problems,
+        strategy_mode=options["strategy_mode"],
+        weights=options["weights"],
+        time_limit=options["time_limit"],
+        num_workers=options["num_workers"],
+        model_options=options["model_options"],
+        cache_dir=options["cache_dir"],
+        max_processes=max_processes,
+    )
+    summaries = []
+    for u, (path, name) in enumerate(zip(files, names)):
+        result = out["results"][u]
+        summary = {
+            "file": path,
+            "name": name,
+            "status": result["status"],
+            "home_staff": out["subs"][u]["total"],
+            "uncovered_before": out["uncovered_before"][u],
+            "uncovered_after": out["uncovered_after"][u],
+            "relaxation_messages": result["relaxation_messages"],
+        }
+        schedule = eng.unit_schedule_with_helpers(out, u)
+        if schedule is not None:
+            p = problems[u]
+            out_path = os.path.join(out_dir, f"{name}_roster_{p['year']}_{p['month']}.csv")
+            schedule.to_csv(out_path, encoding="utf-8-sig")
+            summary["output"] = out_path
+        summaries.append(summary)
+    helpers = [dict(h, home=names[h["home"]], unit=names[h["unit"]]) for h in out["helpers"]]
+    print(f"{len(files)} ユニット / 兼務者 {len(out['home'])} 名 / 応援 {len(helpers)} 件 ({time.time() - started:.1f}s)")
+    return summaries, {"home": {n: names[u] for n, u in out["home"].items()}, "helpers": helpers}
+
+
+# --- 出力した全勤務表（全ファイル・全月・全ユニット）を1冊の Excel ブックへまとめる ---
+def write_workbook(summaries, path):
+    sheets = []
+    for s in summaries:
+        outputs = [m["output"] for m in s.get("months", []) if "output" in m]
+        if "output" in s:
+            outputs.append(s["output"])
+        if not outputs:
+            continue
+        early_gr = eng.load_config_file(s["file"]).get("early_shifts", [])
+        for out_path in outputs:
+            name = os.path.splitext(os.path.basename(out_path))[0].replace("_roster_", "_")
+            sheets.append((name, pd.read_csv(out_path, index_col=0, encoding="utf-8-sig", keep_default_na=False), early_gr))
+    with open(path, "wb") as f:
+        f.write(eng.roster_workbook(sheets))
+    print(f"Excel: {len(sheets)} シート → {path}")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="設定バックアップ JSON を一括で勤務作成します。")
+    p.add_argument("input_dir", help="v80_backup_*.json を格納したディレクトリ")
+    p.add_argument("-o", "--out-dir", default="batch_results", help="勤務表 CSV とサマリーの出力先")
+    p.add_argument("--pattern", default=".json", help="対象ファイルの拡張子（既定: .json、コンパクト形式は .v80z）")
+    p.add_argument("-j", "--jobs", type=int, default=0, help="同時に求解するファイル数（0: CPU数 ÷ ソルバースレッド数）")
+    p.add_argument("--num-workers", type=int, default=eng.DEFAULT_NUM_WORKERS, help="1求解あたりの CP-SAT スレッド数")
+    p.add_argument("--time-limit", type=float, default=eng.DEFAULT_TIME_LIMIT, help="1求解あたりの制限時間（秒）")
+    p.add_argument("--strategy", type=int, choices=[0, 1, 2], default=0, help="0: バランス, 1: フェアネス, 2: 健康・リズム")
+    p.add_argument("--mentor-coverage", choices=["inline", "shared"], default=eng.DEFAULT_MODEL_OPTIONS["mentor_coverage"],
+                   help="教育同行判定の定式化（shared: 日×熟練者集合ごとの共有リテラル）")
+    p.add_argument("--overtime-banking", choices=["prefix", "inline"], default=eng.DEFAULT_MODEL_OPTIONS["overtime_banking"],
+                   help="働き溜め制約の定式化（prefix: 日ごとの残高変数を連鎖）")
+    p.add_argument("--objective", choices=["weighted", "lexicographic"], default=eng.DEFAULT_MODEL_OPTIONS["objective"],
+                   help="目的関数の扱い（lexicographic: 充足 → ルール → 休日 → リズム・公平性の順に段階的に求解）")
+    p.add_argument("--symmetry", choices=["none", "lex"], default=eng.DEFAULT_MODEL_OPTIONS["symmetry"],
+                   help="入れ替え可能なスタッフ（スキル・申し込み・引継ぎ・休日目標が同一）の勤務列を辞書式に順序付けて探索を減らす")
+    p.add_argument("--excel", default=None, help="出力した全勤務表を1つの Excel ブック（ファイル・月・ユニットごとのシート）にまとめる出力先")
+    p.add_argument("--cache-dir", default=eng.CACHE_DIR, help="求解結果キャッシュの保存先（同一条件の再求解を省略）")
+    p.add_argument("--no-cache", action="store_true", help="求解結果キャッシュを使わない")
+    p.add_argument("--units", action="store_true", help="全ファイルを1つの勤務表のユニットとみなして分割作成（ユニットごとに設定ファイルが必要。同名スタッフは兼務者）")
+    p.add_argument("--months", type=int, default=1, help="当月から連続して作成する月数（前月末引継ぎ・累積公平性を自動繰越）")
+    p.add_argument("--year", type=int, default=None, help="JSON 内の年を上書き")
+    p.add_argument("--month", type=int, default=None, help="JSON 内の月を上書き")
+    p.add_argument("--w-h-rule", type=int, default=eng.DEFAULT_WEIGHTS["w_h_rule"])
+    p.add_argument("--w-mixing", type=int, default=eng.DEFAULT_WEIGHTS["w_mixing"])
+    p.add_argument("--w-fair", type=int, default=eng.DEFAULT_WEIGHTS["w_fair"])
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = sorted(
+        os.path.join(args.input_dir, f)
+        for f in os.listdir(args.input_dir)
+        if f.endswith(args.pattern)
+    )
+    if not files:
+        print(f"対象ファイルがありません: {args.input_dir}", file=sys.stderr)
+        return 1
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    jobs = args.jobs
+    if jobs <= 0:
+        jobs = max(1, (os.cpu_count() or 1) // max(1, args.num_workers))
+    options = {
+        "year": args.year,
+        "month": args.month,
+        "months": args.months,
+        "strategy_mode": eng.STRATEGY_MODES[args.strategy],
+        "weights": {"w_h_rule": args.w_h_rule, "w_mixing": args.w_mixing, "w_fair": args.w_fair},
+        "time_limit": args.time_limit,
+        "num_workers": args.num_workers,
+        "model_options": {"mentor_coverage": args.mentor_coverage, "overtime_banking": args.overtime_banking, "objective": args.objective,
+                          "symmetry": args.symmetry},
+        "cache_dir": None if args.no_cache else args.cache_dir,
+    }
+
+    if args.units:
+        summaries, coordination = solve_units_dir(files, args.out_dir, options, jobs)
+        with open(os.path.join(args.out_dir, "units_coordination.json"), "w", encoding="utf-8") as f:
+            json.dump(coordination, f, ensure_ascii=False, indent=2)
+        with open(os.path.join(args.out_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(summaries, f, ensure_ascii=False, indent=2)
+        if args.excel:
+            write_workbook(summaries, args.excel)
+        return 1 if any(s["status"] not in ("OPTIMAL", "FEASIBLE") for s in summaries) else 0
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(solve_file, path, args.out_dir, options): path for path in files}
+        for fut in as_completed(futures):
+            summary = fut.result()
+            summaries.append(summary)
+            print(f"[{summary['status']}] {summary['file']} ({summary['elapsed']}s)")
+
+    summaries.sort(key=lambda s: s["file"])
+    with open(os.path.join(args.out_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summaries, f, ensure_ascii=False, indent=2)
+    if args.excel:
+        write_workbook(summaries, args.excel)
+
+    failed = [s for s in summaries if s["status"] not in ("OPTIMAL", "FEASIBLE")]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
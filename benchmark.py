@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ortools
+import roster_engine as eng
+
+# =====================================================================
+#  合成インスタンス生成 ＆ 性能ベンチマーク
+#  シード固定のランダム設定 JSON（アプリで読み込める形式）を生成し、
+#  モデル構築時間・変数/制約数・初回実行可能解までの時間・最終目的値とギャップ・
+#  ピークメモリを計測して JSON に書き出す。--compare で前回結果との差分を表示する。
+#  例: python benchmark.py --suite scale -o bench_scale.json
+#      python benchmark.py --suite scale -o new.json --compare bench_scale.json
+#      python benchmark.py --suite symmetry --time-limit 60 --symmetry lex -o sym_lex.json --compare sym_none.json
+# =====================================================================
+
+SHIFT_NAMES = "ABCDEGHJKLMNPQRS"
+
+
+# --- 合成インスタンス（設定 JSON）の生成 ---
+# saturday_f=True なら C・D を必ず含め（土曜 F 運用あり）、False なら D を除いて F 運用を無効化する。
+# interchangeable=n なら末尾 n 名の一般職をスキル全○・申し込みなし・同じ前月末引継ぎにそろえ、入れ替え可能なスタッフにする。
+def make_instance(seed, n_mgr=2, n_reg=10, n_shifts=5, trainee_ratio=0.15, ng_ratio=0.1, request_density=0.08,
+                  work_request_ratio=0.2, saturday_f=True, interchangeable=0, year=2026, month=11):
+    rnd = random.Random(seed)
+    names = list(SHIFT_NAMES[:max(n_shifts, 1)])
+    if saturday_f and n_shifts >= 4:
+        names = ["A", "B", "C", "D"] + [n for n in SHIFT_NAMES if n not in "ABCD"][:n_shifts - 4]
+    elif not saturday_f:
+        names = [n for n in SHIFT_NAMES if n != "D"][:n_shifts]
+    # 前半を早番、後半を遅番グループとする（既定の A,B,C / D,E と同じ分け方）
+    n_early = max(1, (len(names) + 1) // 2)
+    early, late = names[:n_early], names[n_early:]
+
+    total = n_mgr + n_reg
+    staff_names = [f"職員{i+1:03d}" for i in range(total)]
+    config = {
+        "num_mgr": n_mgr,
+        "num_regular": n_reg,
+        "staff_names": staff_names,
+        "user_shifts": ",".join(names),
+        "early_shifts": early,
+        "late_shifts": late,
+        "year": year,
+        "month": month,
+        "saved_tables": {},
+    }
+    layout = eng.resolve_layout(config)
+
+    skill, _ = eng.default_table("skill", layout)
+    for s in layout["staff_list"]:
+        for c in layout["s_list"]:
+            r = rnd.random()
+            skill.loc[s, c] = "△" if r < trainee_ratio else ("×" if r < trainee_ratio + ng_ratio else "○")
+    # 勤務の申し込みは、同じ日の同じ担務が重複せず（充足制約は「ちょうど1名」）、× の担務を含まない範囲で入れる
+    request, _ = eng.default_table("request", layout)
+    taken = set()
+    for s in layout["staff_list"]:
+        for d in layout["days_cols"]:
+            if rnd.random() >= request_density:
+                continue
+            if rnd.random() < work_request_ratio:
+                choices = [c for c in layout["s_list"] if skill.loc[s, c] != "×" and (d, c) not in taken]
+                if not choices:
+                    continue
+                c = rnd.choice(choices)
+                taken.add((d, c))
+                request.loc[s, d] = c
+            else:
+                request.loc[s, d] = "休"
+    prev, _ = eng.default_table("prev", layout)
+    for s in layout["staff_list"]:
+        for c in layout["p_days"]:
+            prev.loc[s, c] = rnd.choice(["日", "休", "早", "遅"])
+    # 前月末日が遅番のスタッフは1日に早番・F に就けないため、その申し込みは外す
+    # （乱数の消費順を変えないよう生成後に取り除き、既存のシードのインスタンスは他の部分が変わらないようにする）
+    day1 = layout["days_cols"][0]
+    for s in layout["staff_list"]:
+        if prev.loc[s, layout["p_days"][-1]] == "遅" and request.loc[s, day1] in early + ["F"]:
+            request.loc[s, day1] = ""
+    clones = layout["staff_list"][total - min(interchangeable, n_reg):]
+    if clones:
+        skill.loc[clones, :] = "○"
+        request.loc[clones, :] = ""
+        prev.loc[clones, :] = prev.loc[clones[0]].to_numpy()
+
+    config["saved_tables"] = {
+        "skill": skill.astype(object).to_dict(),
+        "request": request.astype(object).to_dict(),
+        "prev": prev.astype(object).to_dict(),
+    }
+    # アプリの保存形式（JSON 往復後）にそろえる
+    return json.loads(json.dumps(config, ensure_ascii=False))
+
+
+# --- ベンチマークスイート（各要素が1インスタンスの生成パラメータ） ---
+def suite_cases(name, seeds=(0,)):
+    base = {"n_mgr": 2, "n_reg": 10, "n_shifts": 5, "trainee_ratio": 0.15, "request_density": 0.08, "saturday_f": True}
+    axes = {
+        "quick": [{}, {"n_reg": 20}],
+        "scale": [{"n_reg": n} for n in (6, 10, 14, 20, 30, 40)],
+        "shifts": [{"n_shifts": n} for n in (3, 5, 7, 9)],
+        "trainee": [{"trainee_ratio": r} for r in (0.0, 0.15, 0.3, 0.5)],
+        "requests": [{"request_density": r} for r in (0.0, 0.08, 0.2, 0.35)],
+        "saturday_f": [{"saturday_f": True}, {"saturday_f": False}],
+        # 入れ替え可能な一般職の人数（--symmetry lex との比較用。最適性の証明に近づける小規模構成）
+        "symmetry": [{"n_mgr": 0, "n_reg": 6, "n_shifts": 2, "saturday_f": False, "interchangeable": n} for n in (0, 3, 6)],
+    }
+    if name == "full":
+        variants = [v for key in ("scale", "shifts", "trainee", "requests", "saturday_f") for v in axes[key]]
+    else:
+        variants = axes[name]
+    cases = []
+    for v in variants:
+        for seed in seeds:
+            params = dict(base, **v)
+            label = "_".join(f"{k}={params[k]}" for k in sorted(v)) or "base"
+            cases.append({"case": f"{name}:{label}:seed={seed}", "seed": seed, "params": params})
+    return cases
+
+
+def _peak_rss_mb():
+    # resource は Unix 専用のため、Windows ではピークメモリを記録しない
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+# --- 1インスタンスの計測（ピークメモリを分離するため子プロセスで実行） ---
+def run_case(case, time_limit, num_workers, strategy_mode, model_options):
+    config = make_instance(case["seed"], **case["params"])
+    record = {"case": case["case"], "seed": case["seed"], "params": case["params"]}
+
+    t0 = time.perf_counter()
+    problem = eng.load_problem(config)
+    inputs = eng.compile_inputs(problem)
+    t1 = time.perf_counter()
+    built = eng.build_model(problem, strategy_mode, inputs=inputs, model_options=model_options)
+    t2 = time.perf_counter()
+    record["load_time"] = round(t1 - t0, 4)
+    record["build_time"] = round(t2 - t1, 4)
+    record.update(eng.model_size(built["model"]))
+    record["build_phases"] = built["build_stats"]["phases"]
+    record["families"] = built["build_stats"]["families"]
+    record["symmetric_staff"] = sum(len(c) for c in built["symmetry_classes"])
+
+    recorder = eng.IncumbentRecorder(built, keep_preview=False)
+    if built["model_options"]["objective"] == "lexicographic":
+        slv, status = eng.solve_lexicographic(built, time_limit, num_workers, callback=recorder)
+    else:
+        slv = eng.make_solver(time_limit, num_workers, built.get("solver_params"))
+        status = slv.Solve(built["model"], recorder)
+    incumbents, _ = recorder.snapshot()
+
+    ok = status in (eng.cp_model.OPTIMAL, eng.cp_model.FEASIBLE)
+    objective = slv.ObjectiveValue() if ok else None
+    bound = slv.BestObjectiveBound() if ok else None
+    if ok and built.get("lexicographic"):
+        # 最終段の目的値ではなく重み付き総和で記録し、weighted との比較・回帰判定に使えるようにする
+        objective = slv.Value(built["objective"])
+        bound = None
+        record["tiers"] = built["lexicographic"]
+    record.update({
+        "status": slv.StatusName(status),
+        "time_to_first_solution": round(incumbents[0]["wall_time"], 4) if incumbents else None,
+        "solutions": len(incumbents),
+        "objective": objective,
+        "bound": bound,
+        "gap": abs(bound - objective) / max(1.0, abs(bound)) if ok and bound is not None else None,
+        "solve_wall_time": round(sum(t["wall_time"] for t in built["lexicographic"]) if built.get("lexicographic") else slv.WallTime(), 4),
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+    record["time_to_optimal"] = record["solve_wall_time"] if status == eng.cp_model.OPTIMAL else None
+    if ok:
+        res = eng.extract_result(built, slv, status)
+        record["metrics"] = eng.roster_metrics(inputs, eng.schedule_codes(inputs, res["schedule"]))
+    return record
+
+
+def run_suite(cases, time_limit=10.0, num_workers=eng.DEFAULT_NUM_WORKERS, strategy_mode=eng.STRATEGY_MODES[0], model_options=None, on_record=None):
+    records = []
+    # 1ケース1プロセスにして ru_maxrss（プロセス生涯のピーク）をケースごとに分離する
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+        for case in cases:
+            try:
+                record = pool.submit(run_case, case, time_limit, num_workers, strategy_mode, model_options).result()
+            except Exception as e:
+                record = {"case": case["case"], "seed": case["seed"], "params": case["params"], "status": "ERROR", "error": f"{type(e).__name__}: {e}"}
+            records.append(record)
+            if on_record is not None:
+                on_record(record)
+    return records
+
+
+def environment_info(args):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "ortools": ortools.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "suite": args.suite,
+        "seeds": args.seeds,
+        "time_limit": args.time_limit,
+        "num_workers": args.num_workers,
+        "model_options": model_options_from_args(args),
+    }
+
+
+# --- 前回結果との比較（ケース名で突き合わせ） ---
+COMPARE_FIELDS = [
+    ("build_time", "lower"),
+    ("variables", "lower"),
+    ("constraints", "lower"),
+    ("time_to_first_solution", "lower"),
+    ("time_to_optimal", "lower"),
+    ("objective", "higher"),
+    ("gap", "lower"),
+    ("peak_rss_mb", "lower"),
+]
+
+
+def compare_results(old, new, tolerance=0.1):
+    old_by_case = {r["case"]: r for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        o = old_by_case.get(r["case"])
+        if o is None:
+            continue
+        for field, better in COMPARE_FIELDS:
+            a, b = o.get(field), r.get(field)
+            if a is None or b is None:
+                if (a is None) != (b is None):
+                    rows.append({"case": r["case"], "field": field, "old": a, "new": b, "regression": b is None})
+                continue
+            base = max(abs(a), 1e-9)
+            change = (b - a) / base
+            worse = change > tolerance if better == "lower" else change < -tolerance
+            rows.append({"case": r["case"], "field": field, "old": a, "new": b, "change": round(change, 4), "regression": bool(worse)})
+    return rows
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="合成インスタンスで勤務作成エンジンの性能を計測します。")
+    p.add_argument("--suite", choices=["quick", "scale", "shifts", "trainee", "requests", "saturday_f", "symmetry", "full"], default="quick")
+    p.add_argument("--seeds", type=int, nargs="+", default=[0], help="インスタンス生成シード（複数指定可）")
+    p.add_argument("-o", "--output", default="benchmark_results.json", help="計測結果 JSON の出力先")
+    p.add_argument("--compare", default=None, help="比較対象とする前回の計測結果 JSON")
+    p.add_argument("--tolerance", type=float, default=0.1, help="回帰とみなす変化率（既定: 10%%）")
+    p.add_argument("--time-limit", type=float, default=10.0, help="1ケースあたりの制限時間（秒）")
+    p.add_argument("--num-workers", type=int, default=eng.DEFAULT_NUM_WORKERS)
+    p.add_argument("--strategy", type=int, choices=[0, 1, 2], default=0)
+    p.add_argument("--mentor-coverage", choices=["inline", "shared"], default=eng.DEFAULT_MODEL_OPTIONS["mentor_coverage"])
+    p.add_argument("--overtime-banking", choices=["prefix", "inline"], default=eng.DEFAULT_MODEL_OPTIONS["overtime_banking"])
+    p.add_argument("--objective", choices=["weighted", "lexicographic"], default=eng.DEFAULT_MODEL_OPTIONS["objective"])
+    p.add_argument("--symmetry", choices=["none", "lex"], default=eng.DEFAULT_MODEL_OPTIONS["symmetry"],
+                   help="入れ替え可能なスタッフの対称性除去（lex: 勤務列の辞書式順序）")
+    p.add_argument("--write-configs", default=None, help="生成した設定 JSON をこのディレクトリへ書き出す（求解はしない）")
+    return p.parse_args(argv)
+
+
+def model_options_from_args(args):
+    return {"mentor_coverage": args.mentor_coverage, "overtime_banking": args.overtime_banking, "objective": args.objective, "symmetry": args.symmetry}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = suite_cases(args.suite, tuple(args.seeds))
+
+    if args.write_configs:
+        os.makedirs(args.write_configs, exist_ok=True)
+        for case in cases:
+            fname = case["case"].replace(":", "_").replace("=", "-") + ".json"
+            with open(os.path.join(args.write_configs, fname), "w", encoding="utf-8") as f:
+                json.dump(make_instance(case["seed"], **case["params"]), f, ensure_ascii=False)
+        print(f"{len(cases)} 件の設定 JSON を書き出しました: {args.write_configs}")
+        return 0
+
+    def report(r):
+        if r["status"] == "ERROR":
+            print(f"[ERROR] {r['case']}: {r['error']}")
+            return
+        first = "-" if r["time_to_first_solution"] is None else f"{r['time_to_first_solution']:.2f}s"
+        gap = "-" if r["gap"] is None else f"{r['gap']:.2%}"
+        optimal = "-" if r["time_to_optimal"] is None else f"{r['time_to_optimal']:.2f}s"
+        rss = "-" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']}MB"
+        print(f"[{r['status']}] {r['case']}  build={r['build_time']:.3f}s vars={r['variables']} cons={r['constraints']} "
+              f"first={first} optimal={optimal} gap={gap} rss={rss}")
+
+    results = {
+        "environment": environment_info(args),
+        "results": run_suite(
+            cases,
+            time_limit=args.time_limit,
+            num_workers=args.num_workers,
+            strategy_mode=eng.STRATEGY_MODES[args.strategy],
+            model_options=model_options_from_args(args),
+            on_record=report,
+        ),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        rows = compare_results(old, results, args.tolerance)
+        regressions = [r for r in rows if r["regression"]]
+        for r in regressions:
+            print(f"[REGRESSION] {r['case']} {r['field']}: {r['old']} -> {r['new']}")
+        print(f"比較 {len(rows)} 項目中 回帰 {len(regressions)} 件")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3050 @@
+import calendar
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+# OR-Tools の最適化モジュールをインポート
+from ortools.sat.python import cp_model
+# holidaysライブラリを安全にインポート（環境未導入時でもクラッシュしない設計）
+try:
+    import holidays
+except ImportError:
+    holidays = None
+# Excel 書き出し用（未導入でも求解は可能）
+try:
+    import openpyxl
+    from openpyxl.formatting.rule import CellIsRule, FormulaRule
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+except ImportError:
+    openpyxl = None
+
+# =====================================================================
+#  勤務作成エンジン（Streamlit 非依存のヘッドレス API）
+#  サイドバーの「📥 現在の全設定を保存する」で書き出した JSON をそのまま入力に取り、
+#  CP-SAT モデルの構築・求解・結果抽出までを行う。
+# =====================================================================
+
+WEEKDAY_CHARS = ['月', '火', '水', '木', '金', '土', '日']
+P_DAYS = ["前月4日前", "前月3日前", "前月2日前", "前月末日"]
+TABLE_KEYS = ["skill", "hols", "trainee", "prev", "request", "exclude", "overtime", "designated", "names"]
+
+STRATEGY_MODES = [
+    "⚖️ バランス調整モード（標準）",
+    "🤝 フェアネス（担当回数公平）最優先モード",
+    "🧘 健康・リズム（連勤・シフト負荷低減）最優先モード",
+]
+
+DEFAULT_WEIGHTS = {"w_h_rule": 95, "w_mixing": 70, "w_fair": 50, "w_holiday": 80}
+DEFAULT_TIME_LIMIT = 45.0
+DEFAULT_NUM_WORKERS = 4
+
+# モデル定式化の切替オプション
+#   mentor_coverage: "shared" = 日×熟練者集合ごとに「熟練者が勤務中」リテラルを1つ作り全見習い制約で共有
+#                    "inline" = 見習い制約ごとに熟練者の和を展開（従来方式・比較用）
+#   overtime_banking: "prefix" = 働き溜め残高を日ごとの IntVar で前日から連鎖（線形サイズ）
+#                     "inline" = 各日で月初からの累積和を展開（従来方式・O(日数²)）
+#   objective: "weighted" = 全評価項を重み付き和で1回求解（従来方式）
+#              "lexicographic" = 充足 → ルール → 休日 → リズム・公平性の順に段階的に求解
+#   symmetry: "none" = 対称性除去なし（従来方式）
+#             "lex" = 入れ替え可能なスタッフ同士の勤務列を辞書式に順序付け、同じ勤務表の並べ替えを探索から除く
+#   hard_constraints: "plain" = ハード制約をそのまま追加（通常の求解）
+#                     "assumptions" = 申し込み・年休数・スキル×・担務休止・遷移禁止をグループごとのリテラルの下に置く（実行不能の説明用）
+DEFAULT_MODEL_OPTIONS = {"mentor_coverage": "inline", "overtime_banking": "prefix", "objective": "weighted", "symmetry": "none",
+                         "hard_constraints": "plain"}
+
+
+# --- 日本の祝日判定用データの取得 ---
+# 祝日表の生成は重いため年ごとに1回だけ作成して使い回す（呼び出し側は変更しないこと）
+@functools.lru_cache(maxsize=16)
+def get_jp_holidays(year):
+    if holidays is not None:
+        try:
+            return holidays.Japan(years=[year])
+        except Exception:
+            pass
+    return {}
+
+
+# --- カレンダー列見出し（例: "1(月)"）の生成 ---
+def make_days_cols(year, month):
+    _, n_days = calendar.monthrange(year, month)
+    return [f"{d+1}({WEEKDAY_CHARS[calendar.weekday(year, month, d+1)]})" for d in range(n_days)]
+
+
+# --- 【位置ベース】曜日ズレ・非カレンダーテーブル共通高精度復元関数 ---
+def restore_table(saved_tables, key, d_df, categories=None):
+    if key in saved_tables:
+        raw_data = saved_tables.get(key)
+        df = pd.DataFrame(raw_data)
+
+        result_df = d_df.copy()
+
+        max_rows = min(len(d_df.index), len(df.index))
+        max_cols = min(len(d_df.columns), len(df.columns))
+
+        # 左上の重なり部分を位置で一括コピーする（欠損・空文字のセルは既定値のまま）
+        src = df.iloc[:max_rows, :max_cols].astype(object).to_numpy()
+        keep = pd.notna(src) & (src != "")
+        for j in np.flatnonzero(keep.any(axis=0)).tolist():
+            col = result_df.iloc[:, j].to_numpy(dtype=object).copy()
+            col[:max_rows][keep[:, j]] = src[keep[:, j], j]
+            result_df.isetitem(j, pd.Series(col, index=result_df.index).infer_objects())
+        df = result_df
+    else:
+        df = d_df
+
+    if categories:
+        for c in df.columns:
+            df[c] = pd.Categorical(df[c], categories=categories)
+    return df
+
+
+# --- 設定値からスタッフ・シフト構成を解決する（app.py と同一の規則） ---
+def resolve_layout(config, year=None, month=None):
+    year = int(year if year is not None else config["year"])
+    month = int(month if month is not None else config["month"])
+    n_mgr = int(config["num_mgr"])
+    n_reg = int(config["num_regular"])
+    total = int(n_mgr + n_reg)
+
+    staff_list = list(config.get("staff_names", []))
+    if len(staff_list) < total:
+        staff_list.extend([f"スタッフ{i+1}" for i in range(len(staff_list), total)])
+    staff_list = staff_list[:total]
+
+    raw_s = config["user_shifts"]
+    s_list = [s.strip() for s in raw_s.split(",") if s.strip()]
+    early_gr = [x for x in s_list if x in config.get("early_shifts", [])]
+    late_gr = [x for x in s_list if x in config.get("late_shifts", [])]
+
+    # 超過時間設定用のF対応リスト
+    overtime_s_list = list(s_list)
+    if "C" in s_list and "D" in s_list:
+        overtime_s_list.append("F")
+
+    _, n_days = calendar.monthrange(year, month)
+    return {
+        "year": year,
+        "month": month,
+        "n_days": n_days,
+        "n_mgr": n_mgr,
+        "total": total,
+        "staff_list": staff_list,
+        "s_list": s_list,
+        "early_gr": early_gr,
+        "late_gr": late_gr,
+        "overtime_s_list": overtime_s_list,
+        "days_cols": make_days_cols(year, month),
+        "options": ["", "休", "日"] + s_list,
+        "p_days": list(P_DAYS),
+    }
+
+
+# --- 各入力テーブルの既定値（未保存時の初期表） ---
+def default_table(key, layout):
+    staff_list = layout["staff_list"]
+    s_list = layout["s_list"]
+    overtime_s_list = layout["overtime_s_list"]
+    n_days = layout["n_days"]
+    if key == "skill":
+        return pd.DataFrame("○", index=staff_list, columns=s_list), ["○", "△", "×"]
+    if key == "hols":
+        return pd.DataFrame({"休の総数": [9] * len(staff_list), "公休分": [8] * len(staff_list)}, index=staff_list), None
+    if key == "trainee":
+        return pd.DataFrame(0, index=staff_list, columns=[f"{s}_見習い回数" for s in s_list]), None
+    if key == "prev":
+        return pd.DataFrame("休", index=staff_list, columns=layout["p_days"]), ["日", "休", "早", "遅"]
+    if key == "request":
+        return pd.DataFrame("", index=staff_list, columns=layout["days_cols"]), layout["options"]
+    if key == "exclude":
+        return pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=s_list), None
+    if key == "overtime":
+        return pd.DataFrame({"平日超過分(分)": [0 if s in ["A", "B"] else 30 for s in overtime_s_list], "土曜超過分(分)": [0 if s in ["A", "B"] else 30 for s in overtime_s_list]}, index=overtime_s_list), None
+    if key == "designated":
+        return pd.DataFrame(False, index=[d+1 for d in range(n_days)], columns=["指定日"]), None
+    if key == "names":
+        return pd.DataFrame({"スタッフ名": list(staff_list)}), None
+    raise KeyError(key)
+
+
+def load_tables(config, layout):
+    saved_tables = config.get("saved_tables", {}) or {}
+    tables = {}
+    for key in TABLE_KEYS:
+        d_df, categories = default_table(key, layout)
+        tables[key] = restore_table(saved_tables, key, d_df, categories)
+    return tables
+
+
+# --- 設定 JSON（dict）から求解用の問題定義を組み立てる ---
+def load_problem(config, year=None, month=None):
+    layout = resolve_layout(config, year, month)
+    problem = dict(layout)
+    problem["tables"] = load_tables(config, layout)
+    problem["jp_holidays"] = get_jp_holidays(layout["year"])
+    return problem
+
+
+def load_config_file(path):
+    with open(path, "rb") as f:
+        return load_config_bytes(f.read())
+
+
+# --- 設定ファイルのコンパクト形式（スキーマ版数付きバイナリ） ---
+# saved_tables の各表を列ごとの整数コード配列（文字列は語彙＋コード、真偽・数値はそのまま）にし、
+# 表以外の設定と表の見出しは JSON メタデータとして np.savez_compressed の1ファイルにまとめる。
+# 読み込み時は配列から DataFrame を直接組み立て、to_dict 形式の辞書パースを経由しない。
+CONFIG_MAGIC = b"V80Z"
+CONFIG_FORMAT_VERSION = 1
+
+
+def _json_key(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+
+def _encode_table(df):
+    df = pd.DataFrame(df)
+    columns, arrays = [], []
+    for j in range(df.shape[1]):
+        values = df.iloc[:, j]
+        if pd.api.types.is_bool_dtype(values.dtype):
+            columns.append({"kind": "bool"})
+            arrays.append(values.to_numpy(dtype=np.bool_))
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            columns.append({"kind": "int"})
+            arrays.append(values.to_numpy(dtype=np.int64))
+        elif pd.api.types.is_float_dtype(values.dtype):
+            columns.append({"kind": "float"})
+            arrays.append(values.to_numpy(dtype=np.float64))
+        else:
+            # 文字列（カテゴリ含む）は語彙とコードに分解。欠損はコード -1
+            obj = values.astype(object).to_numpy()
+            missing = pd.isna(obj)
+            vocab, codes = np.unique(obj[~missing].astype(str), return_inverse=True)
+            full = np.full(len(obj), -1, dtype=np.int32)
+            full[~missing] = codes
+            dtype = np.int8 if len(vocab) < 127 else np.int32
+            columns.append({"kind": "str", "vocab": vocab.tolist()})
+            arrays.append(full.astype(dtype))
+    meta = {
+        "index": [_json_key(v) for v in df.index],
+        "columns": [_json_key(v) for v in df.columns],
+        "kinds": columns,
+    }
+    return meta, arrays
+
+
+def _decode_table(meta, arrays):
+    data = {}
+    for j, (col, kind) in enumerate(zip(meta["columns"], meta["kinds"])):
+        arr = arrays[j]
+        if kind["kind"] == "str":
+            vocab = np.array(kind["vocab"] + [None], dtype=object)
+            data[j] = vocab[arr.astype(np.intp)]  # -1 → 末尾の None
+        else:
+            data[j] = arr
+    df = pd.DataFrame(data, index=meta["index"])
+    df.columns = meta["columns"]
+    return df
+
+
+def pack_config(config):
+    meta = {k: v for k, v in config.items() if k != "saved_tables"}
+    meta["format_version"] = CONFIG_FORMAT_VERSION
+    meta["tables"] = {}
+    arrays = {}
+    for key, raw in (config.get("saved_tables") or {}).items():
+        t_meta, t_arrays = _encode_table(raw)
+        meta["tables"][key] = t_meta
+        for j, a in enumerate(t_arrays):
+            arrays[f"{key}.{j}"] = a
+    arrays["meta"] = np.frombuffer(json.dumps(meta, ensure_ascii=False, default=_json_key).encode("utf-8"), dtype=np.uint8)
+    buf = io.BytesIO()
+    buf.write(CONFIG_MAGIC)
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def unpack_config(data):
+    if not data.startswith(CONFIG_MAGIC):
+        raise ValueError("コンパクト形式の設定ファイルではありません")
+    with np.load(io.BytesIO(data[len(CONFIG_MAGIC):]), allow_pickle=False) as npz:
+        meta = json.loads(npz["meta"].tobytes().decode("utf-8"))
+        version = meta.pop("format_version", None)
+        if version is None or version > CONFIG_FORMAT_VERSION:
+            raise ValueError(f"未対応の設定ファイル形式です（版数: {version}）")
+        tables = meta.pop("tables", {})
+        config = dict(meta)
+        config["saved_tables"] = {
+            key: _decode_table(t_meta, [npz[f"{key}.{j}"] for j in range(len(t_meta["columns"]))])
+            for key, t_meta in tables.items()
+        }
+    return config
+
+
+# --- 設定ファイル（JSON またはコンパクト形式）の読み込みと JSON への書き出し ---
+def load_config_bytes(data):
+    if data.startswith(CONFIG_MAGIC):
+        return unpack_config(data)
+    return json.loads(data.decode("utf-8-sig") if isinstance(data, bytes) else data)
+
+
+def config_to_json(config):
+    # コンパクト形式から読み込んだ表（DataFrame）は従来の to_dict 形式へ戻して書き出す
+    def default(o):
+        if isinstance(o, pd.DataFrame):
+            return o.to_dict()
+        return _json_key(o)
+    return json.dumps(config, ensure_ascii=False, default=default)
+
+
+# --- 戦略モードとスライダー値から目的関数ウェイトを算出 ---
+def strategy_weights(strategy_mode, w_h_rule, w_mixing, w_fair):
+    if "⚖️" in strategy_mode:
+        return w_h_rule, w_mixing, w_fair
+    elif "🤝" in strategy_mode:
+        return w_h_rule, int(w_mixing * 0.5), int(w_fair * 4.0)
+    # 🧘 健康・リズム最優先
+    return int(w_h_rule * 2.0), int(w_mixing * 4.0), int(w_fair * 0.3)
+
+
+# --- 調整休・年休の目標値（デバッグ表・モデル・検証で共通） ---
+def holiday_targets(total_h, kokyu_h, req_off_count):
+    max_cho_capacity = total_h - kokyu_h
+    expected_cho = max(0, max_cho_capacity)
+    expected_nen = max(0, req_off_count - expected_cho)
+    return expected_cho, expected_nen
+
+
+# --- 入力テーブルの前処理（整数コード化した NumPy 行列と派生マスク） ---
+# モデル構築は DataFrame へ一切アクセスせず、ここで作った配列のみを参照する。
+SKILL_OK, SKILL_TRAINEE, SKILL_NG = 0, 1, 2
+SKILL_CODES = {"○": SKILL_OK, "△": SKILL_TRAINEE, "×": SKILL_NG}
+REQ_NONE = -1
+
+
+# --- 当月の祝日（日番号のタプル） ---
+@functools.lru_cache(maxsize=64)
+def month_holiday_days(year, month):
+    _, n_days = calendar.monthrange(year, month)
+    jp_holidays = get_jp_holidays(year)
+    return tuple(d + 1 for d in range(n_days) if datetime.date(year, month, d+1) in jp_holidays)
+
+
+# --- 月ごとの日属性表（求解モデルと検証の双方で共有） ---
+# 曜日・祝日・指定日・土曜 F 運用日と、日×担務の超過分（分）行列を
+# (年, 月, 担務, 超過分設定, 指定日, 祝日) ごとに1回だけ計算する。返す配列は読み取り専用。
+@functools.lru_cache(maxsize=64)
+def day_attributes(year, month, s_list_extended, overtime_key, designated_days, holiday_days):
+    _, n_days = calendar.monthrange(year, month)
+    first_wd = calendar.weekday(year, month, 1)
+    weekday = ((first_wd + np.arange(n_days)) % 7).astype(np.int8)
+    is_holiday = np.zeros(n_days, dtype=bool)
+    is_holiday[[d - 1 for d in holiday_days]] = True
+    designated = np.zeros(n_days, dtype=bool)
+    designated[[d - 1 for d in designated_days]] = True
+    is_sat_f_day = (weekday == 5) & ("C" in s_list_extended and "F" in s_list_extended)
+
+    ot = np.array(overtime_key, dtype=np.int64).reshape(len(s_list_extended), 2)
+    is_ab = np.array([n in ["A", "B"] for n in s_list_extended], dtype=bool)
+    overtime_min = np.zeros((n_days, len(s_list_extended)), dtype=np.int64)
+    weekday_rows = weekday < 5
+    overtime_min[weekday_rows] = ot[:, 0]
+    overtime_min[np.ix_((weekday_rows & (is_holiday | designated)), is_ab)] = 0
+    overtime_min[weekday == 5] = np.where(is_ab, 0, ot[:, 1])
+
+    attrs = {
+        "weekday": weekday,
+        "is_holiday": is_holiday,
+        "designated": designated,
+        "is_sat_f_day": is_sat_f_day,
+        "overtime_min": overtime_min,
+    }
+    for v in attrs.values():
+        v.flags.writeable = False
+    return attrs
+
+
+def _to_bool_array(df):
+    return df.astype(object).where(df.notna(), False).to_numpy(dtype=bool)
+
+
+def compile_inputs(problem):
+    year, month, n_days = problem["year"], problem["month"], problem["n_days"]
+    total = problem["total"]
+    s_list = problem["s_list"]
+    tables = problem["tables"]
+    jp_holidays = problem["jp_holidays"]
+
+    s_list_extended = list(s_list)
+    has_C_and_D = "C" in s_list and "D" in s_list
+    if has_C_and_D:
+        s_list_extended.append("F")
+    num_types_extended = len(s_list_extended)
+
+    S_OFF, S_NIK = 0, num_types_extended + 1
+    S_CHO = num_types_extended + 2
+    S_NEN = num_types_extended + 3
+
+    # スキル（○/△/×）→ 0/1/2。F は C・D の組合せから導出
+    skill = tables["skill"].astype(object).to_numpy()[:total, :len(s_list)]
+    skill_code = np.full((total, num_types_extended), SKILL_OK, dtype=np.int8)
+    skill_code[:, :len(s_list)] = np.where(skill == "×", SKILL_NG, np.where(skill == "△", SKILL_TRAINEE, SKILL_OK))
+    if has_C_and_D:
+        sc = skill_code[:, s_list.index("C")]
+        sd = skill_code[:, s_list.index("D")]
+        skill_code[:, -1] = np.where((sc == SKILL_NG) | (sd == SKILL_NG), SKILL_NG,
+                                     np.where((sc == SKILL_OK) & (sd == SKILL_OK), SKILL_OK, SKILL_TRAINEE))
+
+    # 申し込み → 割当先コード（休: S_OFF で休系グループ, 日: S_NIK, 勤務: sid, 空欄: REQ_NONE）
+    req_map = {"休": S_OFF, "日": S_NIK}
+    for i, n in enumerate(s_list_extended): req_map[n] = i + 1
+    req = tables["request"].astype(object).to_numpy()[:total, :n_days]
+    req_code = np.full((total, n_days), REQ_NONE, dtype=np.int16)
+    for label, code in req_map.items():
+        req_code[req == label] = code
+
+    # 前月末引継ぎ
+    prev = tables["prev"].astype(object).to_numpy()[:total, :4]
+    prev_work = (prev != "休").astype(np.int8)
+    prev_last_late = prev[:, 3] == "遅"
+
+    # 暦属性（曜日・祝日・指定日・土曜 F 運用日）と日×担務の超過分（分）行列
+    if jp_holidays is get_jp_holidays(year):
+        hol_days = month_holiday_days(year, month)
+    else:
+        hol_days = tuple(d + 1 for d in range(n_days) if datetime.date(year, month, d+1) in jp_holidays)
+    opt_des = tables["designated"]
+    des_flags = _to_bool_array(opt_des[["指定日"]])[:, 0]
+    des_days = tuple(int(day) for pos, day in enumerate(opt_des.index)
+                     if isinstance(day, (int, np.integer)) and 1 <= day <= n_days and des_flags[pos])
+    opt_overtime = tables["overtime"]
+    ot_key = tuple(
+        (int(opt_overtime.loc[n, "平日超過分(分)"]), int(opt_overtime.loc[n, "土曜超過分(分)"])) if n in opt_overtime.index else (0, 0)
+        for n in s_list_extended
+    )
+    days = day_attributes(year, month, tuple(s_list_extended), ot_key, des_days, hol_days)
+    weekday = days["weekday"]
+    is_holiday = days["is_holiday"]
+    designated = days["designated"]
+    is_sat_f_day = days["is_sat_f_day"]
+    overtime_min = days["overtime_min"]
+
+    # 不要担務・申し込み有無から、担務の「閉鎖」マスクを導出
+    requested = np.zeros((n_days, num_types_extended), dtype=bool)
+    for i in range(num_types_extended):
+        requested[:, i] = (req_code == i + 1).any(axis=0)
+    exclude = np.zeros((n_days, num_types_extended), dtype=bool)
+    exclude[:, :len(s_list)] = _to_bool_array(tables["exclude"])[:n_days, :len(s_list)]
+    closed = exclude & ~requested
+    if "C" in s_list:
+        c_col = s_list.index("C")
+        closed[:, c_col] |= (weekday == 6) & ~requested[:, c_col]
+    if has_C_and_D:
+        closed[:, -1] = ~is_sat_f_day
+
+    # 休日目標
+    hols = tables["hols"].to_numpy()[:total, :2].astype(np.int64)
+    req_off_count = (req_code == S_OFF).sum(axis=1)
+    expected_cho = np.maximum(0, hols[:, 0] - hols[:, 1])
+    expected_nen = np.maximum(0, req_off_count - expected_cho)
+
+    # 複数月連続作成の引継ぎ（累積担当回数・働き溜め残高・翌月冒頭の申し込み）
+    carry = problem.get("carry") or {}
+    carry_counts = np.zeros((total, num_types_extended), dtype=np.int64)
+    carry_bank = np.zeros(total, dtype=np.int64)
+    for s, name in enumerate(problem["staff_list"][:total]):
+        counts = carry.get("shift_counts", {}).get(name, {})
+        for i, s_name in enumerate(s_list_extended):
+            carry_counts[s, i] = int(counts.get(s_name, 0))
+        carry_bank[s] = int(carry.get("overtime_bank", {}).get(name, 0))
+    next_req = carry.get("next_requests")
+    n_look = 0 if next_req is None else min(4, next_req.shape[1])
+    next_work = np.zeros((total, n_look), dtype=bool)
+    next_early = np.zeros(total, dtype=bool)
+    if n_look:
+        nr = next_req.reindex(problem["staff_list"][:total]).astype(object).to_numpy()[:, :n_look]
+        next_work = np.isin(nr, ["日"] + s_list_extended)
+        next_early = np.isin(nr[:, 0], problem["early_gr"])
+
+    return {
+        "n_days": n_days,
+        "total": total,
+        "n_mgr": problem["n_mgr"],
+        "s_list_extended": s_list_extended,
+        "has_C_and_D": has_C_and_D,
+        "num_types_extended": num_types_extended,
+        "S_OFF": S_OFF, "S_NIK": S_NIK, "S_CHO": S_CHO, "S_NEN": S_NEN,
+        "E_IDS": [s_list_extended.index(x) + 1 for x in problem["early_gr"] if x in s_list_extended],
+        "L_IDS": [s_list_extended.index(x) + 1 for x in problem["late_gr"] if x in s_list_extended],
+        "skill": skill_code,
+        "request": req_code,
+        "prev_work": prev_work,
+        "prev_last_late": prev_last_late,
+        "weekday": weekday,
+        "is_holiday": is_holiday,
+        "designated": designated,
+        "is_sat_f_day": is_sat_f_day,
+        "closed": closed,
+        "overtime_min": overtime_min,
+        "kokyu": hols[:, 1],
+        "expected_cho": expected_cho,
+        "expected_nen": expected_nen,
+        "carry_counts": carry_counts,
+        "carry_bank": carry_bank,
+        "next_work": next_work,
+        "next_early": next_early,
+    }
+
+
+# --- 割当コード ⇔ 勤務記号 の対応表 ---
+def code_chars(inputs):
+    id_char = {inputs["S_OFF"]: "休", inputs["S_NIK"]: "日", inputs["S_CHO"]: "調", inputs["S_NEN"]: "年"}
+    for i, n in enumerate(inputs["s_list_extended"]): id_char[i+1] = n
+    return id_char
+
+
+# --- 勤務表（記号の DataFrame）をコード行列（スタッフ×日, 未知の記号は -1）へ変換 ---
+def schedule_codes(inputs, schedule_df):
+    values = schedule_df.astype(object).to_numpy()[:inputs["total"], :inputs["n_days"]]
+    codes = np.full(values.shape, -1, dtype=np.int16)
+    for code, char in code_chars(inputs).items():
+        codes[values == char] = code
+    return codes
+
+
+# --- 早番・遅番・F の判定（スタッフ×日の真偽行列。F のない設定では is_f はすべて False） ---
+def shift_kind_flags(inputs, codes):
+    is_early = np.isin(codes, inputs["E_IDS"])
+    is_late = np.isin(codes, inputs["L_IDS"])
+    if inputs["has_C_and_D"]:
+        is_f = codes == len(inputs["s_list_extended"])
+    else:
+        is_f = np.zeros(codes.shape, dtype=bool)
+    return is_early, is_late, is_f
+
+
+# --- 翌日制限の違反セル：遅→早（前月末日の遅も含む）・遅→F・F→早 ---
+def transition_violation_cells(prev_last_late, is_early, is_late, is_f):
+    bad = np.zeros(is_early.shape, dtype=bool)
+    prev_late = np.concatenate([np.asarray(prev_last_late, dtype=bool)[:, None], is_late[:, :-1]], axis=1)
+    bad |= prev_late & is_early
+    bad[:, 1:] |= is_late[:, :-1] & is_early[:, 1:]
+    bad |= prev_late & is_f
+    bad[:, 1:] |= is_f[:, :-1] & is_early[:, 1:]
+    bad[:, :-1] |= is_f[:, :-1] & is_early[:, 1:]
+    return bad
+
+
+# --- ルール違反セルの一括検出 ---
+# 連勤・遅→早・F前後遷移・スキル×・申し込み不一致はセル単位（スタッフ×日の真偽行列）、
+# 休日数の不一致はスタッフ単位（真偽ベクトル）で返す。
+def find_violation_cells(inputs, codes):
+    total, n_days = codes.shape
+    S_OFF, S_NIK, S_CHO, S_NEN = inputs["S_OFF"], inputs["S_NIK"], inputs["S_CHO"], inputs["S_NEN"]
+    bad = np.zeros((total, n_days), dtype=bool)
+
+    is_off = np.isin(codes, [S_OFF, S_CHO, S_NEN])
+    is_early, is_late, is_f = shift_kind_flags(inputs, codes)
+
+    # 5連勤以上（前月末4日を含めた5日窓がすべて勤務）
+    work = np.concatenate([inputs["prev_work"].astype(bool), ~is_off], axis=1)
+    n_win = work.shape[1] - 4
+    if n_win > 0:
+        full = np.ones((total, n_win), dtype=bool)
+        for k in range(5):
+            full &= work[:, k:k + n_win]
+        for k in range(5):
+            cols = np.arange(n_win) + k - 4
+            ok = cols >= 0
+            bad[:, cols[ok]] |= full[:, ok]
+
+    # 遅→早（前月末日の遅も含む）と F 前後の遷移
+    bad |= transition_violation_cells(inputs["prev_last_late"], is_early, is_late, is_f)
+
+    # スキル × の担務
+    shift = (codes >= 1) & (codes <= inputs["num_types_extended"])
+    sk = np.take_along_axis(inputs["skill"], np.clip(codes - 1, 0, inputs["num_types_extended"] - 1).astype(np.intp), axis=1)
+    bad |= shift & (sk == SKILL_NG)
+
+    # 申し込みとの不一致
+    req = inputs["request"]
+    bad |= (req == S_OFF) & ~is_off
+    bad |= (req > 0) & (codes != req)
+    bad |= (codes == S_NEN) & (req != S_OFF)
+
+    # 休日数の不一致はスタッフ単位
+    row_bad = ((codes == S_OFF).sum(axis=1) != inputs["kokyu"])
+    row_bad |= ((codes == S_CHO).sum(axis=1) != inputs["expected_cho"])
+    row_bad |= ((codes == S_NEN).sum(axis=1) != inputs["expected_nen"])
+    return bad, row_bad
+
+
+# --- 担務の未充足セル（日×担務の真偽行列） ---
+# extra_staffed: 他ユニットからの応援などで外部から埋まった人数（日×担務）
+def uncovered_cells(inputs, codes, extra_staffed=None):
+    n_types = inputs["num_types_extended"]
+    per_day = np.stack([(codes == i + 1).sum(axis=0) for i in range(n_types)], axis=1)
+    if extra_staffed is not None:
+        per_day = per_day + extra_staffed
+    need = ~inputs["closed"]
+    if inputs["has_C_and_D"]:
+        # 土曜 F 運用日は F 1名（C・D なし）か C・D 各1名のどちらかを満たせばよい
+        f_used = per_day[:, -1] > 0
+        c_i = inputs["s_list_extended"].index("C")
+        d_i = inputs["s_list_extended"].index("D")
+        sat = inputs["is_sat_f_day"]
+        need[sat & f_used, c_i] = False
+        need[sat & f_used, d_i] = False
+        need[sat & ~f_used, -1] = False
+    return need & (per_day == 0)
+
+
+# --- 勤務表の評価指標（戦略比較・ベンチマーク用の一括集計） ---
+def roster_metrics(inputs, codes):
+    total, n_days = codes.shape
+    S_OFF, S_CHO, S_NEN = inputs["S_OFF"], inputs["S_CHO"], inputs["S_NEN"]
+    n_types = inputs["num_types_extended"]
+    weekday = inputs["weekday"]
+    is_off = np.isin(codes, [S_OFF, S_CHO, S_NEN])
+    is_early = np.isin(codes, inputs["E_IDS"])
+    is_late = np.isin(codes, inputs["L_IDS"])
+    shift = (codes >= 1) & (codes <= n_types)
+    uncovered = int(uncovered_cells(inputs, codes).sum())
+
+    # 5連勤窓・遅→早・F前後遷移
+    work = np.concatenate([inputs["prev_work"].astype(bool), ~is_off], axis=1)
+    n_win = work.shape[1] - 4
+    consecutive = 0
+    if n_win > 0:
+        full = np.ones((total, n_win), dtype=bool)
+        for k in range(5):
+            full &= work[:, k:k + n_win]
+        consecutive = int(full.sum())
+    prev_late = np.concatenate([inputs["prev_last_late"][:, None], is_late[:, :-1]], axis=1)
+    late_early = int((prev_late & is_early).sum())
+    f_transitions = 0
+    if inputs["has_C_and_D"]:
+        is_f = codes == n_types
+        f_transitions = int((prev_late & is_f).sum() + (is_f[:, :-1] & is_early[:, 1:]).sum())
+
+    # 見習い単独（その日に該当担務の熟練者が誰も勤務していない）
+    skill = inputs["skill"]
+    no_mentor = 0
+    for i in range(n_types):
+        mentors_working = (shift & (skill[:, i] == SKILL_OK)[:, None]).any(axis=0)
+        trainee_on = (codes == i + 1) & (skill[:, i] == SKILL_TRAINEE)[:, None]
+        no_mentor += int((trainee_on & ~mentors_working[None, :]).sum())
+
+    # 担当回数の公平性（担務ごとの最大−最小）
+    counts = np.stack([(codes == i + 1).sum(axis=1) for i in range(n_types)], axis=1)
+    spread = counts.max(axis=0) - counts.min(axis=0) if total else np.zeros(n_types, dtype=int)
+
+    # 超過勤務（調整休 445 分精算後）
+    ot = np.where(shift, inputs["overtime_min"][np.arange(n_days)[None, :], np.clip(codes - 1, 0, n_types - 1)], 0)
+    overtime = ot.sum(axis=1) - 445 * (codes == S_CHO).sum(axis=1)
+
+    _, row_bad = find_violation_cells(inputs, codes)
+    return {
+        "uncovered_shifts": uncovered,
+        "no_mentor": no_mentor,
+        "late_to_early": late_early,
+        "f_transitions": f_transitions,
+        "consecutive_windows": consecutive,
+        "holiday_mismatch_staff": int(row_bad.sum()),
+        "fairness_spread_max": int(spread.max()) if n_types else 0,
+        "fairness_spread_sum": int(spread.sum()),
+        "overtime_total_min": int(overtime.sum()),
+        "overtime_max_min": int(overtime.max()) if total else 0,
+        "over_45h_staff": int((overtime > 2700).sum()),
+        "weekend_nik": int(((codes == inputs["S_NIK"]) & (weekday[None, :] >= 5)).sum()),
+    }
+
+
+# --- 分単位の時間を HH:MM 表記へ ---
+def format_minutes_to_hhmm(minutes):
+    is_negative = minutes < 0
+    abs_minutes = abs(minutes)
+    hh = abs_minutes // 60
+    mm = abs_minutes % 60
+    sign = "-" if is_negative else ""
+    return f"{sign}{hh:02d}:{mm:02d}"
+
+
+# --- 最長連勤日数（前月末4日を含む勤務フラグ行列の行ごとの最長連続長） ---
+def max_run_length(work):
+    if work.shape[1] == 0:
+        return np.zeros(work.shape[0], dtype=np.int64)
+    c = np.cumsum(work, axis=1, dtype=np.int64)
+    # 直近の非勤務日の累積値を差し引くと、その日までの連続勤務日数になる
+    reset = np.maximum.accumulate(np.where(work, 0, c), axis=1)
+    return (c - reset).max(axis=1)
+
+
+# --- 手動調整後の勤務表の検証と集計（リアルタイム・バリデーション） ---
+# 休日数・連勤・遅→早・F前後遷移・超過勤務を配列演算で一括計算し、
+# 違反のあるスタッフ×日だけを走査して警告文を組み立てる。
+def validate_roster(inputs, codes, staff_list):
+    total, n_days = codes.shape
+    S_OFF, S_CHO, S_NEN = inputs["S_OFF"], inputs["S_CHO"], inputs["S_NEN"]
+    n_types = inputs["num_types_extended"]
+
+    # (a) 休日数
+    n_off = (codes == S_OFF).sum(axis=1)
+    n_cho = (codes == S_CHO).sum(axis=1)
+    n_nen = (codes == S_NEN).sum(axis=1)
+    total_off = n_off + n_cho + n_nen
+    exp_off, exp_cho, exp_nen = inputs["kokyu"], inputs["expected_cho"], inputs["expected_nen"]
+    exp_total = exp_off + exp_cho + exp_nen
+
+    # (b) 連勤
+    is_off = np.isin(codes, [S_OFF, S_CHO, S_NEN])
+    max_consecutive = max_run_length(np.concatenate([inputs["prev_work"].astype(bool), ~is_off], axis=1))
+
+    # (c) 遅→早・F前後（前月末日の遅も含む）
+    is_early = np.isin(codes, inputs["E_IDS"])
+    is_late = np.isin(codes, inputs["L_IDS"])
+    prev_late = np.concatenate([inputs["prev_last_late"][:, None], is_late[:, :-1]], axis=1)
+    late_early = prev_late & is_early
+    f_after_late = np.zeros_like(late_early)
+    f_before_early = np.zeros_like(late_early)
+    if inputs["has_C_and_D"]:
+        is_f = codes == n_types
+        f_after_late = prev_late & is_f
+        f_before_early[:, :-1] = is_f[:, :-1] & is_early[:, 1:]
+
+    # (d) 超過勤務（調整休 445 分精算）
+    shift = (codes >= 1) & (codes <= n_types)
+    ot = np.where(shift, inputs["overtime_min"][np.arange(n_days)[None, :], np.clip(codes - 1, 0, n_types - 1)], 0)
+    overtime = ot.sum(axis=1)
+    final_overtime = overtime - 445 * n_cho
+
+    def span(di):
+        return "前月末日〜1日" if di == 0 else f"{di}日〜{di+1}日"
+
+    # 同一スタッフ内では日順・種別順に並べる
+    pattern_msgs = {}
+    for kind, mat in enumerate([late_early, f_after_late, f_before_early]):
+        for si, di in zip(*np.nonzero(mat)):
+            if kind == 0:
+                msg = f"🚨 **{staff_list[si]}**: 遅番の翌日に早番が割り当てられています（{span(di)}）"
+            elif kind == 1:
+                msg = f"🚨 **{staff_list[si]}**: 遅番の翌日にF勤務が割り当てられています（{span(di)}）"
+            else:
+                msg = f"🚨 **{staff_list[si]}**: F勤務の翌日に早番が割り当てられています（{di+1}日〜{di+2}日）"
+            pattern_msgs.setdefault(int(si), []).append((int(di), kind, msg))
+
+    hol_checks = [
+        (total_off != exp_total, lambda si: f"⚠️ **{staff_list[si]}**: 休日合計が一致しません（目標: {exp_total[si]}日、手動修正後: {total_off[si]}日）"),
+        (n_off != exp_off, lambda si: f"⚠️ **{staff_list[si]}**: 公休「休」の数が設定と異なります（目標公休: {exp_off[si]}日、手動修正後: {n_off[si]}日）"),
+        (n_cho != exp_cho, lambda si: f"⚠️ **{staff_list[si]}**: 調整休「調」の数が設定と異なります（目標調整休: {exp_cho[si]}日、手動修正後: {n_cho[si]}日）"),
+        (n_nen != exp_nen, lambda si: f"⚠️ **{staff_list[si]}**: 年休「年」の数が期待値と異なります（目標年休: {exp_nen[si]}日、手動修正後: {n_nen[si]}日）"),
+    ]
+    over_cons = max_consecutive >= 5
+    over_36 = final_overtime > 2700
+    flagged = np.zeros(total, dtype=bool)
+    for mask, _ in hol_checks:
+        flagged |= mask
+    flagged |= over_cons | over_36
+    flagged[list(pattern_msgs)] = True
+
+    alerts = []
+    for si in np.flatnonzero(flagged).tolist():
+        for mask, fmt in hol_checks:
+            if mask[si]:
+                alerts.append(fmt(si))
+        if over_cons[si]:
+            alerts.append(f"🚨 **{staff_list[si]}**: **{max_consecutive[si]}連勤**が発生しています（上限4連勤のルール違反）")
+        alerts.extend(msg for _, _, msg in sorted(pattern_msgs.get(si, [])))
+        if over_36[si]:
+            alerts.append(f"⚠️ **36協定アラート**: **{staff_list[si]}**の精算後超過勤務が45時間を超過しています（{format_minutes_to_hhmm(int(final_overtime[si]))}）")
+
+    stats = pd.DataFrame({
+        "休の総数": total_off,
+        "年休数(希望)": n_nen,
+        "設定公休": n_off,
+        "調整休日(調)数": n_cho,
+        "総超過(前)": [format_minutes_to_hhmm(int(v)) for v in overtime],
+        "精算後超過": [format_minutes_to_hhmm(int(v)) for v in final_overtime],
+    }, index=list(staff_list[:total]))
+    return {
+        "alerts": alerts,
+        "stats": stats,
+        "consecutive_rules_broken": int(over_cons.sum()),
+        "pattern_rules_broken": int(late_early.sum() + f_after_late.sum() + f_before_early.sum()),
+        "hols_mismatch_count": int(sum(int(mask.sum()) for mask, _ in hol_checks)),
+        "overtime_limits_exceeded": int(over_36.sum()),
+        "overtime": overtime,
+        "final_overtime": final_overtime,
+    }
+
+
+# --- 求解前の矛盾検出（CP モデルを作らずに数え上げと二部マッチングで判定） ---
+# "error" はモデルのハード制約同士が衝突し、そのまま求解しても解が見つからないもの。
+# "warning" は求解はできるが、担務の欠員・休日数の調整・連勤などの緩和（減点）が避けられないもの。
+PRECHECK_LEVELS = ("error", "warning")
+
+
+def _max_matching(candidates):
+    # candidates[k] = 担務 k に就けるスタッフ番号の列。増加路法で最大マッチングを求め、埋まらない担務を返す
+    match = {}
+
+    def assign(k, seen):
+        for s in candidates[k]:
+            if s in seen:
+                continue
+            seen.add(s)
+            if s not in match or assign(match[s], seen):
+                match[s] = k
+                return True
+        return False
+
+    return [k for k in range(len(candidates)) if not assign(k, set())]
+
+
+def precheck_inputs(problem, inputs=None):
+    if inputs is None:
+        inputs = compile_inputs(problem)
+    started = time.perf_counter()
+    staff_list = problem["staff_list"]
+    days_cols = problem["days_cols"]
+    n_days, total = inputs["n_days"], inputs["total"]
+    names = inputs["s_list_extended"]
+    n_types = inputs["num_types_extended"]
+    S_OFF, S_NIK = inputs["S_OFF"], inputs["S_NIK"]
+    req = inputs["request"]
+    skill = inputs["skill"]
+    closed = inputs["closed"]
+    sat_f = inputs["is_sat_f_day"]
+    issues = []
+
+    # 重大度 → 日 → スタッフの順に並べるため、並べ替えキーと組にして集める
+    def add(level, kind, s, d, message):
+        order = (PRECHECK_LEVELS.index(level), -1 if d is None else d, -1 if s is None else s)
+        issues.append((order, {"level": level, "kind": kind, "staff": None if s is None else staff_list[s],
+                               "day": None if d is None else days_cols[d], "message": message}))
+
+    shift_req = (req >= 1) & (req <= n_types)
+    sid0 = np.clip(req - 1, 0, n_types - 1)
+
+    # (1) × の担務への申し込み
+    rows, cols = np.nonzero(shift_req & (skill[np.arange(total)[:, None], sid0] == SKILL_NG))
+    for s, d in zip(rows.tolist(), cols.tolist()):
+        add("error", "request_banned", s, d, f"{staff_list[s]} が「×」（担当不可）の担務 {names[req[s, d] - 1]} を申し込んでいます")
+
+    # (2) 同じ日・同じ担務への重複申し込み（各担務は1日ちょうど1名）
+    for i in range(n_types):
+        hits = shift_req & (req == i + 1)
+        for d in np.flatnonzero(hits.sum(axis=0) > 1).tolist():
+            who = [staff_list[s] for s in np.flatnonzero(hits[:, d]).tolist()]
+            add("error", "request_duplicate", None, d, f"担務 {names[i]} を {len(who)} 名が申し込んでいます（{'・'.join(who)}）")
+
+    # (3) 閉じている担務への申し込み（土曜 F 運用日以外の F）と、土曜 F 運用日の F と C・D の同時申し込み
+    rows, cols = np.nonzero(shift_req & closed[np.arange(n_days)[None, :], sid0])
+    for s, d in zip(rows.tolist(), cols.tolist()):
+        add("error", "request_closed", s, d, f"{staff_list[s]} がこの日に運用しない担務 {names[req[s, d] - 1]} を申し込んでいます")
+    f_code = None
+    if inputs["has_C_and_D"]:
+        f_code = n_types
+        cd_codes = [names.index("C") + 1, names.index("D") + 1]
+        for d in np.flatnonzero(sat_f).tolist():
+            if (req[:, d] == f_code).any() and np.isin(req[:, d], cd_codes).any():
+                add("error", "request_f_cd", None, d, "F と C・D が同じ土曜日に申し込まれています（F 運用日は F か C・D のどちらか一方）")
+
+    # (4) 遷移の禁止（前月末日の遅 → 1日の早・F、F の翌日の早、遅の翌日の F）
+    is_early_req = np.isin(req, inputs["E_IDS"])
+    is_late_req = np.isin(req, inputs["L_IDS"])
+    for s in np.flatnonzero(inputs["prev_last_late"] & is_early_req[:, 0]).tolist():
+        add("error", "transition", s, 0, f"{staff_list[s]} は前月末日が「遅」のため 1日の早番（{names[req[s, 0] - 1]}）に就けません")
+    if f_code is not None:
+        is_f_req = req == f_code
+        for s in np.flatnonzero(inputs["prev_last_late"] & is_f_req[:, 0]).tolist():
+            add("error", "transition", s, 0, f"{staff_list[s]} は前月末日が「遅」のため 1日の F に就けません")
+        rows, cols = np.nonzero(is_f_req[:, :-1] & is_early_req[:, 1:])
+        for s, d in zip(rows.tolist(), cols.tolist()):
+            add("error", "transition", s, d + 1, f"{staff_list[s]} の F（{days_cols[d]}）の翌日に早番が申し込まれています")
+        rows, cols = np.nonzero(is_late_req[:, :-1] & is_f_req[:, 1:])
+        for s, d in zip(rows.tolist(), cols.tolist()):
+            add("error", "transition", s, d + 1, f"{staff_list[s]} の遅番（{days_cols[d]}）の翌日に F が申し込まれています")
+
+    # (5) 日ごとの担務充足：申し込みで埋まっていないスタッフ（または同じ担務を申し込んだスタッフ）と担務の最大マッチング
+    # 土曜 F 運用日は「F を置く」「C・D を置く」のうち欠員が少ない方で判定する
+    free = req == REQ_NONE
+    for d in range(n_days):
+        avail = [np.flatnonzero((skill[:, i] != SKILL_NG) & (free[:, d] | (req[:, d] == i + 1))).tolist() for i in range(n_types)]
+        open_ids = [i for i in range(n_types) if not closed[d, i]]
+        variants = [open_ids]
+        if sat_f[d] and f_code is not None:
+            cd = (names.index("C"), names.index("D"))
+            variants = [[i for i in open_ids if i != f_code - 1], [i for i in open_ids if i not in cd]]
+        best = min(([v[k] for k in _max_matching([avail[i] for i in v])] for v in variants), key=len)
+        if best:
+            add("warning", "coverage", None, d,
+                f"出勤可能なスタッフが足りず、担務 {'・'.join(names[i] for i in best)} が欠員になります（申し込み・スキル×を考慮）")
+
+    # (6) 休日目標：休の総数と公休分の大小、勤務の申し込みを除いた日数への収まり、平日数と調整休
+    hols = problem["tables"]["hols"].to_numpy()[:total, :2].astype(np.int64)
+    work_req = shift_req | (req == S_NIK)
+    target = inputs["kokyu"] + inputs["expected_cho"]
+    room = n_days - work_req.sum(axis=1)
+    weekdays_free = ((inputs["weekday"] < 5)[None, :] & ~work_req).sum(axis=1)
+    for s in range(total):
+        if hols[s, 0] < hols[s, 1]:
+            add("warning", "holiday_target", s, None, f"{staff_list[s]} の休の総数（{hols[s, 0]}）が公休分（{hols[s, 1]}）より少なく、調整休は 0 日として扱います")
+        if hols[s, 0] < 0 or hols[s, 1] < 0:
+            add("warning", "holiday_target", s, None, f"{staff_list[s]} の休日設定に負の値があります")
+        elif max(hols[s, 0], hols[s, 1]) > n_days:
+            add("warning", "holiday_target", s, None, f"{staff_list[s]} の休日目標（{max(hols[s, 0], hols[s, 1])} 日）が今月の日数（{n_days} 日）を超えています")
+        elif target[s] + inputs["expected_nen"][s] > room[s]:
+            add("warning", "holiday_target", s, None,
+                f"{staff_list[s]} の休日目標（{target[s] + inputs['expected_nen'][s]} 日）が、勤務の申し込み {int(work_req[s].sum())} 日を除いた {room[s]} 日に収まりません")
+        elif inputs["expected_cho"][s] > weekdays_free[s]:
+            add("warning", "holiday_target", s, None,
+                f"{staff_list[s]} の調整休（{inputs['expected_cho'][s]} 日）を置ける平日が {weekdays_free[s]} 日しかありません（調整休は土日に置けません）")
+
+    # (7) 申し込みだけで確定する5連勤以上（前月末4日を含む）
+    pinned = np.concatenate([inputs["prev_work"].astype(bool), work_req], axis=1)
+    runs = max_run_length(pinned)
+    for s in np.flatnonzero(runs >= 5).tolist():
+        add("warning", "consecutive", s, None, f"{staff_list[s]} は前月末と勤務の申し込みだけで {runs[s]} 連勤になります（上限4連勤）")
+
+    issues = [issue for _, issue in sorted(issues, key=lambda t: t[0])]
+    return {
+        "issues": issues,
+        "errors": sum(1 for x in issues if x["level"] == "error"),
+        "warnings": sum(1 for x in issues if x["level"] == "warning"),
+        "elapsed": time.perf_counter() - started,
+    }
+
+
+# --- 勤務表の Excel 書き出し ---
+# 書き込み専用（ストリーミング）モードで行を順に出力し、色分けはセルごとのスタイルではなく
+# シート単位の条件付き書式で表す。sheets は (シート名, DataFrame[, 早番グループ]) の列で、
+# 複数月・複数ユニットを1冊にまとめられる。
+# 色は (勤務記号, 背景色, 文字色, 太字)。どれにも当たらないセルは通常勤務色。
+ROSTER_COLORS = [
+    ("休", "FFCCCC", None, False),
+    ("調", "FFCC99", "7A3E00", True),
+    ("年", "FFB3D9", "8A004B", True),
+    ("日", "E0F0FF", None, False),
+]
+ROSTER_EARLY_COLOR = "FFFFCC"
+ROSTER_F_COLOR = ("E8D7FF", "4A148C", True)
+ROSTER_WORK_COLOR = "CCFFCC"
+
+
+def _excel_sheet_title(name, used):
+    base = re.sub(r"[\[\]:*?/\\]", "_", str(name))[:31] or "Sheet"
+    title, k = base, 1
+    while title in used:
+        k += 1
+        suffix = f"_{k}"
+        title = base[:31 - len(suffix)] + suffix
+    used.add(title)
+    return title
+
+
+def _excel_value(v):
+    if isinstance(v, np.generic):
+        v = v.item()
+    return None if v is None or (isinstance(v, float) and np.isnan(v)) else v
+
+
+def _roster_rules(ws, cell_range, top_left, early_gr):
+    def fill(color):
+        return PatternFill(fill_type="solid", start_color=color, end_color=color)
+
+    def font(color, bold):
+        return Font(color=color, bold=bold) if color or bold else None
+
+    for char, bg, fg, bold in ROSTER_COLORS:
+        ws.conditional_formatting.add(cell_range, CellIsRule(operator="equal", formula=[f'"{char}"'], fill=fill(bg), font=font(fg, bold), stopIfTrue=True))
+    if early_gr:
+        cond = ",".join(f'{top_left}="{e}"' for e in early_gr)
+        ws.conditional_formatting.add(cell_range, FormulaRule(formula=[f"OR({cond})"], fill=fill(ROSTER_EARLY_COLOR), stopIfTrue=True))
+    bg, fg, bold = ROSTER_F_COLOR
+    ws.conditional_formatting.add(cell_range, CellIsRule(operator="equal", formula=['"F"'], fill=fill(bg), font=font(fg, bold), stopIfTrue=True))
+    ws.conditional_formatting.add(cell_range, FormulaRule(formula=["TRUE"], fill=fill(ROSTER_WORK_COLOR), stopIfTrue=True))
+
+
+def roster_workbook(sheets, early_gr=()):
+    if openpyxl is None:
+        raise RuntimeError("Excel 書き出しには openpyxl が必要です")
+    wb = openpyxl.Workbook(write_only=True)
+    used = set()
+    for name, df, *sheet_early in sheets:
+        ws = wb.create_sheet(_excel_sheet_title(name, used))
+        ws.append([None] + [_excel_value(c) for c in df.columns])
+        values = df.astype(object).to_numpy()
+        for label, row in zip(df.index, values):
+            ws.append([_excel_value(label)] + [_excel_value(v) for v in row])
+        if len(df.index) and len(df.columns):
+            last = f"{get_column_letter(len(df.columns) + 1)}{len(df.index) + 1}"
+            _roster_rules(ws, f"B2:{last}", "B2", sheet_early[0] if sheet_early else early_gr)
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+# --- 辞書式（段階的）最適化の優先段 ---
+# 単一の重み付き和では係数が 100〜数億と桁違いに混在し LP 上界が弱くなるため、
+# 上位の段から順に最適化してその値を下限として固定し、次の段へ進む。
+OBJECTIVE_TIERS = [
+    ("coverage", "担務充足・教育同行"),
+    ("rules", "勤務ルール（遅→早・連勤・管理職・日勤）"),
+    ("holidays", "休日数・働き溜め"),
+    ("rhythm", "リズム・公平性"),
+]
+# 制限時間の各段への配分比
+LEXICOGRAPHIC_SPLIT = {"coverage": 0.2, "rules": 0.3, "holidays": 0.2, "rhythm": 0.3}
+
+
+# --- 構築計測：工程ごとの所要時間と、制約ファミリーごとの制約数・変数数 ---
+# mark(family) は前回の mark 以降に追加された制約・変数をそのファミリーへ計上する。
+class BuildStats:
+    def __init__(self, model):
+        self.proto = model.Proto()
+        self.phases = {}
+        self.families = {}
+        self._t = time.perf_counter()
+        self._n = (len(self.proto.constraints), len(self.proto.variables))
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._t)
+        self._t = now
+
+    def mark(self, family):
+        n = (len(self.proto.constraints), len(self.proto.variables))
+        f = self.families.setdefault(family, {"constraints": 0, "variables": 0})
+        f["constraints"] += n[0] - self._n[0]
+        f["variables"] += n[1] - self._n[1]
+        self._n = n
+
+    def as_dict(self):
+        return {"phases": {k: round(v, 6) for k, v in self.phases.items()}, "families": {k: dict(v) for k, v in self.families.items()}}
+
+
+# --- 入れ替え可能なスタッフ（対称性）の検出 ---
+# モデルがスタッフごとに参照する入力（管理職区分・スキル行・申し込み行・前月末引継ぎ・休日目標・
+# 累積担当回数・働き溜め残高・翌月冒頭の申し込み）がすべて一致するスタッフは、勤務列を入れ替えても
+# 実行可能性も目的値も変わらない。2名以上の同値類をスタッフ番号の昇順で返す。
+def interchangeable_staff(inputs):
+    classes = {}
+    for s in range(inputs["total"]):
+        key = (
+            s < inputs["n_mgr"],
+            inputs["skill"][s].tobytes(),
+            inputs["request"][s].tobytes(),
+            inputs["prev_work"][s].tobytes(),
+            bool(inputs["prev_last_late"][s]),
+            int(inputs["kokyu"][s]),
+            int(inputs["expected_cho"][s]),
+            int(inputs["expected_nen"][s]),
+            inputs["carry_counts"][s].tobytes(),
+            int(inputs["carry_bank"][s]),
+            inputs["next_work"][s].tobytes(),
+            bool(inputs["next_early"][s]),
+        )
+        classes.setdefault(key, []).append(s)
+    return [members for members in classes.values() if len(members) > 1]
+
+
+# --- CP-SAT モデルの構築 ---
+def build_model(problem, strategy_mode=STRATEGY_MODES[0], weights=None, inputs=None, model_options=None):
+    build_started = time.perf_counter()
+    w = dict(DEFAULT_WEIGHTS)
+    w.update(weights or {})
+    opts = dict(DEFAULT_MODEL_OPTIONS)
+    opts.update(model_options or {})
+    current_w_h_rule, current_w_rhythm, current_w_fair = strategy_weights(strategy_mode, w["w_h_rule"], w["w_mixing"], w["w_fair"])
+
+    if inputs is None:
+        inputs = compile_inputs(problem)
+    input_sync_time = time.perf_counter() - build_started
+    n_days, total, n_mgr = inputs["n_days"], inputs["total"], inputs["n_mgr"]
+    s_list_extended = inputs["s_list_extended"]
+    has_C_and_D = inputs["has_C_and_D"]
+    num_types_extended = inputs["num_types_extended"]
+    S_OFF, S_NIK, S_CHO, S_NEN = inputs["S_OFF"], inputs["S_NIK"], inputs["S_CHO"], inputs["S_NEN"]
+    E_IDS, L_IDS = inputs["E_IDS"], inputs["L_IDS"]
+    skill = inputs["skill"]
+    req_code = inputs["request"]
+    weekday = inputs["weekday"]
+    closed = inputs["closed"]
+    overtime_min = inputs["overtime_min"]
+
+    # 担務ごとの熟練者・見習い者リスト（日に依存しないため1回だけ算出）
+    skilled_by_shift = [np.flatnonzero(skill[:, i] == SKILL_OK).tolist() for i in range(num_types_extended)]
+    trainee_by_shift = [np.flatnonzero(skill[:, i] == SKILL_TRAINEE).tolist() for i in range(num_types_extended)]
+
+    model = cp_model.CpModel()
+    stats = BuildStats(model)
+    stats.phases["input_sync"] = input_sync_time
+
+    x = {(s, d, i): model.NewBoolVar(f'x_{s}_{d}_{i}') for s in range(total) for d in range(n_days) for i in range(num_types_extended + 4)}
+    score_objs = []
+    # 辞書式（段階的）最適化用に、各評価項を優先段ごとにも振り分けておく
+    tier_objs = {tier: [] for tier, _ in OBJECTIVE_TIERS}
+
+    def add_score(tier, term):
+        score_objs.append(term)
+        tier_objs[tier].append(term)
+
+    # 説明モードでは、ハード制約をグループ（キー）ごとの仮定リテラルで有効化する
+    hard_groups = {}
+
+    def hard(ct, *key):
+        if opts["hard_constraints"] != "assumptions":
+            return ct
+        if key not in hard_groups:
+            hard_groups[key] = model.NewBoolVar("hard_" + "_".join(str(k) for k in key))
+        ct.OnlyEnforceIf(hard_groups[key])
+        return ct
+    stats.mark("assignment")
+    stats.lap("variables")
+
+    for s in np.flatnonzero(inputs["prev_last_late"]).tolist():
+        for ei in E_IDS: hard(model.Add(x[s, 0, ei] == 0), "transition", s, 0, "late_early")
+    stats.mark("transitions")
+
+    # --- 教育同行（見習いに熟練者が付く）判定 ---
+    # shared: has_mentor => 熟練者の誰かが何らかの担務に就く、を日×熟練者集合ごとに1本だけ張る。
+    # has_mentor を偽にすると見習い側で no_vet を立てるしかなく減点されるため、等価性は不要。
+    mentor_cache = {}
+
+    def add_mentor_rule(d, i, s_t, sid, no_vet_var):
+        mentors = skilled_by_shift[i]
+        if opts["mentor_coverage"] == "inline":
+            eligible_mentors_on_duty = sum(x[s, d, other_sid] for s in mentors for other_sid in range(1, num_types_extended+1))
+            model.Add(eligible_mentors_on_duty + no_vet_var >= 1).OnlyEnforceIf(x[s_t, d, sid])
+            return
+        key = (d, tuple(mentors))
+        if key not in mentor_cache:
+            has_mentor = model.NewBoolVar(f'has_mentor_{d}_{i}')
+            model.AddBoolOr([x[s, d, other_sid] for s in mentors for other_sid in range(1, num_types_extended+1)]).OnlyEnforceIf(has_mentor)
+            mentor_cache[key] = has_mentor
+        model.AddBoolOr([mentor_cache[key], no_vet_var]).OnlyEnforceIf(x[s_t, d, sid])
+
+    for d in range(n_days):
+        wd = int(weekday[d])
+        sat_f_day = bool(inputs["is_sat_f_day"][d])
+
+        use_F_var = None
+        if sat_f_day:
+            use_F_var = model.NewBoolVar(f'use_F_{d}')
+            add_score("rhythm", use_F_var * -1000)
+
+        for i, s_name in enumerate(s_list_extended):
+            sid = i + 1
+            is_excl = bool(closed[d, i])
+            skilled = skilled_by_shift[i]
+            trainee = trainee_by_shift[i]
+
+            s_sum = sum(x[s, d, sid] for s in skilled)
+            t_sum = sum(x[s, d, sid] for s in trainee)
+
+            if s_name in ["C", "D", "F"] and sat_f_day:
+                under_sat_var = model.NewIntVar(0, 1, f'under_sat_{d}_{sid}')
+                if s_name == "F":
+                    model.Add(s_sum + t_sum + under_sat_var == 1).OnlyEnforceIf(use_F_var)
+                    model.Add(s_sum + t_sum == 0).OnlyEnforceIf(use_F_var.Not())
+                else:
+                    hard(model.Add(s_sum + t_sum == 0), "saturday_cd", d, i).OnlyEnforceIf(use_F_var)
+                    if is_excl:
+                        hard(model.Add(s_sum + t_sum == 0), "closed", d, i).OnlyEnforceIf(use_F_var.Not())
+                    else:
+                        model.Add(s_sum + t_sum + under_sat_var == 1).OnlyEnforceIf(use_F_var.Not())
+                add_score("coverage", under_sat_var * -100000000)
+            else:
+                if is_excl:
+                    hard(model.Add(s_sum + t_sum == 0), "closed", d, i)
+                else:
+                    under_std_var = model.NewIntVar(0, 1, f'under_std_{d}_{sid}')
+                    model.Add(s_sum + t_sum + under_std_var == 1)
+                    add_score("coverage", under_std_var * -100000000)
+
+                stats.mark("coverage")
+                for s_t in trainee:
+                    no_vet_var = model.NewBoolVar(f'no_vet_{s_t}_{d}_{sid}')
+                    add_mentor_rule(d, i, s_t, sid, no_vet_var)
+                    add_score("coverage", no_vet_var * -50000000)
+                stats.mark("mentor")
+
+        stats.mark("coverage")
+        if sat_f_day:
+            for s_name in ["C", "D", "F"]:
+                i = s_list_extended.index(s_name)
+                sid = i + 1
+                for s_t in trainee_by_shift[i]:
+                    no_vet_var = model.NewBoolVar(f'no_vet_sat_{s_t}_{d}_{sid}')
+                    add_mentor_rule(d, i, s_t, sid, no_vet_var)
+                    add_score("coverage", no_vet_var * -50000000)
+            stats.mark("mentor")
+
+        for s in range(total): model.Add(sum(x[s, d, i] for i in range(num_types_extended+4)) == 1)
+        stats.mark("assignment")
+    stats.lap("coverage")
+
+    overtime_shortages = []
+    off_discrepancies = []
+    f_sid = s_list_extended.index("F") + 1 if has_C_and_D else None
+
+    for s in range(total):
+        is_early = [model.NewBoolVar(f'ie_{s}_{d}') for d in range(n_days)]
+        is_late = [model.NewBoolVar(f'il_{s}_{d}') for d in range(n_days)]
+        is_off = [model.NewBoolVar(f'io_{s}_{d}') for d in range(n_days)]
+        daily_overtime_exprs = []
+        stats.mark("channeling")
+
+        # --- Fシフト前後の遷移に関するハード制約定義 ---
+        if f_sid is not None:
+            # 1. 前月最終日（前月末日）が「遅」の場合、当月1日目の F を完全排除（禁止）
+            if inputs["prev_last_late"][s]:
+                hard(model.Add(x[s, 0, f_sid] == 0), "transition", s, 0, "late_f")
+
+            # 2. 月内の F の前後遷移制限（ハード制約）
+            for d in range(n_days):
+                # F の翌日(d+1) に 早番グループ を完全禁止
+                if d < n_days - 1:
+                    hard(model.Add(x[s, d, f_sid] + sum(x[s, d+1, ei] for ei in E_IDS) <= 1), "transition", s, d + 1, "f_early")
+                # F の前日(d-1) に 遅番グループ を完全禁止
+                if d > 0:
+                    hard(model.Add(sum(x[s, d-1, li] for li in L_IDS) + x[s, d, f_sid] <= 1), "transition", s, d, "late_f")
+            stats.mark("transitions")
+
+        banned_sids = (np.flatnonzero(skill[s] == SKILL_NG) + 1).tolist()
+        for d in range(n_days):
+            model.Add(is_off[d] == x[s, d, S_OFF] + x[s, d, S_CHO] + x[s, d, S_NEN])
+            model.Add(sum(x[s, d, i] for i in E_IDS) == 1).OnlyEnforceIf(is_early[d])
+            model.Add(sum(x[s, d, i] for i in E_IDS) == 0).OnlyEnforceIf(is_early[d].Not())
+            model.Add(sum(x[s, d, i] for i in L_IDS) == 1).OnlyEnforceIf(is_late[d])
+            model.Add(sum(x[s, d, i] for i in L_IDS) == 0).OnlyEnforceIf(is_late[d].Not())
+            stats.mark("channeling")
+
+            for sid in banned_sids: hard(model.Add(x[s, d, sid] == 0), "skill", s, sid)
+
+            # 申し込み（希望）の反映モデル
+            req = int(req_code[s, d])
+            if req == S_OFF:
+                hard(model.Add(x[s, d, S_OFF] + x[s, d, S_CHO] + x[s, d, S_NEN] == 1), "request", s, d)
+            elif req != REQ_NONE:
+                hard(model.Add(x[s, d, req] == 1), "request", s, d)
+
+            if req != S_OFF:
+                model.Add(x[s, d, S_NEN] == 0)
+            stats.mark("requests")
+
+            if d < n_days - 1:
+                not_le = model.NewBoolVar(f'nle_{s}_{d}')
+                model.Add(is_late[d] + is_early[d+1] <= 1).OnlyEnforceIf(not_le)
+                add_score("rules", not_le * 2000000 * current_w_h_rule)
+                stats.mark("transitions")
+
+            daily_overtime_exprs.append(sum(x[s, d, i+1] * int(overtime_min[d, i]) for i in range(num_types_extended) if overtime_min[d, i] > 0))
+
+        if opts["overtime_banking"] == "inline":
+            for d in range(n_days):
+                cum_overtime = int(inputs["carry_bank"][s]) + sum(daily_overtime_exprs[k] for k in range(d + 1))
+                cum_cho_count = sum(x[s, k, S_CHO] for k in range(d + 1))
+
+                shortage = model.NewIntVar(0, 10000, f'shortage_{s}_{d}')
+                model.Add(cum_overtime + shortage >= cum_cho_count * 445)
+                add_score("holidays", shortage * -1000)
+                overtime_shortages.append(shortage)
+        else:
+            # 働き溜め残高 bank[d] = 累積超過分 − 445 × 累積調整休数 を前日残高から連鎖させる
+            bank_start = int(inputs["carry_bank"][s])
+            bank_hi = bank_start
+            bank_prev = bank_start
+            for d in range(n_days):
+                bank_hi += int(max(0, overtime_min[d].max(initial=0)))
+                bank = model.NewIntVar(bank_start - 445 * (d + 1), bank_hi, f'bank_{s}_{d}')
+                model.Add(bank == bank_prev + daily_overtime_exprs[d] - x[s, d, S_CHO] * 445)
+                bank_prev = bank
+
+                shortage = model.NewIntVar(0, 10000, f'shortage_{s}_{d}')
+                model.Add(bank + shortage >= 0)
+                add_score("holidays", shortage * -1000)
+                overtime_shortages.append(shortage)
+
+        for d in np.flatnonzero(weekday >= 5).tolist():
+            model.Add(x[s, d, S_CHO] == 0)
+        stats.mark("overtime_banking")
+
+        hist_w = inputs["prev_work"][s].tolist() + [(1 - is_off[di]) for di in range(n_days)]
+        for st_i in range(len(hist_w) - 4):
+            nc = model.NewBoolVar(f'nc_{s}_{st_i}')
+            model.Add(sum(hist_w[st_i:st_i+5]) <= 4).OnlyEnforceIf(nc)
+            add_score("rules", nc * 1000000 * current_w_h_rule)
+        stats.mark("consecutive")
+
+        # 翌月冒頭の申し込み（勤務確定日）と月末をまたぐ 5連勤・遅→早 を先読みで回避する
+        next_work = inputs["next_work"][s]
+        for k in range(1, len(next_work) + 1):
+            if not next_work[:k].all() or 5 - k > n_days:
+                continue
+            nc_next = model.NewBoolVar(f'ncn_{s}_{k}')
+            model.Add(sum(1 - is_off[di] for di in range(n_days - (5 - k), n_days)) <= 4 - k).OnlyEnforceIf(nc_next)
+            add_score("rules", nc_next * 1000000 * current_w_h_rule)
+        stats.mark("consecutive")
+        if inputs["next_early"][s]:
+            nle_next = model.NewBoolVar(f'nlen_{s}')
+            model.Add(is_late[n_days - 1] == 0).OnlyEnforceIf(nle_next)
+            add_score("rules", nle_next * 2000000 * current_w_h_rule)
+        stats.mark("transitions")
+
+        for di in range(n_days - 1):
+            mix = model.NewBoolVar(f'mix_{s}_{di}')
+            model.AddBoolAnd([is_early[di], is_late[di+1]]).OnlyEnforceIf(mix)
+            add_score("rhythm", mix * 500 * current_w_rhythm)
+            if di < n_days - 2:
+                e_block = model.NewBoolVar(f'eb_{s}_{di}')
+                model.Add(is_early[di] + is_early[di+1] + is_early[di+2] - 2 <= e_block)
+                add_score("rhythm", e_block * -1000 * current_w_rhythm)
+        stats.mark("transitions")
+
+        if s < n_mgr:
+            for di in range(n_days):
+                if weekday[di] >= 5:
+                    m_o = model.NewBoolVar(f'mo_{s}_{di}')
+                    model.Add(is_off[di] == 1).OnlyEnforceIf(m_o)
+                    add_score("rhythm", m_o * 10000)
+                else:
+                    m_w = model.NewBoolVar(f'mw_{s}_{di}')
+                    model.Add(is_off[di] == 0).OnlyEnforceIf(m_w)
+                    add_score("rules", m_w * 500000)
+        else:
+            for di in np.flatnonzero(req_code[s] != S_NIK).tolist():
+                nik_var = x[s, di, S_NIK]
+                add_score("rules", nik_var * -10000000)
+        stats.mark("staff_rules")
+
+        # 新休日割当ルール
+        kokyu_val = int(inputs["kokyu"][s])
+        expected_cho = int(inputs["expected_cho"][s])
+        expected_nen = int(inputs["expected_nen"][s])
+
+        hard(model.Add(sum(x[s, d, S_NEN] for d in range(n_days)) == expected_nen), "nen", s)
+
+        off_slack_plus = model.NewIntVar(0, n_days, f'off_sp_{s}')
+        off_slack_minus = model.NewIntVar(0, n_days, f'off_sm_{s}')
+        model.Add(sum(x[s, d, S_OFF] for d in range(n_days)) + off_slack_plus - off_slack_minus == kokyu_val)
+        add_score("holidays", off_slack_plus * -10000000)
+        add_score("holidays", off_slack_minus * -10000000)
+        off_discrepancies.append((s, "公休数", off_slack_plus, off_slack_minus))
+
+        cho_slack_plus = model.NewIntVar(0, n_days, f'cho_sp_{s}')
+        cho_slack_minus = model.NewIntVar(0, n_days, f'cho_sm_{s}')
+        model.Add(sum(x[s, d, S_CHO] for d in range(n_days)) + cho_slack_plus - cho_slack_minus == expected_cho)
+        add_score("holidays", cho_slack_plus * -10000000)
+        add_score("holidays", cho_slack_minus * -10000000)
+        off_discrepancies.append((s, "調整休数", cho_slack_plus, cho_slack_minus))
+        stats.mark("holidays")
+    stats.lap("per_staff")
+
+    # --- 対称性除去：同値類の隣り合うスタッフ a < b で、日ごとの割当コード列を code[a] ≦ code[b]（辞書式）に制限 ---
+    # eq は「その日より前がすべて同じ勤務」を表し、成立している間だけその日の大小を強制する。
+    symmetry_classes = interchangeable_staff(inputs) if opts["symmetry"] == "lex" else []
+    num_codes = num_types_extended + 4
+    for members in symmetry_classes:
+        for a, b in zip(members, members[1:]):
+            eq = None
+            for d in range(n_days):
+                code_a = sum(j * x[a, d, j] for j in range(1, num_codes))
+                code_b = sum(j * x[b, d, j] for j in range(1, num_codes))
+                le = model.Add(code_a <= code_b)
+                if eq is not None:
+                    le.OnlyEnforceIf(eq)
+                if d == n_days - 1:
+                    break
+                same = model.NewBoolVar(f'sym_same_{a}_{b}_{d}')
+                model.Add(code_a == code_b).OnlyEnforceIf(same)
+                model.Add(code_a != code_b).OnlyEnforceIf(same.Not())
+                if eq is None:
+                    eq = same
+                    continue
+                eq_next = model.NewBoolVar(f'sym_eq_{a}_{b}_{d}')
+                model.AddBoolAnd([eq, same]).OnlyEnforceIf(eq_next)
+                model.AddBoolOr([eq.Not(), same.Not(), eq_next])
+                eq = eq_next
+    stats.mark("symmetry")
+    stats.lap("symmetry")
+
+    for i_sh in range(1, num_types_extended + 1):
+        # 前月までの累積担当回数を加えた通算回数で公平性を評価する
+        offsets = inputs["carry_counts"][:, i_sh - 1]
+        c_hi = n_days + int(offsets.max(initial=0))
+        counts = [model.NewIntVar(0, c_hi, f'sh_c{si}_{i_sh}') for si in range(total)]
+        for si in range(total): model.Add(counts[si] == int(offsets[si]) + sum(x[si, d, i_sh] for d in range(n_days)))
+        mx, mn = model.NewIntVar(0, c_hi, f'mx_{i_sh}'), model.NewIntVar(0, c_hi, f'mn_{i_sh}')
+        model.AddMaxEquality(mx, counts); model.AddMinEquality(mn, counts)
+        add_score("rhythm", (mx - mn) * -100 * current_w_fair)
+    stats.mark("fairness")
+    stats.lap("fairness")
+
+    objective = sum(score_objs)
+    model.Maximize(objective)
+    stats.lap("objective")
+
+    return {
+        "model": model,
+        "x": x,
+        "problem": problem,
+        "inputs": inputs,
+        "strategy_mode": strategy_mode,
+        "model_options": opts,
+        "s_list_extended": s_list_extended,
+        "num_codes": num_codes,
+        "id_char": code_chars(inputs),
+        "symmetry_classes": symmetry_classes,
+        "hard_groups": hard_groups,
+        "objective": objective,
+        "overtime_shortages": overtime_shortages,
+        "off_discrepancies": off_discrepancies,
+        "build_stats": stats.as_dict(),
+        "tier_terms": {tier: terms for tier, terms in tier_objs.items() if terms},
+    }
+
+
+def _has_field(ct, name):
+    if hasattr(ct, f"has_{name}"):
+        return getattr(ct, f"has_{name}")()
+    return ct.HasField(name)
+
+
+# --- モデル規模の集計（変数数・制約数・線形項数） ---
+def model_size(model):
+    proto = model.Proto()
+    n_terms = 0
+    n_literals = 0
+    for ct in proto.constraints:
+        # .linear 等の参照は未設定の制約をその種別に書き換えてしまうため、必ず存在確認してから読む
+        if _has_field(ct, "linear"):
+            n_terms += len(ct.linear.vars)
+        if _has_field(ct, "bool_or"):
+            n_literals += len(ct.bool_or.literals)
+        if _has_field(ct, "bool_and"):
+            n_literals += len(ct.bool_and.literals)
+    return {
+        "variables": len(proto.variables),
+        "constraints": len(proto.constraints),
+        "linear_terms": n_terms,
+        "bool_literals": n_literals,
+        "objective_terms": len(proto.objective.vars),
+    }
+
+
+# --- ソルバーの生成（パラメータ既定値は UI と同一） ---
+def make_solver(time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, params=None):
+    slv = cp_model.CpSolver()
+    slv.parameters.max_time_in_seconds = float(time_limit)
+    slv.parameters.num_search_workers = int(num_workers)
+    for name, value in (params or {}).items():
+        setattr(slv.parameters, name, value)
+    return slv
+
+
+# --- 変数値から勤務記号の行列（スタッフ×日）を復元する ---
+def decode_schedule_rows(built, value):
+    problem = built["problem"]
+    x = built["x"]
+    id_char = built["id_char"]
+    num_codes = built["num_codes"]
+    res_rows = []
+    for si in range(problem["total"]):
+        res_rows.append([id_char[next(j for j in range(num_codes) if value(x[si, di, j]) == 1)] for di in range(problem["n_days"])])
+    return res_rows
+
+
+# --- 求解結果から勤務表と制約緩和レポートを取り出す ---
+# --- CP-SAT 応答の統計（計測パネル・JSON 出力用） ---
+def solver_stats(slv, status):
+    r = slv.response_proto
+    ok = status in [cp_model.OPTIMAL, cp_model.FEASIBLE]
+    objective = slv.ObjectiveValue() if ok else None
+    bound = slv.BestObjectiveBound() if ok else None
+    return {
+        "status": slv.StatusName(status),
+        "wall_time": slv.WallTime(),
+        "user_time": slv.UserTime(),
+        "deterministic_time": r.deterministic_time,
+        "conflicts": slv.NumConflicts(),
+        "branches": slv.NumBranches(),
+        "restarts": r.num_restarts,
+        "lp_iterations": r.num_lp_iterations,
+        "booleans": r.num_booleans,
+        "objective": objective,
+        "best_bound": bound,
+        "gap": abs(bound - objective) / max(1.0, abs(bound)) if ok else None,
+        "solution_info": r.solution_info,
+        "num_workers": slv.parameters.num_search_workers,
+        "time_limit": slv.parameters.max_time_in_seconds,
+    }
+
+
+# 構築工程の時間・制約ファミリー別の内訳・モデル規模・ソルバー統計をまとめた計測レポート
+def instrumentation_report(built, slv, status, extraction_time=None):
+    build_stats = built.get("build_stats", {"phases": {}, "families": {}})
+    phases = dict(build_stats["phases"])
+    phases["solve"] = slv.WallTime()
+    if built.get("lexicographic"):
+        phases["solve"] = sum(t["wall_time"] for t in built["lexicographic"])
+    if extraction_time is not None:
+        phases["extraction"] = extraction_time
+    size = model_size(built["model"])
+    families = {k: dict(v) for k, v in build_stats["families"].items()}
+    # ヒント補完・近傍修復で構築後に追加された制約など
+    other_c = size["constraints"] - sum(f["constraints"] for f in families.values())
+    other_v = size["variables"] - sum(f["variables"] for f in families.values())
+    if other_c or other_v:
+        families["other"] = {"constraints": other_c, "variables": other_v}
+    report = {
+        "strategy_mode": built.get("strategy_mode"),
+        "staff": built["inputs"]["total"],
+        "days": built["inputs"]["n_days"],
+        "phases": {k: round(v, 6) for k, v in phases.items()},
+        "families": families,
+        "model_size": size,
+        "solver": solver_stats(slv, status),
+    }
+    if built.get("lexicographic"):
+        report["tiers"] = built["lexicographic"]
+    return report
+
+
+def extract_result(built, slv, status):
+    extract_started = time.perf_counter()
+    problem = built["problem"]
+    result = {
+        "status": slv.StatusName(status),
+        "ok": status in [cp_model.OPTIMAL, cp_model.FEASIBLE],
+        "schedule": None,
+        "relaxation_messages": [],
+        "objective": None,
+        "wall_time": slv.WallTime(),
+    }
+    if not result["ok"]:
+        result["instrumentation"] = instrumentation_report(built, slv, status, time.perf_counter() - extract_started)
+        return result
+
+    staff_list = problem["staff_list"]
+    relaxation_messages = []
+    for s_idx, off_type, sp, sm in built["off_discrepancies"]:
+        val_p = slv.Value(sp)
+        val_m = slv.Value(sm)
+        if val_p > 0:
+            relaxation_messages.append(f"⚠️ {staff_list[s_idx]}の{off_type}が、制約矛盾解消のため目標より **{val_p}日減少** して調整されました。")
+        if val_m > 0:
+            relaxation_messages.append(f"⚠️ {staff_list[s_idx]}の{off_type}が、制約矛盾解消のため目標より **{val_m}日増加** して調整されました。")
+
+    overtime_shortage_sum = sum(slv.Value(sh) for sh in built["overtime_shortages"])
+    if overtime_shortage_sum > 0:
+        relaxation_messages.append(f"⚠️ 働き溜め（超過勤務の累積時間）が不足しているスタッフの調整休（調）付与タイミングにおいて、計 **{overtime_shortage_sum}分相当のルール緩和** を実施しました。")
+
+    res_rows = decode_schedule_rows(built, slv.Value)
+    result["schedule"] = pd.DataFrame(res_rows, index=staff_list, columns=problem["days_cols"])
+    result["relaxation_messages"] = relaxation_messages
+    result["objective"] = slv.ObjectiveValue()
+    if built.get("lexicographic"):
+        # 段階的最適化では最終段の目的値ではなく、重み付き総和で他モードと比較できるようにする
+        result["objective"] = slv.Value(built["objective"])
+        result["tiers"] = built["lexicographic"]
+    if built.get("hint_cells"):
+        result["hint_report"] = hint_report(built, res_rows)
+    result["instrumentation"] = instrumentation_report(built, slv, status, time.perf_counter() - extract_started)
+    return result
+
+
+# --- 既存の勤務表を初期解ヒント（ウォームスタート）として与える ---
+# スタッフは名前で、日は列位置で対応付ける。未知の勤務記号や対応しない行・列は無視する。
+# complete=True の場合、勤務割当をスタッフ行単位で固定した複製モデルを短時間解いて
+# 補助変数（連勤・遷移・公平性など）まで含む完全な実行可能解をヒントにする。
+# 設定変更で成立しなくなった行は、固定できる行数を最大化する事前求解で特定して固定を外す。
+def add_schedule_hint(built, schedule_df, complete=True, complete_time_limit=5.0):
+    problem = built["problem"]
+    model = built["model"]
+    x = built["x"]
+    char_id = {c: j for j, c in built["id_char"].items()}
+    n_days = min(problem["n_days"], len(schedule_df.columns))
+    row_of = {name: pos for pos, name in enumerate(schedule_df.index)}
+    values = schedule_df.astype(object).to_numpy()
+    # 対称性除去ありのモデルでは、入れ替え可能なスタッフの行を辞書式の昇順に並べ替えてから与える
+    # （並べ替えても目的値は同じで、そのままでは順序制約に反するヒントになるため）
+    for members in built.get("symmetry_classes", []):
+        names = [problem["staff_list"][s] for s in members]
+        if not all(name in row_of for name in names):
+            continue
+        rows = [row_of[name] for name in names]
+        keys = {pos: [char_id.get(v, -1) for v in values[pos, :n_days]] for pos in rows}
+        for name, pos in zip(names, sorted(rows, key=keys.__getitem__)):
+            row_of[name] = pos
+
+    hint_cells = {}
+    for s, name in enumerate(problem["staff_list"]):
+        pos = row_of.get(name)
+        if pos is None:
+            continue
+        for d in range(n_days):
+            code = char_id.get(values[pos, d])
+            if code is not None:
+                hint_cells[s, d] = values[pos, d]
+    built["hint_cells"] = hint_cells
+
+    completion = _complete_hint(built, hint_cells, char_id, complete_time_limit) if complete and hint_cells else None
+    model.ClearHints()
+    if completion is not None:
+        for idx, val in enumerate(completion["values"]):
+            model.AddHint(model.GetIntVarFromProtoIndex(idx), val)
+        built["hint_released_staff"] = completion["released"]
+    else:
+        for (s, d), char in hint_cells.items():
+            code = char_id[char]
+            for j in range(built["num_codes"]):
+                model.AddHint(x[s, d, j], 1 if j == code else 0)
+        # 部分ヒントが矛盾していても探索を始められるよう修復を有効化
+        built.setdefault("solver_params", {})["repair_hint"] = True
+    return len(hint_cells)
+
+
+def _complete_hint(built, hint_cells, char_id, time_limit):
+    model = built["model"]
+    x = built["x"]
+    deadline = time.time() + time_limit
+    rows = sorted({s for s, _ in hint_cells})
+
+    def pin_rows(clone, staff_rows, lits=None):
+        for (s, d), char in hint_cells.items():
+            if s not in staff_rows:
+                continue
+            xv = clone.GetIntVarFromProtoIndex(x[s, d, char_id[char]].Index())
+            if lits is None:
+                clone.Add(xv == 1)
+            else:
+                clone.Add(xv == 1).OnlyEnforceIf(lits[s])
+
+    # 段階A: 固定したまま成立するスタッフ行の数を最大化（行ごとの固定リテラル）
+    stage_a = model.Clone()
+    row_lits = {s: stage_a.NewBoolVar(f'hint_row_{s}') for s in rows}
+    pin_rows(stage_a, set(rows), row_lits)
+    for (s, d), char in hint_cells.items():
+        stage_a.AddHint(stage_a.GetIntVarFromProtoIndex(x[s, d, char_id[char]].Index()), 1)
+    for lit in row_lits.values():
+        stage_a.AddHint(lit, 1)
+    stage_a.Maximize(sum(row_lits.values()))
+    slv = make_solver(max(0.1, (deadline - time.time()) / 2), 1)
+    status = slv.Solve(stage_a)
+    if status not in [cp_model.OPTIMAL, cp_model.FEASIBLE]:
+        return None
+    kept = {s for s, lit in row_lits.items() if slv.Value(lit)}
+
+    # 段階B: 残せる行を固定し、本来の目的関数で補助変数と解放行を最適化
+    stage_b = model.Clone()
+    pin_rows(stage_b, kept)
+    slv = make_solver(max(0.1, deadline - time.time()), 1)
+    status = slv.Solve(stage_b)
+    if status not in [cp_model.OPTIMAL, cp_model.FEASIBLE]:
+        return None
+    n_vars = len(model.Proto().variables)
+    return {
+        "values": [slv.Value(stage_b.GetIntVarFromProtoIndex(i)) for i in range(n_vars)],
+        "released": [s for s in rows if s not in kept],
+    }
+
+
+# --- ヒントへの追従度（ヒントを与えたセルのうち同じ勤務が残った割合） ---
+def hint_report(built, res_rows):
+    staff_list = built["problem"]["staff_list"]
+    hint_cells = built["hint_cells"]
+    changed = []
+    for (s, d), before in hint_cells.items():
+        after = res_rows[s][d]
+        if after != before:
+            changed.append({"staff": staff_list[s], "day": d + 1, "before": before, "after": after})
+    n_hinted = len(hint_cells)
+    kept = n_hinted - len(changed)
+    return {
+        "hinted_cells": n_hinted,
+        "kept_cells": kept,
+        "kept_ratio": kept / n_hinted if n_hinted else 0.0,
+        "changed": changed,
+        "released_staff": [staff_list[s] for s in built.get("hint_released_staff", [])],
+    }
+
+
+# --- 問題定義を1回求解する（構築→求解→抽出） ---
+def solve_problem(problem, strategy_mode=STRATEGY_MODES[0], weights=None, time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, model_options=None, hint_schedule=None, cache_dir=None):
+    sync_started = time.perf_counter()
+    inputs = compile_inputs(problem)
+    input_sync_time = time.perf_counter() - sync_started
+    # ヒント付きの求解は結果がヒントに依存するためキャッシュしない
+    cache_key = None
+    if cache_dir is not None and hint_schedule is None:
+        cache_key = solve_cache_key(problem, strategy_mode, weights, time_limit, num_workers, model_options, inputs=inputs)
+        cached = cache_get(cache_key, cache_dir)
+        if cached is not None:
+            return cached
+    built = build_model(problem, strategy_mode, weights, inputs=inputs, model_options=model_options)
+    built["build_stats"]["phases"]["input_sync"] = input_sync_time
+    if hint_schedule is not None:
+        add_schedule_hint(built, hint_schedule)
+    if built["model_options"]["objective"] == "lexicographic":
+        slv, status = solve_lexicographic(built, time_limit, num_workers)
+    else:
+        slv = make_solver(time_limit, num_workers, built.get("solver_params"))
+        status = slv.Solve(built["model"])
+    result = extract_result(built, slv, status)
+    if cache_key is not None:
+        cache_put(cache_key, result, cache_dir)
+    return result
+
+
+# --- 実行不能の説明（ハード制約グループを仮定リテラルの下に置き、矛盾する最小の組を特定） ---
+# 目的関数を外した実行可能性判定だけを行う。CP-SAT の SufficientAssumptionsForInfeasibility で得た組から
+# 1つずつ外して解き直し、外しても実行不能のままなら除く（削除法）ことで、どれを外しても解ける最小の組にする。
+def describe_hard_group(key, problem, inputs):
+    staff_list = problem["staff_list"]
+    days_cols = problem["days_cols"]
+    names = inputs["s_list_extended"]
+    kind = key[0]
+    if kind == "request":
+        _, s, d = key
+        req = int(inputs["request"][s, d])
+        label = code_chars(inputs).get(req, "休")
+        return {"kind": kind, "staff": staff_list[s], "day": days_cols[d], "message": f"{staff_list[s]} の {days_cols[d]} の申し込み「{label}」"}
+    if kind == "nen":
+        s = key[1]
+        n_req = int((inputs["request"][s] == inputs["S_OFF"]).sum())
+        return {"kind": kind, "staff": staff_list[s], "day": None,
+                "message": f"{staff_list[s]} の年休「年」の日数（希望休 {n_req} 日のうち {int(inputs['expected_nen'][s])} 日に固定）"}
+    if kind == "skill":
+        _, s, sid = key
+        return {"kind": kind, "staff": staff_list[s], "day": None, "message": f"{staff_list[s]} は担務 {names[sid - 1]} が「×」（担当不可）"}
+    if kind == "closed":
+        _, d, i = key
+        if names[i] == "F":
+            reason = "F は土曜 F 運用日のみ"
+        elif names[i] == "C" and inputs["weekday"][d] == 6:
+            reason = "日曜は C を置かない"
+        else:
+            reason = "不要担務の設定"
+        return {"kind": kind, "staff": None, "day": days_cols[d], "message": f"{days_cols[d]} は担務 {names[i]} を置かない（{reason}）"}
+    if kind == "saturday_cd":
+        _, d, i = key
+        return {"kind": kind, "staff": None, "day": days_cols[d], "message": f"{days_cols[d]} は F を置く場合 {names[i]} を置かない（土曜 F 運用）"}
+    if kind == "transition":
+        _, s, d, rule = key
+        prev = "前月末日" if d == 0 else days_cols[d - 1]
+        text = {
+            "late_early": f"{prev} の遅番の翌日（{days_cols[d]}）に早番を置かない",
+            "late_f": f"{prev} の遅番の翌日（{days_cols[d]}）に F を置かない",
+            "f_early": f"{prev} の F の翌日（{days_cols[d]}）に早番を置かない",
+        }[rule]
+        return {"kind": kind, "staff": staff_list[s], "day": days_cols[d], "message": f"{staff_list[s]}: {text}"}
+    return {"kind": kind, "staff": None, "day": None, "message": str(key)}
+
+
+def explain_infeasibility(problem, inputs=None, time_limit=30.0, minimize=True, model_options=None):
+    started = time.time()
+    if inputs is None:
+        inputs = compile_inputs(problem)
+    built = build_model(problem, inputs=inputs, model_options=dict(model_options or {}, hard_constraints="assumptions"))
+    model = built["model"]
+    model.ClearObjective()
+    key_of = {lit.Index(): key for key, lit in built["hard_groups"].items()}
+    lit_of = {lit.Index(): lit for lit in built["hard_groups"].values()}
+
+    def check(indices):
+        model.ClearAssumptions()
+        model.AddAssumptions([lit_of[i] for i in indices])
+        # 仮定リテラルからの矛盾抽出は単一ワーカーで行う。
+        # 目的関数がなく実行可能性だけを見るため、前処理と LP 緩和を省いた方が1回あたり数倍速い
+        slv = make_solver(max(0.1, time_limit - (time.time() - started)), 1, {"cp_model_presolve": False, "linearization_level": 0})
+        status = slv.Solve(model)
+        core = list(slv.SufficientAssumptionsForInfeasibility()) if status == cp_model.INFEASIBLE else None
+        return slv.StatusName(status), core
+
+    status, core = check(list(key_of))
+    result = {"status": status, "conflicts": [], "minimal": False, "checks": 1}
+    if core is None:
+        result["wall_time"] = time.time() - started
+        return result
+
+    core = [i for i in core if i in key_of]
+    minimal = minimize
+    k = 0
+    while minimize and k < len(core):
+        if time.time() - started >= time_limit:
+            minimal = False
+            break
+        trial = core[:k] + core[k + 1:]
+        status, sub = check(trial)
+        result["checks"] += 1
+        if sub is not None:
+            # 外しても実行不能 → 返ってきた（さらに小さいかもしれない）組で置き換え、同じ位置から続ける
+            core = [i for i in trial if i in set(sub)] or trial
+        elif status == "UNKNOWN":
+            minimal = False
+            k += 1
+        else:
+            k += 1
+    order = {key: n for n, key in enumerate(built["hard_groups"])}
+    keys = sorted((key_of[i] for i in core), key=order.__getitem__)
+    result.update({
+        "conflicts": [describe_hard_group(key, problem, inputs) for key in keys],
+        "minimal": minimal,
+        "wall_time": time.time() - started,
+    })
+    return result
+
+
+# --- 暫定解（インカンベント）の記録用コールバック ---
+# 解が更新されるたびに目的値・上界・経過時間と勤務表プレビューを保持する。
+# UI スレッドからは snapshot() で排他的に読み出す。
+class IncumbentRecorder(cp_model.CpSolverSolutionCallback):
+    def __init__(self, built, keep_preview=True):
+        super().__init__()
+        self.built = built
+        self.keep_preview = keep_preview
+        self.lock = threading.Lock()
+        self.incumbents = []
+        self.best_rows = None
+        # 目的値がこの値に達したら（それ以上改善しようがないため）探索を打ち切る
+        self.stop_at = None
+        # 段階的最適化の求解中の段（段ごとに目的が異なるため、スコアは段ごとに区別して表示する）
+        self.tier = None
+
+    def on_solution_callback(self):
+        entry = {
+            "objective": self.ObjectiveValue(),
+            "bound": self.BestObjectiveBound(),
+            "wall_time": self.WallTime(),
+            "tier": self.tier,
+        }
+        if self.stop_at is not None and entry["objective"] >= self.stop_at:
+            self.StopSearch()
+        rows = decode_schedule_rows(self.built, self.Value) if self.keep_preview else None
+        with self.lock:
+            self.incumbents.append(entry)
+            if rows is not None:
+                self.best_rows = rows
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.incumbents), self.best_rows
+
+
+# --- バックグラウンド求解ジョブ ---
+# 別スレッドで Solve を実行し、呼び出し側はジョブ辞書をポーリングする。
+# 中断（cancel_solve_job）しても、それまでの最良解は extract_result で取り出せる。
+def start_solve_job(built, time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, keep_preview=True):
+    slv = make_solver(time_limit, num_workers, built.get("solver_params"))
+    recorder = IncumbentRecorder(built, keep_preview)
+    job = {
+        "built": built,
+        "solver": slv,
+        "recorder": recorder,
+        "time_limit": float(time_limit),
+        "started_at": time.time(),
+        "status": None,
+        "error": None,
+        "cancelled": False,
+        "done": threading.Event(),
+    }
+
+    def run():
+        try:
+            job["status"] = slv.Solve(built["model"], recorder)
+        except Exception as e:
+            job["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            job["done"].set()
+
+    job["thread"] = threading.Thread(target=run, name="roster-solve", daemon=True)
+    job["thread"].start()
+    return job
+
+
+def cancel_solve_job(job):
+    job["cancelled"] = True
+    if "service_url" in job:
+        _cancel_service_job(job)
+        return
+    job["solver"].StopSearch()
+
+
+def solve_job_snapshot(job):
+    if "service_url" in job:
+        return _service_job_snapshot(job)
+    incumbents, best_rows = job["recorder"].snapshot()
+    return {
+        "running": not job["done"].is_set(),
+        "elapsed": time.time() - job["started_at"],
+        "time_limit": job["time_limit"],
+        "incumbents": incumbents,
+        "best_rows": best_rows,
+        "cancelled": job["cancelled"],
+        "tier": job.get("tier"),
+        "queue_position": None,
+    }
+
+
+def finish_solve_job(job):
+    if "service_url" in job:
+        return _finish_service_job(job)
+    job["done"].wait()
+    if job["error"] is not None:
+        raise RuntimeError(job["error"])
+    return extract_result(job["built"], job["solver"], job["status"])
+
+
+# --- 辞書式（段階的）最適化 ---
+# 各段の目的だけを最大化 → 得られた値を下限制約として固定 → 全変数の値を次段のヒントにする。
+# 目的の差し替え・下限制約・ヒントは built["model"] の複製に加え、呼び出し側のモデルは変更しない。
+# 各段の目的係数は最大公約数で割って小さくし、報告値は scaling_factor で元の単位に戻す。
+def _set_tier_objective(model, expr):
+    model.Maximize(expr)
+    obj = model.Proto().objective
+    g = 0
+    for c in obj.coeffs:
+        g = math.gcd(g, abs(int(c)))
+    if g > 1:
+        coeffs = [int(c) // g for c in obj.coeffs]
+        obj.coeffs.clear()
+        obj.coeffs.extend(coeffs)
+        obj.offset /= g
+        obj.scaling_factor *= g
+
+
+# 変数の定義域だけから求まる目的値の上限（減点項のみの段なら「違反ゼロ」の値）。
+# CP-SAT の上界は前処理の代入で緩むことがあるため、この値に達したら最適とみなして打ち切る。
+def _trivial_objective_max(model):
+    proto = model.Proto()
+    obj = proto.objective
+    inner = obj.offset
+    for v, c in zip(obj.vars, obj.coeffs):
+        # 負の参照は否定リテラル（1 − x）。proto の repeated は負の添字に対応しないため長さで末尾を取る
+        dom = proto.variables[v if v >= 0 else -v - 1].domain
+        lo, hi = dom[0], dom[len(dom) - 1]
+        if v < 0:
+            lo, hi = 1 - hi, 1 - lo
+        inner += min(c * lo, c * hi)
+    return obj.scaling_factor * inner
+
+
+def _hint_from_response(model, slv):
+    model.ClearHints()
+    hint = model.Proto().solution_hint
+    values = list(slv.response_proto.solution)
+    hint.vars.extend(range(len(values)))
+    hint.values.extend(values)
+
+
+def lexicographic_budgets(time_limit, split=None):
+    split = split or LEXICOGRAPHIC_SPLIT
+    return {tier: float(time_limit) * split.get(tier, 0.0) for tier, _ in OBJECTIVE_TIERS}
+
+
+def solve_lexicographic(built, time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, split=None, callback=None, job=None):
+    # 複製でも変数の添字は変わらないため、built の変数・式で値を読み出せる
+    model = built["model"].Clone()
+    budgets = lexicographic_budgets(time_limit, split)
+    if callback is None:
+        callback = IncumbentRecorder(built, keep_preview=False)
+    records = []
+    best_slv, best_status = None, None
+    last_slv, last_status = None, cp_model.UNKNOWN
+    all_optimal = True
+    built["lexicographic"] = records
+    spare = 0.0
+    used = 0.0
+    for tier, label in OBJECTIVE_TIERS:
+        terms = built["tier_terms"].get(tier)
+        if not terms or budgets[tier] <= 0:
+            spare += budgets[tier]
+            continue
+        if job is not None and job["cancelled"]:
+            break
+        expr = sum(terms)
+        _set_tier_objective(model, expr)
+        trivial_max = _trivial_objective_max(model)
+        callback.stop_at = trivial_max
+        callback.tier = label
+        # 前段が早く終わった（最適性を示せた）場合、余った時間を次段へ回す
+        tier_limit = min(budgets[tier] + spare, max(0.0, float(time_limit) - used))
+        if tier_limit <= 0:
+            break
+        slv = make_solver(tier_limit, num_workers, built.get("solver_params"))
+        if job is not None:
+            job["solver"] = slv
+            job["tier"] = label
+        used_before = used
+        status = slv.Solve(model, callback)
+        used += slv.WallTime()
+        if status == cp_model.UNKNOWN and best_slv is None and not (job is not None and job["cancelled"]):
+            # 配分時間内に実行可能解が1つも無い場合は、残り全体の時間でこの段を解き直す（以降の段は省略される）
+            tier_limit = max(0.0, float(time_limit) - used)
+            if tier_limit > 0:
+                slv = make_solver(tier_limit, num_workers, built.get("solver_params"))
+                if job is not None:
+                    job["solver"] = slv
+                status = slv.Solve(model, callback)
+                used += slv.WallTime()
+        last_slv, last_status = slv, status
+        ok = status in [cp_model.OPTIMAL, cp_model.FEASIBLE]
+        if ok and slv.ObjectiveValue() >= trivial_max:
+            status = cp_model.OPTIMAL
+        records.append({
+            "tier": tier,
+            "label": label,
+            "status": slv.StatusName(status),
+            "value": slv.Value(expr) if ok else None,
+            "bound": min(slv.BestObjectiveBound(), trivial_max) if ok else None,
+            "wall_time": used - used_before,
+            "time_limit": tier_limit,
+        })
+        spare = max(0.0, tier_limit - slv.WallTime())
+        if not ok:
+            # 前段の解はこの段の制約をすべて満たすため通常は起こらない。起きた場合は前段の解で打ち切る
+            all_optimal = False
+            break
+        all_optimal = all_optimal and status == cp_model.OPTIMAL
+        best_slv, best_status = slv, status
+        model.Add(expr >= int(slv.Value(expr)))
+        _hint_from_response(model, slv)
+    callback.stop_at = None
+    callback.tier = None
+    if best_slv is None:
+        # 第1段で解が得られなかった（実行不能・中断）場合はその状態をそのまま返す
+        return last_slv, last_status
+    return best_slv, cp_model.OPTIMAL if all_optimal and len(records) == len(built["tier_terms"]) else cp_model.FEASIBLE
+
+
+def start_lexicographic_job(built, time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, keep_preview=True, split=None):
+    recorder = IncumbentRecorder(built, keep_preview)
+    job = {
+        "built": built,
+        "solver": make_solver(time_limit, num_workers, built.get("solver_params")),
+        "recorder": recorder,
+        "time_limit": float(time_limit),
+        "started_at": time.time(),
+        "status": None,
+        "error": None,
+        "cancelled": False,
+        "tier": None,
+        "done": threading.Event(),
+    }
+
+    def run():
+        try:
+            slv, status = solve_lexicographic(built, time_limit, num_workers, split, callback=recorder, job=job)
+            if slv is not None:
+                job["solver"] = slv
+                job["status"] = status
+            else:
+                job["status"] = cp_model.UNKNOWN
+        except Exception as e:
+            job["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            job["done"].set()
+
+    job["thread"] = threading.Thread(target=run, name="roster-solve-lex", daemon=True)
+    job["thread"].start()
+    return job
+
+
+# --- 近傍修復モード：変更・違反セルの周辺だけを再最適化する ---
+# 中心セル（スタッフ×日の真偽行列）から、前後 day_radius 日 × 上下 staff_radius 行
+# （None なら全スタッフ）の窓を自由セルとし、それ以外は現在の勤務表に固定する。
+# full_rows で指定したスタッフ（休日数が合わなくなった編集行など）は行全体を自由にする。
+def repair_free_cells(centers, day_radius=2, staff_radius=None, full_rows=None):
+    total, n_days = centers.shape
+    free = np.zeros_like(centers, dtype=bool)
+    for s, d in zip(*np.nonzero(centers)):
+        d0, d1 = max(0, d - day_radius), min(n_days, d + day_radius + 1)
+        if staff_radius is None:
+            free[:, d0:d1] = True
+        else:
+            free[max(0, s - staff_radius):min(total, s + staff_radius + 1), d0:d1] = True
+    if full_rows is not None:
+        free[full_rows] = True
+    return free
+
+
+# 変更・新規違反セルと休日数が崩れた編集行から、修復の自由セルを決める
+def repair_window(inputs, base_df, edited_df, day_radius=2, staff_radius=None):
+    edited = schedule_codes(inputs, edited_df)
+    bad, row_bad = find_violation_cells(inputs, edited)
+    centers = bad.copy()
+    changed = np.zeros_like(bad)
+    if base_df is not None and base_df.shape == edited_df.shape:
+        base = schedule_codes(inputs, base_df)
+        changed = base != edited
+        base_bad, _ = find_violation_cells(inputs, base)
+        # 元の勤務表から引き継いだ違反（AI の制約緩和分など）は中心にしない
+        centers = (bad & ~base_bad) | changed
+    full_rows = row_bad & changed.any(axis=1)
+    return repair_free_cells(centers, day_radius, staff_radius, full_rows)
+
+
+def fix_outside_window(built, schedule_df, free, keep_current=True):
+    if built.get("symmetry_classes"):
+        # 現在の勤務のまま固定する行は対称性除去の順序制約と両立するとは限らない
+        raise ValueError("近傍修復は対称性除去（symmetry=\"lex\"）なしで構築したモデルにのみ適用できます")
+    model = built["model"]
+    x = built["x"]
+    codes = schedule_codes(built["inputs"], schedule_df)
+    # 窓の外は必ず現在の勤務に固定する。勤務記号として認識できないセルは固定しようがないため受け付けない
+    unknown = ~free & (codes < 0)
+    if unknown.any():
+        staff_list, days_cols = built["problem"]["staff_list"], built["problem"]["days_cols"]
+        cells = [f"{staff_list[s]} {days_cols[d]}" for s, d in zip(*np.nonzero(unknown))]
+        more = f" ほか {len(cells) - 5} 件" if len(cells) > 5 else ""
+        raise ValueError(f"修復範囲外に勤務記号として認識できないセルがあります（{'、'.join(cells[:5])}{more}）。修正するか修復範囲に含めてください")
+    n_fixed = 0
+    for s, d in zip(*np.nonzero(~free & (codes >= 0))):
+        model.Add(x[s, d, int(codes[s, d])] == 1)
+        n_fixed += 1
+    # 自由セルは現在の勤務をヒントとして与え、同じ勤務を保つと小さく加点して無用な入替えを抑える
+    keep_terms = []
+    for s, d in zip(*np.nonzero(free & (codes >= 0))):
+        code = int(codes[s, d])
+        for j in range(built["num_codes"]):
+            model.AddHint(x[s, d, j], 1 if j == code else 0)
+        keep_terms.append(x[s, d, code])
+    if keep_terms and keep_current:
+        # 維持ボーナスは同点解の選別にだけ使う。重み付き目的の差は必ず係数の最大公約数 g の倍数なので、
+        # 目的を scale 倍して scale·g を自由セル数より大きくすれば、全セル維持でもルール違反1件分に届かない
+        obj = model.Proto().objective
+        g = 0
+        for c in obj.coeffs:
+            g = math.gcd(g, abs(int(c)))
+        scale = len(keep_terms) // max(1, g) + 1
+        model.Maximize(scale * built["objective"] + sum(keep_terms))
+        # 報告される目的値は元の単位に戻す（維持ボーナス分は 1 / scale 倍で g 未満）
+        model.Proto().objective.scaling_factor /= scale
+    built.setdefault("solver_params", {})["repair_hint"] = True
+    built["repair"] = {"free_cells": int(free.sum()), "fixed_cells": n_fixed}
+    return built["repair"]
+
+
+# --- 求解結果キャッシュ（入力内容のハッシュをキーにしたディスク上の LRU） ---
+# 同じ設定・年月・祝日・戦略・ウェイト・ソルバー設定の求解は、前回の勤務表と緩和レポートを即座に返す。
+# キーは DataFrame の表記揺れ（NaN と False など）を吸収した compile_inputs() の配列から計算する。
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".solve_cache")
+CACHE_MAX_ENTRIES = 200
+CACHE_MAX_BYTES = 50 * 1024 * 1024
+CACHE_VERSION = 1
+
+
+def solve_cache_key(problem, strategy_mode=STRATEGY_MODES[0], weights=None, time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, model_options=None, inputs=None):
+    w = dict(DEFAULT_WEIGHTS)
+    w.update(weights or {})
+    opts = dict(DEFAULT_MODEL_OPTIONS)
+    opts.update(model_options or {})
+    if inputs is None:
+        inputs = compile_inputs(problem)
+    # 戦略による倍率適用後の実効ウェイトで比較する（同じ実効値なら同じ結果）
+    eff = strategy_weights(strategy_mode, w["w_h_rule"], w["w_mixing"], w["w_fair"])
+    header = {
+        "version": CACHE_VERSION,
+        "year": problem["year"],
+        "month": problem["month"],
+        "staff_list": list(problem["staff_list"]),
+        "days_cols": list(problem["days_cols"]),
+        "weights": [int(v) for v in eff] + [int(w["w_holiday"])],
+        "model_options": sorted(opts.items()),
+        "time_limit": float(time_limit),
+        "num_workers": int(num_workers),
+    }
+    h = hashlib.sha256()
+    for k in sorted(inputs):
+        v = inputs[k]
+        if isinstance(v, np.ndarray):
+            h.update(f"{k}:{v.dtype.str}:{v.shape}".encode())
+            h.update(np.ascontiguousarray(v).tobytes())
+        else:
+            header[f"inputs.{k}"] = v
+    h.update(json.dumps(header, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_path(key, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, f"{key}.json")
+
+
+def cache_get(key, cache_dir=None):
+    path = _cache_path(key, cache_dir)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # 参照時刻を更新して LRU の順序に反映する
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    sched = entry["schedule"]
+    return {
+        "status": entry["status"],
+        "ok": True,
+        "schedule": pd.DataFrame(sched["data"], index=sched["index"], columns=sched["columns"]),
+        "relaxation_messages": entry["relaxation_messages"],
+        "objective": entry["objective"],
+        "wall_time": entry["wall_time"],
+        "cached": True,
+    }
+
+
+def cache_put(key, result, cache_dir=None, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+    if not result.get("ok") or result.get("schedule") is None:
+        return
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = {
+        "status": result["status"],
+        "schedule": result["schedule"].to_dict(orient="split"),
+        "relaxation_messages": result["relaxation_messages"],
+        "objective": result["objective"],
+        "wall_time": result["wall_time"],
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    path = _cache_path(key, cache_dir)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    cache_evict(cache_dir, max_entries, max_bytes)
+
+
+def _cache_files(cache_dir):
+    files = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".json"):
+            continue
+        try:
+            info = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        files.append((info.st_mtime, info.st_size, name))
+    return files
+
+
+def cache_evict(cache_dir=None, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return 0
+    files = sorted(_cache_files(cache_dir))
+    used = sum(size for _, size, _ in files)
+    removed = 0
+    # 最終参照が古いものから、件数・容量の両方が上限以下になるまで削除
+    while files and (len(files) > max_entries or used > max_bytes):
+        _, size, name = files.pop(0)
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        used -= size
+        removed += 1
+    return removed
+
+
+def cache_stats(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return {"entries": 0, "bytes": 0}
+    files = _cache_files(cache_dir)
+    return {"entries": len(files), "bytes": sum(size for _, size, _ in files)}
+
+
+def cache_clear(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    return cache_evict(cache_dir, max_entries=0, max_bytes=0)
+
+
+# --- 勤務表の世代履歴（基準勤務表からのセル差分で保持し、ユニット×年月ごとにディスクへ永続化） ---
+# 各世代は基準（最初の世代、または表の形が変わった時点の勤務表）との差分セル（行・列・記号コード）のみを持つ。
+# 世代数・推定メモリ量の上限を超えたら古い世代から捨て、参照されなくなった基準も削除する。
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".roster_history")
+HISTORY_MAX_GENERATIONS = 200
+HISTORY_MAX_BYTES = 8 * 1024 * 1024
+HISTORY_VERSION = 1
+
+
+def history_unit_key(staff_list, s_list):
+    h = hashlib.sha256(json.dumps([list(staff_list), list(s_list)], ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def history_path(unit_key, year, month, history_dir=None):
+    return os.path.join(history_dir or HISTORY_DIR, f"{unit_key}_{int(year)}_{int(month):02d}.json")
+
+
+class RosterHistory:
+    def __init__(self, max_generations=HISTORY_MAX_GENERATIONS, max_bytes=HISTORY_MAX_BYTES, path=None):
+        self.max_generations = max_generations
+        self.max_bytes = max_bytes
+        self.path = path
+        self.vocab = []
+        self.bases = {}
+        self.generations = []
+        self._next_base = 0
+
+    def __len__(self):
+        return len(self.generations)
+
+    def _codes(self, values):
+        index = {v: k for k, v in enumerate(self.vocab)}
+        flat = ["" if v is None or (isinstance(v, float) and np.isnan(v)) else str(v) for v in values.ravel()]
+        for v in flat:
+            if v not in index:
+                index[v] = len(self.vocab)
+                self.vocab.append(v)
+        return np.array([index[v] for v in flat], dtype=np.int32).reshape(values.shape)
+
+    def _base_for(self, df):
+        if self.generations:
+            b = self.bases[self.generations[-1]["base"]]
+            if b["index"] == list(df.index) and b["columns"] == list(df.columns):
+                return self.generations[-1]["base"]
+        return None
+
+    # gen_id・created は他セッションの世代を取り込むとき（merge）に元の値を引き継ぐために渡す
+    def push(self, df, label, timestamp=None, gen_id=None, created=None):
+        codes = self._codes(df.astype(object).to_numpy())
+        base_id = self._base_for(df)
+        if base_id is None:
+            base_id = self._next_base
+            self._next_base += 1
+            self.bases[base_id] = {"index": list(df.index), "columns": list(df.columns), "codes": codes}
+        rows, cols = np.nonzero(codes != self.bases[base_id]["codes"])
+        if 3 * len(rows) > codes.size:
+            # 基準から大きく離れた（再作成などの）勤務表は、それ自体を新しい基準にする
+            base_id = self._next_base
+            self._next_base += 1
+            self.bases[base_id] = {"index": list(df.index), "columns": list(df.columns), "codes": codes}
+            rows, cols = np.nonzero(codes != codes)
+        gen = {
+            "id": gen_id or uuid.uuid4().hex,
+            "created": time.time() if created is None else float(created),
+            "timestamp": timestamp or datetime.datetime.now().strftime("%m/%d %H:%M:%S"),
+            "label": label,
+            "base": base_id,
+            "rows": rows.astype(np.int32),
+            "cols": cols.astype(np.int32),
+            "vals": codes[rows, cols].astype(np.int32),
+        }
+        last = self.generations[-1] if self.generations else None
+        if (last is not None and last["base"] == base_id and np.array_equal(last["rows"], gen["rows"])
+                and np.array_equal(last["cols"], gen["cols"]) and np.array_equal(last["vals"], gen["vals"])):
+            return False
+        self.generations.append(gen)
+        self._evict()
+        return True
+
+    def get(self, i):
+        gen = self.generations[i]
+        base = self.bases[gen["base"]]
+        codes = base["codes"].copy()
+        codes[gen["rows"], gen["cols"]] = gen["vals"]
+        vocab = np.array(self.vocab, dtype=object)
+        return pd.DataFrame(vocab[codes], index=base["index"], columns=base["columns"])
+
+    def latest(self):
+        return self.get(-1) if self.generations else None
+
+    def entries(self):
+        return [{"timestamp": g["timestamp"], "label": g["label"], "changed": int(len(g["rows"]))} for g in self.generations]
+
+    def nbytes(self):
+        total = sum(b["codes"].nbytes for b in self.bases.values())
+        total += sum(len(v.encode("utf-8")) + 8 for v in self.vocab)
+        return total + sum(g["rows"].nbytes + g["cols"].nbytes + g["vals"].nbytes for g in self.generations)
+
+    def _evict(self):
+        # 最新世代は常に残す
+        evicted = False
+        while len(self.generations) > 1 and (len(self.generations) > self.max_generations or self.nbytes() > self.max_bytes):
+            self.generations.pop(0)
+            evicted = True
+            used = {g["base"] for g in self.generations}
+            for b in [b for b in self.bases if b not in used]:
+                del self.bases[b]
+            self._compact_vocab()
+        return evicted
+
+    # どの基準・世代からも参照されなくなった記号を語彙から除き、コードを詰め直す
+    def _compact_vocab(self):
+        used = np.zeros(len(self.vocab), dtype=bool)
+        for b in self.bases.values():
+            used[b["codes"].ravel()] = True
+        for g in self.generations:
+            used[g["vals"]] = True
+        if used.all():
+            return
+        remap = np.cumsum(used, dtype=np.int32) - 1
+        self.vocab = [v for v, u in zip(self.vocab, used) if u]
+        for b in self.bases.values():
+            b["codes"] = remap[b["codes"]]
+        for g in self.generations:
+            g["vals"] = remap[g["vals"]]
+
+    # 他セッションが保存した世代を取り込み、作成時刻順に並べ直す（同じ id の世代は1つにまとめる）
+    def merge(self, other):
+        known = {g["id"] for g in self.generations}
+        if all(g["id"] in known for g in other.generations):
+            return False
+        items = {g["id"]: (g, other.get(i)) for i, g in enumerate(other.generations)}
+        items.update({g["id"]: (g, self.get(i)) for i, g in enumerate(self.generations)})
+        self.vocab, self.bases, self.generations, self._next_base = [], {}, [], 0
+        for g, df in sorted(items.values(), key=lambda item: item[0]["created"]):
+            self.push(df, g["label"], g["timestamp"], g["id"], g["created"])
+        return True
+
+    def to_dict(self):
+        return {
+            "version": HISTORY_VERSION,
+            "vocab": self.vocab,
+            "bases": {str(k): {"index": b["index"], "columns": b["columns"], "codes": b["codes"].tolist()} for k, b in self.bases.items()},
+            "generations": [
+                {"id": g["id"], "created": g["created"], "timestamp": g["timestamp"], "label": g["label"], "base": g["base"],
+                 "cells": np.stack([g["rows"], g["cols"], g["vals"]], axis=1).ravel().tolist()}
+                for g in self.generations
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        hist = cls(**kwargs)
+        if data.get("version") != HISTORY_VERSION:
+            return hist
+        hist.vocab = list(data["vocab"])
+        hist.bases = {
+            int(k): {"index": b["index"], "columns": b["columns"], "codes": np.array(b["codes"], dtype=np.int32).reshape(len(b["index"]), len(b["columns"]))}
+            for k, b in data["bases"].items()
+        }
+        hist._next_base = max(hist.bases, default=-1) + 1
+        for i, g in enumerate(data["generations"]):
+            cells = np.array(g["cells"], dtype=np.int32).reshape(-1, 3)
+            hist.generations.append({
+                # id・作成時刻のない旧形式の世代は、どのセッションが読んでも同じ値になるよう位置から決める
+                "id": g.get("id") or f"legacy-{i}", "created": float(g.get("created", i)),
+                "timestamp": g["timestamp"], "label": g["label"], "base": int(g["base"]),
+                "rows": cells[:, 0].copy(), "cols": cells[:, 1].copy(), "vals": cells[:, 2].copy(),
+            })
+        hist._evict()
+        return hist
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(path=path, **kwargs)
+        hist = cls.from_dict(data, **kwargs)
+        hist.path = path
+        return hist
+
+    # 同じユニット×年月を複数のセッションが編集していても世代を失わないよう、
+    # ロック下でディスク上の履歴を読み直して取り込んでから書き出す
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _history_lock(path):
+            on_disk = type(self).load(path, max_generations=self.max_generations, max_bytes=self.max_bytes)
+            self.merge(on_disk)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp, path)
+
+
+HISTORY_LOCK_TIMEOUT = 10.0
+HISTORY_LOCK_STALE = 30.0
+
+
+# --- 履歴ファイルの排他ロック（OS を問わず使えるよう、排他作成したロックファイルで表す） ---
+# 異常終了で残ったロックファイルは一定時間で古いものとみなして取り除く。
+@contextlib.contextmanager
+def _history_lock(path):
+    lock_path = f"{path}.lock"
+    deadline = time.time() + HISTORY_LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > HISTORY_LOCK_STALE:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"履歴ファイルのロックを取得できません: {lock_path}")
+            time.sleep(0.05)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+# --- 戦略ポートフォリオ：複数のウェイト設定を別プロセスで同時に求解して比較する ---
+def preset_candidates(weights=None):
+    return [{"label": mode, "strategy_mode": mode, "weights": dict(weights or {})} for mode in STRATEGY_MODES]
+
+
+def _portfolio_worker(problem, candidate, time_limit, num_workers, model_options):
+    result = solve_problem(
+        problem,
+        strategy_mode=candidate.get("strategy_mode", STRATEGY_MODES[0]),
+        weights=candidate.get("weights"),
+        time_limit=time_limit,
+        num_workers=num_workers,
+        model_options=model_options,
+    )
+    result["label"] = candidate["label"]
+    if result["ok"]:
+        inputs = compile_inputs(problem)
+        result["metrics"] = roster_metrics(inputs, schedule_codes(inputs, result["schedule"]))
+    return result
+
+
+def start_portfolio_job(problem, candidates, time_limit=DEFAULT_TIME_LIMIT, num_workers=None, model_options=None):
+    n = max(1, len(candidates))
+    if num_workers is None:
+        # 1スレッドの CP-SAT は LNS 等のサブソルバーが動かず初期解すら出にくいため、各候補は標準スレッド数で解く
+        num_workers = DEFAULT_NUM_WORKERS
+    # 合計スレッド数が CPU 数を超えないよう同時に解く候補数を絞り、残りは順番待ちにする
+    n_proc = max(1, min(n, (os.cpu_count() or 1) // max(1, num_workers)))
+    pool = ProcessPoolExecutor(max_workers=n_proc)
+    futures = [pool.submit(_portfolio_worker, problem, c, time_limit, num_workers, model_options) for c in candidates]
+    pool.shutdown(wait=False)
+    return {
+        "candidates": candidates,
+        "futures": futures,
+        "time_limit": float(time_limit),
+        # 候補数が同時実行数を超える場合は順に回るため、その分の所要時間を見込む
+        "expected_time": float(time_limit) * -(-n // n_proc),
+        "started_at": time.time(),
+    }
+
+
+def portfolio_done(job):
+    return all(f.done() for f in job["futures"])
+
+
+def portfolio_snapshot(job):
+    return {
+        "elapsed": time.time() - job["started_at"],
+        "time_limit": job["time_limit"],
+        "expected_time": job["expected_time"],
+        "total": len(job["futures"]),
+        "done": sum(1 for f in job["futures"] if f.done()),
+    }
+
+
+def portfolio_results(job):
+    results = []
+    for cand, fut in zip(job["candidates"], job["futures"]):
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append({"label": cand["label"], "status": "ERROR", "ok": False, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+def solve_portfolio(problem, candidates, time_limit=DEFAULT_TIME_LIMIT, num_workers=None, model_options=None):
+    job = start_portfolio_job(problem, candidates, time_limit, num_workers, model_options)
+    return portfolio_results(job)
+
+
+# --- 複数月の連続作成（前月末引継ぎ・累積公平性・働き溜め残高の自動繰越） ---
+# 各月を順に求解し、結果の末尾4日を翌月の「前月末引継ぎ」に、担当回数と働き溜め残高を
+# スタッフ名をキーに翌月へ繰り越す。lookahead=True なら翌月冒頭4日の申し込みを先読みし、
+# 月末をまたぐ連勤・遅→早を当月側で避ける。
+# month_configs に (年, 月) → 設定 JSON を渡すとその月の申し込み等を使い、無い月は
+# config のスタッフ・スキル・休日数設定で日付依存の表（申し込み・不要担務・指定日）を空にして作成する。
+DAY_TABLE_KEYS = ["request", "exclude", "designated"]
+
+
+def month_sequence(year, month, n_months):
+    out = []
+    for k in range(n_months):
+        y, m = divmod(month - 1 + k, 12)
+        out.append((year + y, m + 1))
+    return out
+
+
+def horizon_problem(config, year, month, month_configs=None, first=False):
+    month_cfg = (month_configs or {}).get((year, month))
+    if month_cfg is not None:
+        return load_problem(month_cfg, year, month)
+    problem = load_problem(config, year, month)
+    if not first:
+        layout = resolve_layout(config, year, month)
+        for key in DAY_TABLE_KEYS:
+            problem["tables"][key] = default_table(key, layout)[0]
+    return problem
+
+
+def carry_prev_table(problem, schedule_df):
+    # 前月の勤務記号を「前月末引継ぎ」表の区分（日・休・早・遅）へ変換する
+    off_chars = {"休", "調", "年"}
+    tail = schedule_df.iloc[:, -4:]
+    prev, _ = default_table("prev", problem)
+    for name in prev.index:
+        if name not in tail.index:
+            continue
+        for col, ch in zip(prev.columns, tail.loc[name].tolist()):
+            if ch in off_chars:
+                prev.loc[name, col] = "休"
+            elif ch in problem["early_gr"]:
+                prev.loc[name, col] = "早"
+            elif ch in problem["late_gr"] or ch == "F":
+                # F の翌日も早番を置けないため、翌日制限を引き継げる「遅」として扱う
+                # （翌日の F も禁止になるが、F は土曜のみで翌日曜は F を置かないため結果は変わらない）
+                prev.loc[name, col] = "遅"
+            else:
+                prev.loc[name, col] = "日"
+    return prev
+
+
+def roll_carry(problem, schedule_df, carry=None):
+    inputs = compile_inputs(problem)
+    codes = schedule_codes(inputs, schedule_df)
+    carry = carry or {}
+    shift_counts = {k: dict(v) for k, v in carry.get("shift_counts", {}).items()}
+    overtime_bank = dict(carry.get("overtime_bank", {}))
+    n_types = inputs["num_types_extended"]
+    shift = (codes >= 1) & (codes <= n_types)
+    ot = np.where(shift, inputs["overtime_min"][np.arange(inputs["n_days"])[None, :], np.clip(codes - 1, 0, n_types - 1)], 0)
+    month_bank = ot.sum(axis=1) - 445 * (codes == inputs["S_CHO"]).sum(axis=1)
+    for s, name in enumerate(problem["staff_list"][:inputs["total"]]):
+        counts = shift_counts.setdefault(name, {})
+        for i, s_name in enumerate(inputs["s_list_extended"]):
+            counts[s_name] = counts.get(s_name, 0) + int((codes[s] == i + 1).sum())
+        # 不足分は当月の緩和レポートで報告済みのため、繰り越すのは正の残高のみ
+        overtime_bank[name] = max(0, overtime_bank.get(name, 0) + int(month_bank[s]))
+    return {"shift_counts": shift_counts, "overtime_bank": overtime_bank}
+
+
+def solve_horizon(config, n_months, year=None, month=None, month_configs=None, strategy_mode=STRATEGY_MODES[0], weights=None,
+                  time_limit=DEFAULT_TIME_LIMIT, num_workers=DEFAULT_NUM_WORKERS, model_options=None, lookahead=True,
+                  cache_dir=None, on_month=None, should_stop=None, first_problem=None):
+    year = int(year if year is not None else config["year"])
+    month = int(month if month is not None else config["month"])
+    months = month_sequence(year, month, n_months)
+    # first_problem: 画面上で編集中の当月分など、組み立て済みの初月の問題定義
+    problems = {} if first_problem is None else {0: dict(first_problem, tables=dict(first_problem["tables"]))}
+
+    def get_problem(k):
+        if k not in problems:
+            y, m = months[k]
+            problems[k] = horizon_problem(config, y, m, month_configs, first=(k == 0))
+        return problems[k]
+
+    results = []
+    carry = {}
+    prev_schedule = None
+    for k, (y, m) in enumerate(months):
+        if should_stop is not None and should_stop():
+            break
+        problem = get_problem(k)
+        if prev_schedule is not None:
+            problem["tables"]["prev"] = carry_prev_table(problem, prev_schedule)
+        problem["carry"] = dict(carry)
+        if lookahead and k + 1 < len(months):
+            problem["carry"]["next_requests"] = get_problem(k + 1)["tables"]["request"].iloc[:, :4]
+        result = solve_problem(problem, strategy_mode, weights, time_limit, num_workers, model_options, cache_dir=cache_dir)
+        entry = {"year": y, "month": m, "problem": problem, "result": result}
+        results.append(entry)
+        if on_month is not None:
+            on_month(entry)
+        if not result["ok"]:
+            # 引継ぎ元が無いため以降の月は作成できない
+            break
+        carry = roll_carry(problem, result["schedule"], carry)
+        entry["carry"] = carry
+        prev_schedule = result["schedule"]
+    return results
+
+
+def start_horizon_job(config, n_months, **kwargs):
+    job = {
+        "n_months": n_months,
+        "months": [],
+        "done": threading.Event(),
+        "stop": threading.Event(),
+        "error": None,
+        "started_at": time.time(),
+    }
+
+    def _run():
+        try:
+            solve_horizon(config, n_months, on_month=job["months"].append, should_stop=job["stop"].is_set, **kwargs)
+        except Exception as e:
+            job["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            job["done"].set()
+
+    job["thread"] = threading.Thread(target=_run, daemon=True)
+    job["thread"].start()
+    return job
+
+
+# --- 大規模向け：複数ユニットの分割求解（兼務スタッフの所属決定・並列求解・応援による調整） ---
+# 対象はユニットごとに設定（従来どおりの1勤務表）が分かれている場合に限る。1つの設定の全スタッフを
+# チームへ自動分割することはしない（担務充足は「日×担務ごとに1名」で、勤務表1つにつき1組しか
+# 必要としないため、人員を分けるとチームごとに同じ充足が求められ問題の意味が変わる）。
+# 各ユニットを独立に解き、同名で複数ユニットに登場するスタッフを兼務者として扱う。
+# 兼務者はスキルの希少性から所属ユニット（ホーム）を1つ決めてそこで勤務を組み、
+# 調整パスで、ホームで「日」となった日（「日」の申し込み日を除く）に他ユニットの未充足担務を応援として埋める。
+# 応援は翌日制限・応援先での申し込み・△ の同行（応援先の熟練者の勤務）を満たす場合に限る。
+# 日勤枠からの振替なのでホーム側の担務充足・休日数・働き溜めは変わらない。
+STAFF_TABLE_KEYS = ["skill", "hols", "trainee", "prev", "request"]
+
+
+def subset_problem(problem, staff_names):
+    names = set(staff_names)
+    pos = [i for i, s in enumerate(problem["staff_list"][:problem["total"]]) if s in names]
+    sub = dict(problem)
+    sub["staff_list"] = [problem["staff_list"][i] for i in pos]
+    sub["total"] = len(pos)
+    sub["n_mgr"] = sum(1 for i in pos if i < problem["n_mgr"])
+    sub["tables"] = dict(problem["tables"])
+    for key in STAFF_TABLE_KEYS:
+        sub["tables"][key] = problem["tables"][key].iloc[pos]
+    sub["tables"]["names"] = pd.DataFrame({"スタッフ名": sub["staff_list"]})
+    return sub
+
+
+def shared_staff(unit_problems):
+    seen = {}
+    for u, problem in enumerate(unit_problems):
+        for name in problem["staff_list"][:problem["total"]]:
+            seen.setdefault(name, []).append(u)
+    return {name: units for name, units in seen.items() if len(units) > 1}
+
+
+def assign_home_units(unit_problems, shared=None):
+    shared = shared_staff(unit_problems) if shared is None else shared
+    inputs = [compile_inputs(p) for p in unit_problems]
+    # 兼務者以外の熟練者（○）数を担務ごとに数え、兼務者は最も手薄な担務を持つユニットへ順に割り当てる
+    skilled = []
+    for p, inp in zip(unit_problems, inputs):
+        own = np.array([name not in shared for name in p["staff_list"][:p["total"]]], dtype=bool)
+        skilled.append((inp["skill"][own] == SKILL_OK).sum(axis=0).astype(float))
+    home = {}
+    for name in sorted(shared, key=lambda n: len(shared[n]), reverse=True):
+        best, best_score = None, None
+        for u in shared[name]:
+            p = unit_problems[u]
+            row = inputs[u]["skill"][p["staff_list"].index(name)] == SKILL_OK
+            score = (1.0 / (1.0 + skilled[u][row])).sum() if row.any() else 0.0
+            key = (score, -p["total"])
+            if best_score is None or key > best_score:
+                best, best_score = u, key
+        home[name] = best
+        row = inputs[best]["skill"][unit_problems[best]["staff_list"].index(name)] == SKILL_OK
+        skilled[best][row] += 1
+    return home
+
+
+def decompose_units(unit_problems, home=None):
+    shared = shared_staff(unit_problems)
+    home = assign_home_units(unit_problems, shared) if home is None else home
+    subs = []
+    for u, problem in enumerate(unit_problems):
+        keep = [name for name in problem["staff_list"][:problem["total"]] if home.get(name, u) == u]
+        subs.append(subset_problem(problem, keep))
+    return subs, home
+
+
+def coordinate_units(unit_problems, subs, results, home):
+    unit_inputs = [compile_inputs(p) for p in unit_problems]
+    sub_inputs = [compile_inputs(p) for p in subs]
+    codes = [schedule_codes(inp, r["schedule"]) if r["ok"] else None for inp, r in zip(sub_inputs, results)]
+    lent = set()
+    helpers = []
+    extra = [np.zeros((inp["n_days"], inp["num_types_extended"]), dtype=np.int64) for inp in sub_inputs]
+    uncovered_before = []
+    for u, inp in enumerate(sub_inputs):
+        if codes[u] is None:
+            uncovered_before.append(None)
+            continue
+        gaps = uncovered_cells(inp, codes[u])
+        uncovered_before.append(int(gaps.sum()))
+        for d, i in zip(*np.nonzero(gaps)):
+            if uncovered_cells(inp, codes[u], extra[u])[d, i] == 0:
+                continue
+            sid = i + 1
+            # 応援先で △ の兼務者は、その日に応援先の熟練者（○）が勤務している場合だけ候補にし、○ の兼務者を優先する
+            mentor_on_duty = bool((((codes[u][:, d] >= 1) & (codes[u][:, d] <= inp["num_types_extended"])) & (inp["skill"][:, i] == SKILL_OK)).any())
+            candidates = []
+            for name, h in home.items():
+                if h == u or codes[h] is None or (name, d) in lent or name not in unit_problems[u]["staff_list"]:
+                    continue
+                if d >= sub_inputs[h]["n_days"]:
+                    continue
+                us = unit_problems[u]["staff_list"].index(name)
+                skill = unit_inputs[u]["skill"][us, i]
+                if skill == SKILL_NG or (skill == SKILL_TRAINEE and not mentor_on_duty):
+                    continue
+                # 応援先の設定にある本人の申し込み（休・日・別の担務）と食い違う応援はしない
+                if unit_inputs[u]["request"][us, d] not in (REQ_NONE, sid):
+                    continue
+                candidates.append((skill != SKILL_OK, name, h))
+            for _, name, h in sorted(candidates, key=lambda c: c[0]):
+                hs = subs[h]["staff_list"].index(name)
+                h_inp, h_codes = sub_inputs[h], codes[h]
+                # ホームで「日」の申し込みをしている日は応援に出さない
+                if h_codes[hs, d] != h_inp["S_NIK"] or h_inp["request"][hs, d] == h_inp["S_NIK"]:
+                    continue
+                # ホームの勤務行の当日を応援の担務に置き換え、前月末日・前後日との翌日制限（遅→早・遅→F・F→早）を新たに作らないか確認する。
+                # 担務の番号はユニットごとに異なるため、早番・遅番・F の区分に直して比べる
+                flags = [f[hs:hs + 1] for f in shift_kind_flags(h_inp, h_codes)]
+                before = transition_violation_cells(h_inp["prev_last_late"][hs:hs + 1], *flags)
+                for f, kind in zip(flags, shift_kind_flags(inp, np.array([[sid]]))):
+                    f[0, d] = kind[0, 0]
+                if (transition_violation_cells(h_inp["prev_last_late"][hs:hs + 1], *flags) & ~before).any():
+                    continue
+                lent.add((name, d))
+                extra[u][d, i] += 1
+                helpers.append({
+                    "staff": name,
+                    "home": h,
+                    "unit": u,
+                    "day": int(d) + 1,
+                    "shift": inp["s_list_extended"][i],
+                })
+                break
+    uncovered_after = [None if c is None else int(uncovered_cells(inp, c, e).sum()) for inp, c, e in zip(sub_inputs, codes, extra)]
+    return {"helpers": helpers, "uncovered_before": uncovered_before, "uncovered_after": uncovered_after}
+
+
+def start_decomposition_job(unit_problems, strategy_mode=STRATEGY_MODES[0], weights=None, time_limit=DEFAULT_TIME_LIMIT,
+                            num_workers=None, model_options=None, home=None, cache_dir=None, max_processes=None):
+    subs, home = decompose_units(unit_problems, home)
+    n_proc = max(1, min(len(subs), max_processes or os.cpu_count() or 1))
+    if num_workers is None:
+        # 同時に走るプロセス全体のスレッド数が CPU 数を超えないよう、1プロセスあたり CPU 数 ÷ プロセス数（最低1）とする
+        num_workers = max(1, (os.cpu_count() or 1) // n_proc)
+    pool = ProcessPoolExecutor(max_workers=n_proc)
+    futures = [pool.submit(solve_problem, sub, strategy_mode, weights, time_limit, num_workers, model_options, None, cache_dir) for sub in subs]
+    pool.shutdown(wait=False)
+    return {
+        "unit_problems": unit_problems,
+        "subs": subs,
+        "home": home,
+        "futures": futures,
+        "time_limit": float(time_limit),
+        # ユニット数がプロセス数を超える場合は順に回るため、その分の所要時間を見込む
+        "expected_time": float(time_limit) * -(-len(subs) // n_proc),
+        "started_at": time.time(),
+    }
+
+
+def decomposition_snapshot(job):
+    return {
+        "elapsed": time.time() - job["started_at"],
+        "expected_time": job["expected_time"],
+        "total": len(job["futures"]),
+        "done": sum(1 for f in job["futures"] if f.done()),
+    }
+
+
+def finish_decomposition_job(job):
+    results = []
+    for fut in job["futures"]:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append({"status": "ERROR", "ok": False, "schedule": None, "relaxation_messages": [], "error": f"{type(e).__name__}: {e}"})
+    coordination = coordinate_units(job["unit_problems"], job["subs"], results, job["home"])
+    return {"subs": job["subs"], "home": job["home"], "results": results, **coordination}
+
+
+# 応援者を「氏名（応援）」行として付け加えたユニットの勤務表
+def unit_schedule_with_helpers(out, u):
+    schedule = out["results"][u]["schedule"]
+    if schedule is None:
+        return None
+    rows = {}
+    for h in out["helpers"]:
+        if h["unit"] != u:
+            continue
+        row = rows.setdefault(f"{h['staff']}（応援）", [""] * schedule.shape[1])
+        row[h["day"] - 1] = h["shift"]
+    if not rows:
+        return schedule
+    return pd.concat([schedule, pd.DataFrame.from_dict(rows, orient="index", columns=schedule.columns)])
+
+
+def solve_units(unit_problems, **kwargs):
+    return finish_decomposition_job(start_decomposition_job(unit_problems, **kwargs))
+
+
+# --- 設定 JSON（dict）を直接求解する ---
+def solve_config(config, year=None, month=None, **kwargs):
+    return solve_problem(load_problem(config, year, month), **kwargs)
+
+
+# --- ローカル求解サービス（solve_service.py）との連携 ---
+# 複数のブラウザセッションが同時に求解しても CPU を奪い合わないよう、求解を常駐サービスのプロセスプールへ投入する。
+# 投入したジョブは通常の求解ジョブと同じ辞書として扱い、solve_job_snapshot / cancel_solve_job / finish_solve_job でポーリングする。
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_URL = os.environ.get("ROSTER_SOLVE_SERVICE", f"http://{SERVICE_HOST}:{SERVICE_PORT}")
+SERVICE_TIMEOUT = 10.0
+SERVICE_POLL_INTERVAL = 0.5
+
+
+# 勤務表（DataFrame）は求解結果キャッシュと同じ split 形式でやり取りする
+def result_to_json(result):
+    out = dict(result)
+    if out.get("schedule") is not None:
+        out["schedule"] = out["schedule"].to_dict(orient="split")
+    return out
+
+
+def result_from_json(data):
+    result = dict(data)
+    sched = result.get("schedule")
+    if sched is not None:
+        result["schedule"] = pd.DataFrame(sched["data"], index=sched["index"], columns=sched["columns"])
+    return result
+
+
+def _service_request(method, path, payload=None, url=None, timeout=SERVICE_TIMEOUT):
+    data = None
+    if payload is not None:
+        data = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload, default=_json_key).encode("utf-8")
+    req = urllib.request.Request((url or SERVICE_URL).rstrip("/") + path, data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as res:
+            return json.loads(res.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode("utf-8")).get("error", e.reason)
+        except ValueError:
+            message = e.reason
+        raise RuntimeError(f"求解サービス: {e.code} {message}") from None
+
+
+# --- サービスの稼働状況（起動していなければ None） ---
+def service_health(url=None, timeout=0.5):
+    try:
+        return _service_request("GET", "/health", url=url, timeout=timeout)
+    except (OSError, ValueError, RuntimeError):
+        return None
+
+
+def start_service_job(config, year=None, month=None, strategy_mode=STRATEGY_MODES[0], weights=None, time_limit=DEFAULT_TIME_LIMIT,
+                      model_options=None, hint_schedule=None, url=None):
+    options = {
+        "year": year,
+        "month": month,
+        "strategy_mode": strategy_mode,
+        "weights": weights,
+        "time_limit": float(time_limit),
+        "model_options": model_options,
+        "hint_schedule": None if hint_schedule is None else hint_schedule.to_dict(orient="split"),
+    }
+    # 設定本体は保存ファイルと同じ JSON 表現をそのまま埋め込む
+    payload = '{"config": ' + config_to_json(config) + ', "options": ' + json.dumps(options, ensure_ascii=False, default=_json_key) + "}"
+    accepted = _service_request("POST", "/jobs", payload, url=url)
+    return {
+        "service_url": url or SERVICE_URL,
+        "id": accepted["id"],
+        "time_limit": float(time_limit),
+        "started_at": time.time(),
+        "state": accepted["state"],
+        "queue_position": accepted.get("position"),
+        "elapsed": 0.0,
+        "incumbents": [],
+        "best_rows": None,
+        "tier": None,
+        "result": None,
+        "error": None,
+        "cancelled": False,
+        "done": threading.Event(),
+    }
+
+
+# 前回までに受け取った暫定解より後の分だけを取得して追記する
+def _poll_service_job(job):
+    if job["done"].is_set():
+        return
+    try:
+        data = _service_request("GET", f"/jobs/{job['id']}?since={len(job['incumbents'])}", url=job["service_url"])
+    except (OSError, ValueError, RuntimeError) as e:
+        job["error"] = f"{type(e).__name__}: {e}"
+        job["done"].set()
+        return
+    job["state"] = data["state"]
+    job["queue_position"] = data.get("position")
+    job["elapsed"] = data.get("elapsed", job["elapsed"])
+    job["incumbents"].extend(data.get("incumbents", []))
+    if data.get("best_rows") is not None:
+        job["best_rows"] = data["best_rows"]
+    job["tier"] = data.get("tier")
+    if data["state"] == "error":
+        job["error"] = data.get("error")
+        job["done"].set()
+    elif data["state"] in ("done", "cancelled"):
+        job["result"] = result_from_json(data["result"])
+        job["done"].set()
+
+
+def _service_job_snapshot(job):
+    _poll_service_job(job)
+    return {
+        "running": not job["done"].is_set(),
+        "elapsed": job["elapsed"],
+        "time_limit": job["time_limit"],
+        "incumbents": list(job["incumbents"]),
+        "best_rows": job["best_rows"],
+        "cancelled": job["cancelled"],
+        "tier": job["tier"],
+        "queue_position": job["queue_position"] if job["state"] == "queued" else None,
+    }
+
+
+def _cancel_service_job(job):
+    try:
+        _service_request("DELETE", f"/jobs/{job['id']}", url=job["service_url"])
+    except (OSError, ValueError, RuntimeError):
+        pass
+
+
+def _finish_service_job(job):
+    _poll_service_job(job)
+    while not job["done"].wait(SERVICE_POLL_INTERVAL):
+        _poll_service_job(job)
+    if job["error"] is not None:
+        raise RuntimeError(job["error"])
+    return job["result"]
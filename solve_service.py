@@ -0,0 +1,293 @@
+import argparse
+import asyncio
+import http
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+import roster_engine as eng
+
+# =====================================================================
+#  ローカル求解サービス
+#  各ブラウザセッションが Streamlit のサーバープロセス内で個別に CP-SAT を走らせると、
+#  同時に求解したときに CPU を奪い合って全員の求解が遅くなる。
+#  このサービスは求解ジョブを順番待ちの列に積み、CPU コア数に合わせた数だけプロセスプールで同時に実行する。
+#  例: python solve_service.py --port 8765
+#
+#  POST   /jobs          {"config": 設定 JSON, "options": {...}} を投入 → {"id", "state", "position"}
+#  GET    /jobs/<id>     状態・暫定解（?since=N で N 件目以降だけ）・最良勤務表のプレビュー・完了時の結果
+#  DELETE /jobs/<id>     中断（待機中なら取り消し、実行中なら現時点の最良解で終了）
+#  GET    /health        同時実行数・実行中／待機中の件数
+# =====================================================================
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+MAX_FINISHED_JOBS = 100
+
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+# --- 1ジョブ分の求解（プロセスプール内で実行） ---
+# 通常の求解ジョブをこのプロセス内で起動し、暫定解を共有辞書へ書き出しながら中断要求を監視する。
+def run_job(job_id, request, progress, control, num_workers, cache_dir):
+    options = request.get("options") or {}
+    problem = eng.load_problem(request["config"], options.get("year"), options.get("month"))
+    strategy_mode = options.get("strategy_mode") or eng.STRATEGY_MODES[0]
+    weights = options.get("weights")
+    model_options = options.get("model_options")
+    time_limit = float(options.get("time_limit") or eng.DEFAULT_TIME_LIMIT)
+    hint = options.get("hint_schedule")
+
+    inputs = eng.compile_inputs(problem)
+    # ヒント付きの求解は結果がヒントに依存するためキャッシュしない
+    cache_key = None
+    if cache_dir is not None and hint is None:
+        cache_key = eng.solve_cache_key(problem, strategy_mode, weights, time_limit, num_workers, model_options, inputs=inputs)
+        cached = eng.cache_get(cache_key, cache_dir)
+        if cached is not None:
+            return eng.result_to_json(cached)
+
+    built = eng.build_model(problem, strategy_mode, weights, inputs=inputs, model_options=model_options)
+    if hint is not None:
+        eng.add_schedule_hint(built, pd.DataFrame(hint["data"], index=hint["index"], columns=hint["columns"]))
+    if built["model_options"]["objective"] == "lexicographic":
+        job = eng.start_lexicographic_job(built, time_limit, num_workers)
+    else:
+        job = eng.start_solve_job(built, time_limit, num_workers)
+
+    while not job["done"].wait(eng.SERVICE_POLL_INTERVAL):
+        if control.get(job_id) and not job["cancelled"]:
+            eng.cancel_solve_job(job)
+        snap = eng.solve_job_snapshot(job)
+        progress[job_id] = {k: snap[k] for k in ("elapsed", "incumbents", "best_rows", "tier")}
+
+    result = eng.finish_solve_job(job)
+    # 中断された解は制限時間いっぱい探索した結果ではないため保存しない
+    if cache_key is not None and result["ok"] and not job["cancelled"]:
+        eng.cache_put(cache_key, result, cache_dir)
+    return eng.result_to_json(result)
+
+
+class SolveService:
+    def __init__(self, slots, num_workers=eng.DEFAULT_NUM_WORKERS, cache_dir=eng.CACHE_DIR, max_finished=MAX_FINISHED_JOBS):
+        self.slots = slots
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.max_finished = max_finished
+        self.pool = ProcessPoolExecutor(max_workers=slots)
+        # 実行中ジョブの暫定解（ワーカー → サービス）と中断要求（サービス → ワーカー）の受け渡し
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.dict()
+        self.control = self.manager.dict()
+        self.jobs = {}
+        self.queue = asyncio.Queue()
+        self._ids = itertools.count(1)
+
+    # --- ジョブの投入・参照・中断 ---
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("リクエスト本文は JSON オブジェクトで指定してください")
+        if not isinstance(request.get("config"), dict):
+            raise ValueError("config がありません")
+        job_id = f"{int(time.time())}-{next(self._ids)}"
+        self.jobs[job_id] = {
+            "id": job_id,
+            "request": request,
+            "state": "queued",
+            "time_limit": float((request.get("options") or {}).get("time_limit") or eng.DEFAULT_TIME_LIMIT),
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+        self.queue.put_nowait(job_id)
+        return self.jobs[job_id]
+
+    def position(self, job_id):
+        queued = [j for j in self.jobs.values() if j["state"] == "queued"]
+        return next(i for i, j in enumerate(queued) if j["id"] == job_id) + 1
+
+    def status(self, job, since=0):
+        out = {"id": job["id"], "state": job["state"], "time_limit": job["time_limit"]}
+        if job["state"] == "queued":
+            out["position"] = self.position(job["id"])
+        elif job["state"] == "running":
+            snap = self.progress.get(job["id"]) or {}
+            incumbents = snap.get("incumbents", [])
+            out.update({
+                "elapsed": time.time() - job["started_at"],
+                "n_incumbents": len(incumbents),
+                "incumbents": incumbents[since:],
+                "tier": snap.get("tier"),
+                "cancelled": bool(self.control.get(job["id"])),
+            })
+            # プレビューは前回の問い合わせ以降に解が更新されたときだけ返す
+            if len(incumbents) > since:
+                out["best_rows"] = snap.get("best_rows")
+        else:
+            out["elapsed"] = job["finished_at"] - (job["started_at"] or job["finished_at"])
+            out["result"] = job["result"]
+            out["error"] = job["error"]
+        return out
+
+    def cancel(self, job):
+        if job["state"] == "queued":
+            job["state"] = "cancelled"
+            job["finished_at"] = time.time()
+            job["result"] = {"status": "UNKNOWN", "ok": False, "schedule": None, "relaxation_messages": [], "objective": None, "wall_time": 0.0}
+        elif job["state"] == "running":
+            self.control[job["id"]] = True
+
+    def health(self):
+        states = [j["state"] for j in self.jobs.values()]
+        return {
+            "slots": self.slots,
+            "num_workers": self.num_workers,
+            "running": states.count("running"),
+            "queued": states.count("queued"),
+        }
+
+    # 完了したジョブは新しいものから一定件数だけ保持する
+    def _evict(self):
+        finished = [j for j in self.jobs.values() if j["finished_at"] is not None]
+        for j in sorted(finished, key=lambda j: j["finished_at"])[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[j["id"]]
+
+    # --- 実行枠（同時実行数だけ起動し、列から1件ずつ取り出してプロセスプールで求解する） ---
+    async def _slot(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            if job is None or job["state"] != "queued":
+                continue
+            job["state"] = "running"
+            job["started_at"] = time.time()
+            self.control[job_id] = False
+            pool = self.pool
+            try:
+                job["result"] = await loop.run_in_executor(
+                    pool, run_job, job_id, job["request"], self.progress, self.control, self.num_workers, self.cache_dir
+                )
+                job["state"] = "done"
+            except BrokenProcessPool as e:
+                # ワーカープロセスが異常終了した場合はプールを作り直して後続のジョブを受け付ける。
+                # 同じプールで実行中だった他の枠も同じ例外を受けるため、作り直すのは最初に気づいた枠だけにする
+                job["state"], job["error"] = "error", f"{type(e).__name__}: {e}"
+                if self.pool is pool:
+                    self.pool = ProcessPoolExecutor(max_workers=self.slots)
+                    pool.shutdown(wait=False, cancel_futures=True)
+            except Exception as e:
+                job["state"], job["error"] = "error", f"{type(e).__name__}: {e}"
+            finally:
+                job["finished_at"] = time.time()
+                self.progress.pop(job_id, None)
+                self.control.pop(job_id, None)
+                self._evict()
+
+    # --- HTTP（1リクエスト1接続の最小実装） ---
+    async def _route(self, method, target, body):
+        parts = urlsplit(target)
+        path = parts.path.rstrip("/")
+        query = parse_qs(parts.query)
+        if method == "GET" and path == "/health":
+            return 200, self.health()
+        if method == "POST" and path == "/jobs":
+            job = self.submit(json.loads(body.decode("utf-8")))
+            return 202, {"id": job["id"], "state": job["state"], "position": self.position(job["id"])}
+        if path.startswith("/jobs/"):
+            job = self.jobs.get(path[len("/jobs/"):])
+            if job is None:
+                return 404, {"error": "ジョブが見つかりません"}
+            if method == "GET":
+                return 200, self.status(job, int(query.get("since", ["0"])[0]))
+            if method == "DELETE":
+                self.cancel(job)
+                return 200, {"id": job["id"], "state": job["state"]}
+        return 404, {"error": f"{method} {parts.path} は未対応です"}
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_BYTES:
+                    code, payload = 413, {"error": "リクエストが大きすぎます"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    code, payload = await self._route(method, target, body)
+            except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+                code, payload = 400, {"error": f"{type(e).__name__}: {e}"}
+            data = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {code} {http.HTTPStatus(code).phrase}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+                + data
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host=eng.SERVICE_HOST, port=eng.SERVICE_PORT):
+        workers = [asyncio.create_task(self._slot()) for _ in range(self.slots)]
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"求解サービス: http://{host}:{port} / 同時実行 {self.slots} 件 × CP-SAT {self.num_workers} スレッド", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for w in workers:
+                w.cancel()
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.manager.shutdown()
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="勤務作成の求解ジョブを受け付けるローカルサービスを起動します。")
+    p.add_argument("--host", default=eng.SERVICE_HOST, help="待ち受けアドレス（既定: localhost のみ）")
+    p.add_argument("--port", type=int, default=eng.SERVICE_PORT)
+    p.add_argument("--num-workers", type=int, default=eng.DEFAULT_NUM_WORKERS, help="1求解あたりの CP-SAT スレッド数")
+    p.add_argument("--slots", type=int, default=0, help="同時に求解するジョブ数（0: CPU数 ÷ ソルバースレッド数）")
+    p.add_argument("--cache-dir", default=eng.CACHE_DIR, help="求解結果キャッシュの保存先（同一条件の再求解を省略）")
+    p.add_argument("--no-cache", action="store_true", help="求解結果キャッシュを使わない")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    slots = args.slots
+    if slots <= 0:
+        slots = max(1, (os.cpu_count() or 1) // max(1, args.num_workers))
+
+    async def run():
+        service = SolveService(slots, args.num_workers, None if args.no_cache else args.cache_dir)
+        await service.serve(args.host, args.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())